@@ -0,0 +1,102 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from loguru import logger as logging
+
+
+class BatchJob:
+    """
+    A unit of work waiting in a BatchQueue.
+    """
+
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class BatchQueue:
+    """
+    Collects compatible jobs for a short window and runs them as one batch.
+
+    Jobs are compatible when their keys are equal. A dedicated thread takes the
+    oldest job, then waits up to `window` seconds for more jobs with the same key,
+    up to `max_batch_size`; jobs already waiting are always picked up, even with no
+    window. Incompatible jobs are held back in arrival order for the next batch.
+    `run_batch` receives the list of requests and must return one result per request,
+    which resolves the futures returned by `submit`. With `maxsize`, `submit` blocks
+    while the queue is full, which applies backpressure to the producer. Jobs whose
+    future was cancelled before their batch started (e.g. the client went away) are
+    dropped from it.
+    """
+
+    def __init__(self, run_batch, window: float = 0.0, max_batch_size: int = 1, name: str = "batch", maxsize: int = 0):
+        self.run_batch = run_batch
+        self.window = window
+        self.max_batch_size = max(max_batch_size, 1)
+        self.name = name
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._backlog = deque()
+        self.batches = 0
+        self.jobs = 0
+        self.skipped = 0
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key, request):
+        """
+        Queue a request and return a Future resolved with its result.
+        """
+        job = BatchJob(key, request)
+        self._queue.put(job)
+        return job.future
+
+    def _next_job(self):
+        if self._backlog:
+            return self._backlog.popleft()
+        return self._queue.get()
+
+    def _collect(self, first):
+        batch = [first]
+        # Compatible jobs held back from an earlier window come first
+        for job in list(self._backlog):
+            if len(batch) >= self.max_batch_size:
+                return batch
+            if job.key == first.key:
+                self._backlog.remove(job)
+                batch.append(job)
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                job = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job.key == first.key:
+                batch.append(job)
+            else:
+                self._backlog.append(job)
+        return batch
+
+    def _loop(self):
+        while True:
+            collected = self._collect(self._next_job())
+            # Marks the futures as running, so they can no longer be cancelled
+            batch = [job for job in collected if job.future.set_running_or_notify_cancel()]
+            self.skipped += len(collected) - len(batch)
+            if not batch:
+                continue
+            self.batches += 1
+            self.jobs += len(batch)
+            try:
+                results = self.run_batch([job.request for job in batch])
+                for job, result in zip(batch, results):
+                    job.future.set_result(result)
+            except Exception as e:
+                logging.error(f"[{self.name}] batch of {len(batch)} failed: {e}")
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
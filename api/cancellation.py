@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+
+
+class RequestAbandoned(Exception):
+    """
+    The caller of a request went away before it ran: `reason` is "disconnect" or "deadline".
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Request abandoned ({reason})")
+        self.reason = reason
+
+
+class Caller:
+    """
+    Whether the caller of a request still waits for it: set when the daemon closed the
+    connection, or past the X-Deadline it sent (wall clock time).
+    """
+
+    def __init__(self, deadline: float = None):
+        self.deadline = deadline
+        self.disconnected = threading.Event()
+
+    def gone(self):
+        """
+        :return: Reason the caller is gone, or None while it waits.
+        """
+        if self.disconnected.is_set():
+            return "disconnect"
+        if self.deadline is not None and time.time() > self.deadline:
+            return "deadline"
+        return None
+
+    def check(self):
+        reason = self.gone()
+        if reason:
+            raise RequestAbandoned(reason)
+
+
+def wait_for_job(future, caller, on_skip, poll: float = 0.05):
+    """
+    Wait for a BatchQueue future, cancelling it if the caller goes away before its batch starts.
+
+    A job that started runs to completion: diffusers cannot stop a pipeline call midway.
+
+    :param on_skip: Called with the reason when the job was cancelled.
+    :raises RequestAbandoned: When the job was cancelled.
+    """
+    while True:
+        try:
+            return future.result(timeout=poll)
+        except FutureTimeoutError:
+            reason = caller.gone()
+            if reason and future.cancel():
+                on_skip(reason)
+                raise RequestAbandoned(reason)
+
+
+async def serve(request, deadline, func, *args):
+    """
+    Run the blocking endpoint body `func(*args, caller)` in the thread pool, flagging the
+    caller as gone as soon as the client disconnects.
+
+    :return: The result of `func`, or a 499 (disconnect) / 504 (deadline) response when abandoned.
+    """
+    caller = Caller(deadline)
+
+    async def watch():
+        # The body has been read already, the next message is the disconnect
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        caller.disconnected.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        return await run_in_threadpool(func, *args, caller)
+    except RequestAbandoned as e:
+        return JSONResponse(status_code=504 if e.reason == "deadline" else 499, content={"error": str(e)})
+    finally:
+        watcher.cancel()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+
+# Components SDXL base and refiner pipelines can share, with the module each one depends on
+SHAREABLE_COMPONENTS = {
+    "vae": None,
+    "text_encoder_2": None,
+    "tokenizer_2": "text_encoder_2",
+}
+
+# Bytes read from the start and the end of each weights file for the fingerprint
+SAMPLE_SIZE = 1024 ** 2
+
+# Methods stable-fast replaces on module instances when compiling a pipeline
+COMPILED_ATTRIBUTES = ("forward", "decode", "encode")
+
+
+def component_fingerprint(model_path, component):
+    """
+    Cheap fingerprint of a pipeline component on disk.
+
+    Covers the component config (minus private keys such as `_name_or_path`), the
+    tokenizer vocabularies and, for the default (non-variant) weights files, their
+    size plus the first and last megabyte. Returns None if the component is missing.
+    """
+    directory = os.path.join(model_path, component)
+    if not os.path.isdir(directory):
+        return None
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        file_path = os.path.join(directory, name)
+        if not os.path.isfile(file_path):
+            continue
+        if name == "config.json":
+            with open(file_path, "r") as f:
+                config = {k: v for k, v in json.load(f).items() if not k.startswith("_")}
+            digest.update(json.dumps(config, sort_keys=True).encode())
+        elif name in ("vocab.json", "merges.txt"):
+            with open(file_path, "rb") as f:
+                digest.update(f.read())
+        elif name.endswith((".safetensors", ".bin")) and name.count(".") == 1:
+            size = os.path.getsize(file_path)
+            digest.update(f"{name}:{size};".encode())
+            with open(file_path, "rb") as f:
+                digest.update(f.read(SAMPLE_SIZE))
+                if size > 2 * SAMPLE_SIZE:
+                    f.seek(-SAMPLE_SIZE, os.SEEK_END)
+                    digest.update(f.read(SAMPLE_SIZE))
+    return digest.hexdigest()
+
+
+def shared_components(source_pipeline, source_path, target_path):
+    """
+    Return the components of `source_pipeline` that are identical on disk in `target_path`.
+
+    :return: Dict of component name to the already loaded module, ready to be passed
+             to `from_pretrained`.
+    """
+    shared = {}
+    for component, depends_on in SHAREABLE_COMPONENTS.items():
+        module = getattr(source_pipeline, component, None)
+        if module is None or (depends_on and depends_on not in shared):
+            continue
+        fingerprint = component_fingerprint(source_path, component)
+        if fingerprint is not None and fingerprint == component_fingerprint(target_path, component):
+            shared[component] = module
+    return shared
+
+
+@contextmanager
+def keep_compiled(modules):
+    """
+    Keep the compiled methods of already compiled modules while another pipeline is compiled.
+
+    stable-fast patches `forward`/`decode`/`encode` on module instances; compiling a
+    second pipeline that holds the same modules would wrap them a second time.
+    """
+    saved = []
+    for module in modules:
+        for submodule in module.modules():
+            saved.append((submodule, {k: v for k, v in vars(submodule).items() if k in COMPILED_ATTRIBUTES}))
+    try:
+        yield
+    finally:
+        for submodule, attributes in saved:
+            for name in COMPILED_ATTRIBUTES:
+                if name in attributes:
+                    object.__setattr__(submodule, name, attributes[name])
+                elif name in vars(submodule):
+                    delattr(submodule, name)
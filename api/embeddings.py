@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+def tensors_nbytes(tensors):
+    return sum(t.element_size() * t.nelement() for t in tensors.values() if t is not None)
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of SDXL prompt embeddings bounded by entry count and memory.
+
+    Entries are keyed by the identity of the text encoders that produced them and by
+    the prompt. The SDXL base and refiner pipelines never share entries: the refiner
+    has no first text encoder and its embeddings have another width, so one cache
+    only gives them a common memory budget. Every
+    miss records how long the encoders took; `saved_seconds` estimates the encoder
+    time avoided by hits from the running average.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.encode_seconds = 0.0
+        self.saved_seconds = 0.0
+
+    def get_or_encode(self, encoder_key, prompt, encode):
+        """
+        Return the embeddings for `prompt`, calling `encode()` on a miss.
+
+        :param encoder_key: Identity of the text encoders used by `encode`.
+        :param prompt: Prompt text.
+        :param encode: Callable returning a dict of embedding tensors.
+        """
+        key = (encoder_key, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += self.encode_seconds / max(self.misses, 1)
+                return entry
+
+        start = time.perf_counter()
+        entry = encode()
+        elapsed = time.perf_counter() - start
+        size = tensors_nbytes(entry)
+
+        with self._lock:
+            self.misses += 1
+            self.encode_seconds += elapsed
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = entry
+                self._bytes += size
+                while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= tensors_nbytes(evicted)
+                    self.evictions += 1
+        return entry
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "encode_seconds": round(self.encode_seconds, 3),
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
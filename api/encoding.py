@@ -0,0 +1,62 @@
+import base64
+import io
+import uuid
+
+# Supported output formats: request name -> (PIL format, media type)
+IMAGE_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def encode_image(image, format="jpeg", quality=75):
+    """
+    Encode a PIL image to bytes.
+
+    :param image: PIL image.
+    :param format: One of IMAGE_FORMATS.
+    :param quality: Encoder quality for lossy formats (1-100).
+    :return: Tuple of (encoded bytes, media type).
+    """
+    pil_format, media_type = IMAGE_FORMATS[format]
+    buffered = io.BytesIO()
+    if pil_format == "PNG":
+        image.save(buffered, format=pil_format)
+    else:
+        image.save(buffered, format=pil_format, quality=quality)
+    return buffered.getvalue(), media_type
+
+
+def encode_base64(data):
+    return base64.b64encode(data).decode('utf-8')
+
+
+def accepts_binary(accept):
+    """
+    Check whether the Accept header asks for raw image bytes instead of JSON.
+    """
+    if not accept:
+        return False
+    media_types = [part.split(";")[0].strip() for part in accept.split(",")]
+    return any(m.startswith("image/") or m == "multipart/mixed" for m in media_types)
+
+
+def accepts_multipart(accept):
+    return bool(accept) and "multipart/mixed" in accept
+
+
+def multipart_body(parts):
+    """
+    Build a multipart/mixed body from a list of (bytes, media type) parts.
+
+    :return: Tuple of (body, content type including the boundary).
+    """
+    boundary = uuid.uuid4().hex
+    chunks = []
+    for data, media_type in parts:
+        chunks.append(f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Length: {len(data)}\r\n\r\n".encode())
+        chunks.append(data)
+        chunks.append(b"\r\n")
+    chunks.append(f"--{boundary}--\r\n".encode())
+    return b"".join(chunks), f"multipart/mixed; boundary={boundary}"
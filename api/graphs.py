@@ -0,0 +1,236 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from loguru import logger as logging
+
+
+def parse_buckets(value):
+    """
+    Parse a comma separated list of WIDTHxHEIGHT resolution buckets.
+    """
+    buckets = []
+    for item in value.split(","):
+        item = item.strip().lower()
+        if item:
+            width, height = item.split("x")
+            buckets.append((int(width), int(height)))
+    return buckets
+
+
+def select_bucket(width, height, buckets, mode="snap"):
+    """
+    Map a requested resolution to a resolution bucket.
+
+    snap: the bucket with the closest aspect ratio, then the closest area; the
+          output is resized to the requested resolution.
+    pad:  the smallest bucket that contains the requested resolution; the output
+          is center-cropped to the requested resolution.
+    off:  no mapping.
+
+    :return: (width, height) of the bucket, or None to run at the requested resolution.
+    """
+    if mode == "off" or not buckets or (width, height) in buckets:
+        return None
+    if mode == "pad":
+        fitting = [b for b in buckets if b[0] >= width and b[1] >= height]
+        return min(fitting, key=lambda b: b[0] * b[1]) if fitting else None
+    ratio = math.log(width / height)
+    return min(buckets, key=lambda b: (round(abs(math.log(b[0] / b[1]) - ratio), 3), abs(b[0] * b[1] - width * height)))
+
+
+def fit_to_size(image, width, height, mode):
+    """
+    Bring a PIL image rendered at a bucket resolution back to the requested resolution.
+    """
+    if image.size == (width, height):
+        return image
+    if mode == "pad":
+        left = (image.width - width) // 2
+        top = (image.height - height) // 2
+        return image.crop((left, top, left + width, top + height))
+    return image.resize((width, height))
+
+
+def default_capture(fn, args, kwargs):
+    from sfast.cuda.graphs import simple_make_graphed_callable
+    return simple_make_graphed_callable(fn, args, kwargs)
+
+
+def default_key(args, kwargs):
+    from sfast.cuda.graphs import hash_arg
+    return (hash_arg(args), hash_arg(kwargs))
+
+
+def default_memory():
+    import torch
+    return torch.cuda.memory_reserved()
+
+
+class CaptureGate:
+    """
+    Shared/exclusive lock over the GPU work of the worker.
+
+    Pipeline calls of every stage hold it shared; a CUDA graph capture holds it
+    exclusively, since work launched on another stream during a capture invalidates
+    it. The capturing thread gives up its own shared hold while it waits, so two
+    stages missing a graph at the same time capture one after the other instead of
+    waiting for each other.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._capturing = False
+        self._local = threading.local()
+
+    @contextmanager
+    def shared(self):
+        with self._condition:
+            # Pending captures go first, so traffic cannot starve them
+            while self._capturing or self._waiting:
+                self._condition.wait()
+            self._active += 1
+        self._local.held = getattr(self._local, "held", 0) + 1
+        try:
+            yield
+        finally:
+            self._local.held -= 1
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        held = getattr(self._local, "held", 0)
+        with self._condition:
+            self._active -= held
+            self._waiting += 1
+            self._condition.notify_all()
+            while self._capturing or self._active:
+                self._condition.wait()
+            self._waiting -= 1
+            self._capturing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._capturing = False
+                self._active += held
+                self._condition.notify_all()
+
+
+class GraphCache:
+    """
+    LRU cache of captured CUDA graphs shared by every pipeline of the worker.
+
+    Each wrapped callable is captured once per input signature (tensor shapes, dtypes
+    and scalar arguments). The memory a capture adds is measured and the least
+    recently used graphs are evicted once the total exceeds `budget_bytes`. Graphs
+    captured inside `pinned()` (the pre-captured resolution buckets) are never
+    evicted. Captures run with the GPU to themselves (see CaptureGate, which pipeline
+    calls must hold through `gate.shared()`). `capture`, `key` and `memory` can be
+    replaced, e.g. by a stub compiler.
+    """
+
+    def __init__(self, budget_bytes, capture=None, key=None, memory=None):
+        self.budget_bytes = budget_bytes
+        self.capture = capture or default_capture
+        self.key = key or default_key
+        self.memory = memory or default_memory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.gate = CaptureGate()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.capture_seconds = 0.0
+
+    @property
+    def _pinning(self):
+        return getattr(self._local, "pinning", False)
+
+    @contextmanager
+    def pinned(self):
+        """
+        Pin the graphs captured or used by the current thread inside this block.
+        """
+        self._local.pinning = True
+        try:
+            yield
+        finally:
+            self._local.pinning = False
+
+    def wrap(self, name, fn):
+        """
+        Return a callable that replays a captured graph of `fn` for each input signature.
+        """
+        def graphed(*args, **kwargs):
+            key = (name, self.key(args, kwargs))
+            entry = self._lookup(key)
+            if entry is None:
+                with self.gate.exclusive():
+                    # Another stage may have captured the same graph while this one waited
+                    entry = self._lookup(key) or self._capture(key, fn, args, kwargs)
+            return entry[0](*args, **kwargs)
+
+        return graphed
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if self._pinning and not entry[2]:
+                    entry = self._entries[key] = (entry[0], entry[1], True)
+            return entry
+
+    def _capture(self, key, fn, args, kwargs):
+        # Called with the gate held exclusively, so captures never overlap
+        memory_before = self.memory()
+        start = time.perf_counter()
+        graphed = self.capture(fn, args, kwargs)
+        elapsed = time.perf_counter() - start
+        size = max(self.memory() - memory_before, 0)
+        entry = (graphed, size, self._pinning)
+        with self._lock:
+            self.misses += 1
+            self.capture_seconds += elapsed
+            self._entries[key] = entry
+            self._bytes += size
+            logging.info(f"📸  captured CUDA graph for {key[0]} in {elapsed:.2f}s (+{size / 1024 ** 2:.0f} MB, {len(self._entries)} graphs, {self._bytes / 1024 ** 2:.0f} MB){' [pinned]' if self._pinning else ''}")
+            self._evict()
+        return entry
+
+    def _evict(self):
+        for key in list(self._entries):
+            if self._bytes <= self.budget_bytes:
+                return
+            _, size, pinned = self._entries[key]
+            if pinned:
+                continue
+            del self._entries[key]
+            self._bytes -= size
+            self.evictions += 1
+            logging.info(f"🗑️  evicted CUDA graph for {key[0]} (-{size / 1024 ** 2:.0f} MB)")
+        if self._bytes > self.budget_bytes:
+            logging.warning(f"Pinned CUDA graphs use {self._bytes / 1024 ** 2:.0f} MB, above the {self.budget_bytes / 1024 ** 2:.0f} MB budget")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "graphs": len(self._entries),
+            "pinned": sum(1 for _, _, pinned in self._entries.values() if pinned),
+            "bytes": self._bytes,
+            "budget_bytes": self.budget_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "capture_seconds": round(self.capture_seconds, 3),
+        }
@@ -2,9 +2,9 @@ import random
 import torch
 from diffusers import AutoPipelineForText2Image, AutoPipelineForImage2Image, EulerAncestralDiscreteScheduler
 from sfast.compilers.diffusion_pipeline_compiler import compile, CompilationConfig
-from diffusers.utils import load_image
 from loguru import logger as logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Header, Request, Response
+from fastapi.responses import JSONResponse
 import inspect
 import uvicorn
 import argparse
@@ -12,50 +12,78 @@ import io
 import time
 import base64
 from PIL import Image
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from io import BytesIO
+from typing import Literal, Optional
 import threading
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from batching import BatchQueue
+from embeddings import PromptEmbeddingCache
+from components import shared_components, keep_compiled
+from encoding import encode_image, encode_base64, accepts_binary, accepts_multipart, multipart_body
+from graphs import GraphCache, parse_buckets, select_bucket, fit_to_size
+from warmup import WarmUp, synthetic_image
+from timings import StageTimings, Timings, GPU_STAGES, trace_header
+from cancellation import RequestAbandoned, wait_for_job, serve
 
 # Function to convert base64 to a PIL Image object
 def base64_to_image(base64_encoded_image):
     image_data = base64.b64decode(base64_encoded_image)
     return Image.open(BytesIO(image_data))
 
-# Function to convert a PIL Image object to base64
-def image_to_base64(image):
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
 # Check if the script is running under Uvicorn
 def is_running_under_uvicorn():
     return any('uvicorn' in frame.filename for frame in inspect.stack())
 
 def block_thread(func):
-    func._lock = threading.Lock()
-
-    def wrapper(*args, **kwargs):
-        with func._lock:
-            return func(*args, **kwargs)
+    # One lock per pipeline instance, so the base and refiner stages can overlap
+    def wrapper(self, *args, caller=None, **kwargs):
+        with self.lock:
+            # Requests that waited for the lock are dropped if their caller went away meanwhile
+            if caller is not None:
+                caller.check()
+            # GPU work of every stage stops while a CUDA graph is being captured
+            with self.graph_cache.gate.shared() if self.graph_cache is not None else nullcontext():
+                return func(self, *args, **kwargs)
 
     return wrapper
 # Singleton class for SDFastAPI
 class SDFastAPI:
-    def __init__(self, model_name, pipeline, warm_up=True, worker_id=0):
+    def __init__(self, model_name, pipeline, worker_id=0, embedding_cache=None, share_from=None, graph_cache=None):
+        start_time = time.perf_counter()
+        memory_before = torch.cuda.memory_allocated()
         self.model_name = model_name
         self.pipeline = pipeline
-        self.model = self.load_model(AutoPipelineForText2Image if pipeline == "t2i" else AutoPipelineForImage2Image)
+        self.embedding_cache = embedding_cache
+        self.graph_cache = graph_cache
+        self.lock = threading.Lock()
+        self.vae_lock = threading.Lock()
+        self.stream = torch.cuda.Stream()
+        # Reuse the VAE and text encoder of another pipeline when they are identical on disk
+        self.shared = shared_components(share_from.model, share_from.model_name, model_name) if share_from else {}
+        if 'vae' in self.shared:
+            self.vae_lock = share_from.vae_lock
+        self.model = self.load_model(AutoPipelineForText2Image if pipeline == "t2i" else AutoPipelineForImage2Image, **self.shared)
         self.config = CompilationConfig.Default()
         self.configure_performance()
-        self.model = compile(self.model, self.config)
+        with keep_compiled([module for module in self.shared.values() if hasattr(module, 'modules')]):
+            self.model = compile(self.model, self.config)
+        if self.graph_cache is not None:
+            # One graph per input shape, captured and evicted by the shared graph cache
+            self.model.unet.forward = self.graph_cache.wrap(f"{self.model_name}/unet", self.model.unet.forward)
+        if pipeline != "t2i":
+            self.model.prepare_latents = self.vae_encoding(self.model.prepare_latents)
         self.worker_id = worker_id
+        self.load_time = time.perf_counter() - start_time
+        self.resident_memory = torch.cuda.memory_allocated() - memory_before
+        shared_info = f", sharing {', '.join(self.shared)} with {share_from.model_name}" if self.shared else ""
+        logging.info(f'{self.model_name} loaded in {self.load_time:.1f}s, {self.resident_memory / 1024 ** 2:.0f} MB resident{shared_info}.')
         logging.warning('First diffusion generation will generate warnings. This does not compromise daemon operation.')
-        self.warm_up() if warm_up else None
-        logging.info(f'{self.model_name} loaded.')
 
-    def load_model(self, pipeline):
+    def load_model(self, pipeline, **components):
         logging.info(f'Loading {self.model_name} diffusion model..')
-        model = pipeline.from_pretrained(self.model_name, torch_dtype=torch.float16)
+        model = pipeline.from_pretrained(self.model_name, torch_dtype=torch.float16, **components)
         model.scheduler = EulerAncestralDiscreteScheduler.from_config(model.scheduler.config)
         model.safety_checker = None  # Disable the safety checker
         model.to("cuda")
@@ -64,7 +92,9 @@ class SDFastAPI:
     def configure_performance(self):
         self.config.enable_xformers = self.try_import_module('xformers')
         self.config.enable_triton = self.try_import_module('triton')
-        self.config.enable_cuda_graph = True
+        # With a graph cache the UNet graphs are captured per resolution bucket instead
+        # of by stable-fast on whatever shape a live request brings
+        self.config.enable_cuda_graph = self.graph_cache is None
 
     def try_import_module(self, module_name):
         try:
@@ -74,31 +104,118 @@ class SDFastAPI:
             logging.error(f'{module_name} not installed, skipping')
             return False
 
-    def warm_up(self):
-        logging.info(f"Warming up {self.model_name}.. Please wait.")
-        _ = self.model(**self.get_default_parameters()).images[0]
-
-    def get_default_parameters(self):
-        url = "https://huggingface.co/datasets/patrickvonplaten/images/resolve/main/aa_xl/000000009.png"
-        init_image = load_image(url).convert("RGB")
-        return dict(
-            image=init_image,
-            prompt='Petals',
-            height=1024,
-            width=1024,
-            num_inference_steps=50,
-            num_images_per_prompt=1,
-            batch_size=1,
-            strength=1
-        )
+    def warm_up(self, width, height, steps=2):
+        """
+        Run a short generation at one resolution, so the traced modules and the UNet
+        graph of that resolution are ready (and pinned) before traffic needs them.
+        """
+        kwargs = dict(prompt="", height=height, width=width, num_inference_steps=steps, seed=0)
+        if self.pipeline != "t2i":
+            # strength=1 runs every step, and the synthetic image also traces the VAE encoder
+            kwargs.update(image=synthetic_image(width, height), strength=1)
+        if self.graph_cache is None:
+            return self.inference(**kwargs)
+        with self.graph_cache.pinned():
+            return self.inference(**kwargs)
 
     @block_thread
-    def inference(self, **kwargs):
-        if kwargs.get('seed', -1) == -1:
-            kwargs['seed'] = random.randint(0, 2 ** 32 - 1)
-        kwargs['generator'] = torch.Generator("cuda").manual_seed(kwargs['seed'])
-        output_images = self.model(**kwargs).images
-        return output_images
+    def inference(self, timings=None, stage="denoise", output_type="pt", **kwargs):
+        """
+        Run the pipeline on the GPU.
+
+        With output_type="latent" the latents are returned as-is (e.g. to hand them to
+        the refiner); with "pt" they are VAE-decoded and copied to the CPU so that PIL
+        conversion and encoding can happen outside of the GPU lock (see to_pil).
+        Stage durations in seconds are added to `timings` when given.
+        """
+        timings = timings if timings is not None else Timings()
+        # A list of seeds (one per prompt) runs a batch with one generator per image
+        seed = kwargs.get('seed', -1)
+        seeds = seed if isinstance(seed, list) else [seed]
+        seeds = [random.randint(0, 2 ** 32 - 1) if s == -1 else s for s in seeds]
+        generators = [torch.Generator("cuda").manual_seed(s) for s in seeds]
+        kwargs['seed'] = seeds if isinstance(seed, list) else seeds[0]
+        kwargs['generator'] = generators if isinstance(seed, list) else generators[0]
+        with torch.cuda.stream(self.stream):
+            # Inputs (weights, latents from the other stage) may come from another stream
+            self.stream.wait_stream(torch.cuda.default_stream())
+            if self.embedding_cache is not None and 'prompt' in kwargs:
+                with timings.stage("text_encode"):
+                    kwargs.update(self.encode_prompts(kwargs.pop('prompt')))
+
+            with timings.stage(stage):
+                latents = self.model(output_type="latent", **kwargs).images
+                self.stream.synchronize()
+            if output_type == "latent":
+                return latents
+
+            with timings.stage("vae_decode"):
+                return self.decode_latents(latents)
+
+    def vae_encoding(self, prepare_latents):
+        """
+        Run the prepare_latents step of an image2image pipeline under the VAE lock.
+
+        That step VAE-encodes pixel inputs with a VAE that may be shared with the other
+        stage and is upcast in place. Only the encode holds the lock, never the denoising
+        loop: a UNet call may wait for a CUDA graph capture, which waits for the other
+        stage, which may be waiting for the lock to decode. Latents (4 channels, from the
+        base stage) skip the VAE, so the refiner stage does not wait for decodes.
+        """
+        def wrapper(image, *args, **kwargs):
+            if torch.is_tensor(image) and image.ndim == 4 and image.shape[1] == 4:
+                return prepare_latents(image, *args, **kwargs)
+            with self.vae_lock:
+                return prepare_latents(image, *args, **kwargs)
+
+        return wrapper
+
+    @property
+    def encoder_key(self):
+        # The refiner has no text_encoder, so its key never matches the base pipeline's
+        return (id(getattr(self.model, 'text_encoder', None)), id(getattr(self.model, 'text_encoder_2', None)))
+
+    @torch.no_grad()
+    def encode_prompt(self, prompt):
+        prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = self.model.encode_prompt(
+            prompt=prompt, device="cuda", num_images_per_prompt=1, do_classifier_free_guidance=True)
+        return {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": negative_prompt_embeds,
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": negative_pooled_prompt_embeds,
+        }
+
+    def encode_prompts(self, prompts):
+        """
+        Return the pipeline embedding arguments for one prompt or a list of prompts, using the cache.
+        """
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        embeds = [self.embedding_cache.get_or_encode(self.encoder_key, prompt, lambda: self.encode_prompt(prompt)) for prompt in prompts]
+        return {name: torch.cat([e[name] for e in embeds]) for name in embeds[0]}
+
+    @torch.no_grad()
+    def decode_latents(self, latents):
+        # The VAE may be shared with the other stage, and decoding may upcast it in place
+        with self.vae_lock:
+            return self._decode_latents(latents)
+
+    def _decode_latents(self, latents):
+        # Mirrors the tail of the SDXL pipelines, minus the PIL conversion
+        vae = self.model.vae
+        needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+        if needs_upcasting:
+            self.model.upcast_vae()
+            latents = latents.to(next(iter(vae.post_quant_conv.parameters())).dtype)
+        images = vae.decode(latents / vae.config.scaling_factor, return_dict=False)[0]
+        if needs_upcasting:
+            vae.to(dtype=torch.float16)
+        if getattr(self.model, 'watermark', None) is not None:
+            images = self.model.watermark.apply_watermark(images)
+        return images.float().cpu()
+
+    def to_pil(self, images):
+        return self.model.image_processor.postprocess(images, output_type="pil")
 
 # FastAPI initialization
 api = FastAPI()
@@ -111,11 +228,40 @@ parser.add_argument('--model_type', type=str, default='t2i')
 parser.add_argument('--worker_id', type=int, default=0)
 parser.add_argument('--host', type=str, default="127.0.0.1")
 parser.add_argument('--port', type=int, default=6000)
+parser.add_argument('--batch_window_ms', type=float, default=0, help='How long to wait for compatible text2image requests to batch together')
+parser.add_argument('--max_batch_size', type=int, default=1, help='Maximum number of text2image requests per pipeline call (1 disables batching)')
+parser.add_argument('--share_components', default=True, action=argparse.BooleanOptionalAction, help='Share the VAE and text encoder between the base and refiner pipelines when identical')
+parser.add_argument('--refiner_queue_size', type=int, default=4, help='Maximum number of base results waiting for the refiner stage')
+parser.add_argument('--encode_workers', type=int, default=4, help='Threads used for PIL conversion and image encoding')
+parser.add_argument('--embedding_cache_size', type=int, default=256, help='Maximum number of cached prompt embeddings (0 disables the cache)')
+parser.add_argument('--embedding_cache_mb', type=int, default=256, help='GPU memory budget of the prompt embedding cache in MB')
+parser.add_argument('--resolution_buckets', type=str, default='1024x1024', help='Comma separated WIDTHxHEIGHT resolutions whose CUDA graphs are captured at startup')
+parser.add_argument('--bucket_mode', type=str, default='off', choices=['snap', 'pad', 'off'], help='Map other resolutions to a bucket: snap (resize the output), pad (crop the output) or off')
+parser.add_argument('--warm_up_steps', type=int, default=2, help='Inference steps of the warm-up generation of each resolution bucket')
+parser.add_argument('--graph_cache_mb', type=int, default=4096, help='GPU memory budget of captured CUDA graphs in MB (0 leaves graph capture to stable-fast)')
 args = parser.parse_args()
 
+# Prompt embeddings cache of the base and refiner pipelines (one memory budget, separate entries)
+embedding_cache = PromptEmbeddingCache(max_entries=args.embedding_cache_size, max_bytes=args.embedding_cache_mb * 1024 ** 2) if args.embedding_cache_size > 0 else None
+
+# CUDA graphs of the base and refiner UNets, one per resolution bucket
+buckets = parse_buckets(args.resolution_buckets)
+stage_timings = StageTimings()
+graph_cache = GraphCache(budget_bytes=args.graph_cache_mb * 1024 ** 2) if args.graph_cache_mb > 0 else None
+
+# CPU pool for post-processing, so the GPU lock is released as soon as the VAE has decoded
+encode_pool = ThreadPoolExecutor(max_workers=args.encode_workers, thread_name_prefix="encode")
+
 # Global variable to store the SDFastAPI instance
-sd_fast_api = SDFastAPI(model_name=args.model_name, pipeline=args.model_type, worker_id=args.worker_id) if is_running_under_uvicorn() else None
-sd_fast_api_refiner = SDFastAPI(model_name=args.model_refiner, pipeline="i2i", worker_id=args.worker_id) if is_running_under_uvicorn() and args.model_refiner else None
+sd_fast_api = SDFastAPI(model_name=args.model_name, pipeline=args.model_type, worker_id=args.worker_id, embedding_cache=embedding_cache, graph_cache=graph_cache) if is_running_under_uvicorn() else None
+sd_fast_api_refiner = SDFastAPI(model_name=args.model_refiner, pipeline="i2i", worker_id=args.worker_id, embedding_cache=embedding_cache, share_from=sd_fast_api if args.share_components else None, graph_cache=graph_cache) if is_running_under_uvicorn() and args.model_refiner else None
+if sd_fast_api:
+    pipelines = [p for p in (sd_fast_api, sd_fast_api_refiner) if p]
+    logging.info(f"Diffusion pipelines loaded in {sum(p.load_time for p in pipelines):.1f}s, {sum(p.resident_memory for p in pipelines) / 1024 ** 2:.0f} MB resident (share_components={args.share_components})")
+
+# Warm-up runs in the background: /ping answers as soon as the pipelines are loaded and
+# /ready reports which resolution buckets are warm
+warm_up = WarmUp({role: p for role, p in (("base", sd_fast_api), ("refiner", sd_fast_api_refiner)) if p}, buckets, steps=args.warm_up_steps).start() if sd_fast_api else None
 
 # Pydantic models for API requests
 class TextToImage(BaseModel):
@@ -126,6 +272,8 @@ class TextToImage(BaseModel):
     seed: int = -1 
     batch_size: int = 1
     refiner: bool = False
+    format: Literal["jpeg", "png", "webp"] = "jpeg"
+    quality: int = Field(75, ge=1, le=100)
 
 class ImageToImage(BaseModel):
     image: str  # base64
@@ -135,14 +283,126 @@ class ImageToImage(BaseModel):
     strength: int = 1
     seed: int = -1 
     batch_size: int = 1
+    format: Literal["jpeg", "png", "webp"] = "jpeg"
+    quality: int = Field(75, ge=1, le=100)
+
+def batch_key(request: TextToImage):
+    return (request.height, request.width, request.num_inference_steps, request.refiner)
+
+def generate_images(requests):
+    """
+    Base stage: run compatible text2image requests as one pipeline call.
+
+    Requests without refiner get (decoded images, stage timings) each. For refiner
+    requests the base latents are handed to the refiner stage directly, which skips a
+    VAE decode/encode round trip, and the base stage moves on to the next batch
+    while the refiner works; those requests get the refiner stage future instead.
+    """
+    first = requests[0]
+    prompts = [r.prompt for r in requests]
+    seeds = [r.seed for r in requests]
+    timings = Timings()
+    if len(requests) > 1:
+        logging.debug(f"📦  [cuda/{sd_fast_api.worker_id}] batching {len(requests)} text2image requests")
+    refine = first.refiner and sd_fast_api_refiner
+    output_images = sd_fast_api.inference(timings=timings,
+                                          output_type="latent" if refine else "pt",
+                                          prompt=prompts,
+                                          height=first.height,
+                                          width=first.width,
+                                          num_inference_steps=first.num_inference_steps,
+                                          seed=seeds)
+    if refine:
+        return [refiner_stage.submit(batch_key(r), (r, output_images[i:i + 1], timings.copy())) for i, r in enumerate(requests)]
+    return [(output_images[i:i + 1], timings.copy()) for i in range(len(requests))]
+
+def refine_images(jobs):
+    """
+    Refiner stage: refine base latents of compatible requests as one pipeline call.
+    """
+    first = jobs[0][0]
+    timings = Timings()
+    logging.debug(f"✨  [cuda/{sd_fast_api.worker_id}] applying refiner ({len(jobs)} images)")
+    output_images = sd_fast_api_refiner.inference(timings=timings,
+                                                  stage="refine",
+                                                  image=torch.cat([latents for _, latents, _ in jobs]),
+                                                  prompt=[r.prompt for r, _, _ in jobs],
+                                                  height=first.height,
+                                                  width=first.width,
+                                                  seed=[r.seed for r, _, _ in jobs])
+    return [(output_images[i:i + 1], base_timings.merge(timings)) for i, (_, _, base_timings) in enumerate(jobs)]
+
+def postprocess(pipeline, images, format, quality, timings, size=None):
+    """
+    Convert decoded images to PIL and encode them in the CPU pool.
+
+    :param size: Requested (width, height) when the images were rendered at a resolution bucket.
+    """
+    def encode(i):
+        image = pipeline.to_pil(images[i:i + 1])[0]
+        if size:
+            image = fit_to_size(image, *size, args.bucket_mode)
+        return encode_image(image, format, quality)
+
+    with timings.stage("encode"):
+        return list(encode_pool.map(encode, range(len(images))))
+
+# Base and refiner run as two stages connected by a bounded queue, so the base pass of
+# the next request overlaps the refiner pass of the previous one
+text_to_image_stage = BatchQueue(generate_images, window=args.batch_window_ms / 1000 if args.max_batch_size > 1 else 0, max_batch_size=args.max_batch_size, name="text2image") if sd_fast_api else None
+refiner_stage = BatchQueue(refine_images, max_batch_size=args.max_batch_size, name="refiner", maxsize=args.refiner_queue_size) if sd_fast_api_refiner else None
+
+def image_response(encoded_images, processing_time, accept, timings=None, headers=None):
+    """
+    Return encoded images as raw bytes when the Accept header asks for it, base64 JSON otherwise.
+
+    A single image is sent as-is; several images (or an explicit multipart/mixed
+    Accept) are sent as a multipart/mixed body with one part per image.
+    """
+    timings = timings or {}
+    headers = dict(headers or {})
+    if accepts_binary(accept):
+        headers["X-Processing-Time"] = f"{processing_time:.3f}"
+        if timings:
+            headers["Server-Timing"] = ", ".join(f"{stage};dur={duration * 1000:.1f}" for stage, duration in timings.items())
+        if len(encoded_images) == 1 and not accepts_multipart(accept):
+            data, media_type = encoded_images[0]
+            return Response(content=data, media_type=media_type, headers=headers)
+        body, content_type = multipart_body(encoded_images)
+        return Response(content=body, media_type=content_type, headers=headers)
+    return JSONResponse(content={"images": [encode_base64(data) for data, _ in encoded_images], "processing_time": processing_time, "timings": timings}, headers=headers)
+
+def skipped(endpoint, stages=GPU_STAGES):
+    """
+    Callback recording a request of `endpoint` dropped before `stages` ran.
+    """
+    def on_skip(reason):
+        seconds = stage_timings.skip(endpoint, reason, stages)
+        logging.debug(f"⏭️  [cuda/{sd_fast_api.worker_id}] {endpoint} skipped ({reason}), ~{round(seconds, 2)}s of GPU time saved")
+    return on_skip
 
 # API endpoints
 @api.get("/ping")
 def ping():
     return {"message": "Hello world!"}
 
+@api.get("/ready")
+def ready():
+    return warm_up.report()
+
+@api.get("/stats")
+def stats():
+    return {
+        "prompt_embeddings": embedding_cache.stats() if embedding_cache else None,
+        "cuda_graphs": graph_cache.stats() if graph_cache else None,
+        "timings": stage_timings.snapshot(),
+    }
+
 @api.post("/text_to_image")
-def text_to_image(request: TextToImage):
+async def text_to_image(request: TextToImage, raw_request: Request, accept: Optional[str] = Header(None), traceparent: Optional[str] = Header(None), x_deadline: Optional[float] = Header(None)):
+    return await serve(raw_request, x_deadline, run_text_to_image, request, accept, traceparent)
+
+def run_text_to_image(request: TextToImage, accept, traceparent, caller):
     start_time = time.time()
 
     logging.debug(f"➡️  [cuda/{sd_fast_api.worker_id}] text2image incoming")
@@ -153,53 +413,64 @@ def text_to_image(request: TextToImage):
         logging.error('GPU requirements too high')
         return {"error": "Image dimensions or batch size too large for GPU"}
 
-    output_images = sd_fast_api.inference(prompt=request.prompt,
-                                          height=request.height,
-                                          width=request.width,
-                                          num_inference_steps=request.num_inference_steps,
-                                          seed=request.seed,
-                                          batch_size=request.batch_size)
-
-    base64_images = []
-    for img in output_images:
-        if request.refiner and sd_fast_api_refiner:
-            logging.debug(f"✨  [cuda/{sd_fast_api.worker_id}] applying refiner")
-            img = sd_fast_api_refiner.inference(image=img,
-                                                prompt=request.prompt,
-                                                height=request.height,
-                                                width=request.width,
-                                                seed=request.seed,
-                                                batch_size=request.batch_size)[0]
-
-        base64_str = image_to_base64(img)
-        base64_images.append(base64_str)
+    # Render at the resolution bucket, so the request replays a captured graph
+    size = (request.width, request.height)
+    bucket = select_bucket(request.width, request.height, buckets, args.bucket_mode)
+    if bucket:
+        request.width, request.height = bucket
+
+    # Queued jobs are cancelled if the daemon disconnects or the deadline passes first
+    result = wait_for_job(text_to_image_stage.submit(batch_key(request), request), caller, skipped("text_to_image"))
+    if isinstance(result, Future):
+        result = wait_for_job(result, caller, skipped("text_to_image", stages=("refine", "vae_decode")))
+    output_images, timings = result
+
+    encoded_images = postprocess(sd_fast_api, output_images, request.format, request.quality, timings, size if bucket else None)
 
     end_time = time.time()
     processing_time = end_time - start_time
-    logging.debug(f"⬅️  [cuda/{sd_fast_api.worker_id}] text2image, processing time={round(processing_time, 2)}s,size={request.width}x{request.height}")
+    stages = " ".join(f"{stage}={round(duration, 2)}s" for stage, duration in timings.items())
+    stage_timings.record("text_to_image", timings, processing_time, len(encoded_images))
+    logging.debug(f"⬅️  [cuda/{sd_fast_api.worker_id}] text2image, processing time={round(processing_time, 2)}s,size={size[0]}x{size[1]}{f' (bucket {bucket[0]}x{bucket[1]})' if bucket else ''} ({stages})")
 
-    return {"images": base64_images, "processing_time": processing_time}
+    return image_response(encoded_images, processing_time, accept, timings, trace_header(traceparent, "text2image", start_time, timings))
 
 
 @api.post("/image_to_image")
-def image_to_image(request: ImageToImage):
+async def image_to_image(request: ImageToImage, raw_request: Request, accept: Optional[str] = Header(None), traceparent: Optional[str] = Header(None), x_deadline: Optional[float] = Header(None)):
+    return await serve(raw_request, x_deadline, run_image_to_image, request, accept, traceparent)
+
+def run_image_to_image(request: ImageToImage, accept, traceparent, caller):
     start_time = time.time()
     logging.debug(f"[-->] (Image2Image) [{sd_fast_api.model_name}] Request for Image Generation")
     pipeline = sd_fast_api
     if sd_fast_api.pipeline == "t2i":
         pipeline = sd_fast_api_refiner
-    output_images = pipeline.inference(image=base64_to_image(request.image),
-                                          prompt=request.prompt, 
-                                          height=request.height, 
-                                          width=request.width, 
-                                          strength=request.strength,
-                                          seed=request.seed, 
-                                          batch_size=request.batch_size)
-    base64_images = [image_to_base64(img) for img in output_images]
+    timings = Timings()
+    image = base64_to_image(request.image)
+    width, height = select_bucket(request.width, request.height, buckets, args.bucket_mode) or (request.width, request.height)
+    if (width, height) != (request.width, request.height):
+        image = image.convert("RGB").resize((width, height))
+    try:
+        output_images = pipeline.inference(timings=timings,
+                                           caller=caller,
+                                           image=image,
+                                           prompt=request.prompt,
+                                           height=height,
+                                           width=width,
+                                           strength=request.strength,
+                                           seed=request.seed,
+                                           batch_size=request.batch_size)
+    except RequestAbandoned as e:
+        skipped("image_to_image")(e.reason)
+        raise
+    size = (request.width, request.height) if (width, height) != (request.width, request.height) else None
+    encoded_images = postprocess(pipeline, output_images, request.format, request.quality, timings, size)
     end_time = time.time()
     processing_time = end_time - start_time
+    stage_timings.record("image_to_image", timings, processing_time, len(encoded_images))
     logging.debug(f"[<--] (Image2Image) Processing Time: {round(processing_time, 2)} seconds")
-    return {"images": base64_images}
+    return image_response(encoded_images, processing_time, accept, timings, trace_header(traceparent, "image2image", start_time, timings))
 
 # Main entry point
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the stage duration buckets in seconds
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Stages holding the GPU lock
+GPU_STAGES = ("text_encode", "denoise", "refine", "vae_decode")
+
+
+class Timings(dict):
+    """
+    Stage durations of a request in seconds, with the wall clock span of every stage
+    so that traced requests can report them to the daemon (see `trace_header`).
+    """
+
+    def __init__(self, *args, spans=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spans = list(spans or [])
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self[name] = self.get(name, 0) + duration
+            self.spans.append((name, start, duration))
+
+    def copy(self):
+        return Timings(self, spans=self.spans)
+
+    def merge(self, other):
+        """
+        Timings of a request that went through this stage and then `other` (e.g. base then refiner).
+        """
+        return Timings({**self, **other}, spans=self.spans + other.spans)
+
+
+def is_sampled(traceparent):
+    # W3C trace context: the last field holds the flags, bit 0 is "sampled"
+    parts = (traceparent or "").split("-")
+    try:
+        return len(parts) == 4 and bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return False
+
+
+def trace_header(traceparent, name, start, timings):
+    """
+    X-Trace-Spans header reporting the spans of a request to the daemon, only when its trace is sampled.
+
+    :param start: Wall clock time at which the request was received.
+    """
+    if not is_sampled(traceparent):
+        return {}
+    spans = [(name, start, time.time() - start)] + timings.spans
+    return {"X-Trace-Spans": json.dumps([[n, round(s, 6), round(d, 6)] for n, s, d in spans], separators=(",", ":"))}
+
+
+class StageTimings:
+    """
+    Histograms of the pipeline stage durations of this worker, the number of images
+    generated, and the requests skipped because their caller went away.
+
+    The daemon scrapes `snapshot` through /stats and exposes it with its own metrics.
+    Counts are cumulative since the worker started.
+    """
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.histograms = {}
+        self.images = {}
+        self.skipped = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, stage, seconds):
+        histogram = self.histograms.get((endpoint, stage))
+        if histogram is None:
+            histogram = self.histograms[(endpoint, stage)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def record(self, endpoint, timings, total, images):
+        """
+        Record a finished request.
+
+        :param timings: Duration of each stage in seconds.
+        :param total: Processing time of the whole request in seconds.
+        :param images: Number of images returned.
+        """
+        with self._lock:
+            for stage, seconds in timings.items():
+                self.observe(endpoint, stage, seconds)
+            self.observe(endpoint, "total", total)
+            self.images[endpoint] = self.images.get(endpoint, 0) + images
+
+    def skip(self, endpoint, reason, stages=GPU_STAGES):
+        """
+        Record a request dropped before it ran, because its client disconnected or its deadline passed.
+
+        :param stages: Stages that did not run, whose mean durations estimate the GPU time saved.
+        :return: Estimated GPU seconds saved.
+        """
+        with self._lock:
+            seconds = 0.0
+            for stage in stages:
+                histogram = self.histograms.get((endpoint, stage))
+                if histogram and histogram[2]:
+                    seconds += histogram[1] / histogram[2]
+            entry = self.skipped.setdefault(endpoint, {}).setdefault(reason, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        return seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "bounds": list(self.buckets),
+                "stages": [{"endpoint": endpoint, "stage": stage, "counts": list(counts), "sum": total, "count": count}
+                           for (endpoint, stage), (counts, total, count) in self.histograms.items()],
+                "images": dict(self.images),
+                # [count, estimated GPU seconds saved] by endpoint and reason
+                "skipped": {endpoint: {reason: list(entry) for reason, entry in reasons.items()} for endpoint, reasons in self.skipped.items()},
+            }
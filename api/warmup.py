@@ -0,0 +1,76 @@
+import threading
+import time
+from PIL import Image
+from loguru import logger as logging
+
+
+def synthetic_image(width, height):
+    """
+    Deterministic RGB gradient used as warm-up init image, so warm-up needs no network or input file.
+    """
+    gradient = Image.linear_gradient("L")
+    return Image.merge("RGB", (
+        gradient.resize((width, height)),
+        gradient.transpose(Image.Transpose.ROTATE_90).resize((width, height)),
+        Image.new("L", (width, height), 128),
+    ))
+
+
+class WarmUp:
+    """
+    Warms up the pipelines of a worker for each resolution bucket in a background thread.
+
+    Buckets are warmed in order, every pipeline of a bucket before the next bucket, so
+    the first (most common) bucket becomes servable as early as possible while the
+    worker already answers requests. Warm-up generations go through the same pipeline
+    locks as traffic, and their CUDA graph captures wait for exclusive use of the GPU
+    (see graphs.CaptureGate), so live requests pause during a capture rather than
+    invalidate it. Readiness is tracked per bucket and pipeline.
+    """
+
+    def __init__(self, pipelines, buckets, steps: int = 2):
+        """
+        :param pipelines: Dict of pipeline role (e.g. 'base', 'refiner') to SDFastAPI.
+        :param buckets: List of (width, height) resolutions to warm up.
+        :param steps: Number of inference steps of each warm-up generation.
+        """
+        self.pipelines = pipelines
+        self.buckets = buckets
+        self.steps = steps
+        self.state = {bucket: {role: "pending" for role in pipelines} for bucket in buckets}
+        self.started_at = None
+        self.elapsed = None
+        self.done = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        for bucket in self.buckets:
+            for role, pipeline in self.pipelines.items():
+                self.state[bucket][role] = "warming"
+                start = time.perf_counter()
+                try:
+                    pipeline.warm_up(*bucket, steps=self.steps)
+                    self.state[bucket][role] = "ready"
+                    logging.info(f"🔥  {role} warm for {bucket[0]}x{bucket[1]} in {time.perf_counter() - start:.1f}s")
+                except Exception as e:
+                    self.state[bucket][role] = "failed"
+                    logging.error(f"Warm-up of {role} for {bucket[0]}x{bucket[1]} failed: {e}")
+        self.elapsed = time.perf_counter() - self.started_at
+        self.done.set()
+        logging.info(f"Warm-up finished in {self.elapsed:.1f}s")
+
+    def is_ready(self, width, height):
+        states = self.state.get((width, height))
+        return states is not None and all(state == "ready" for state in states.values())
+
+    def report(self):
+        return {
+            "ready": self.done.is_set() and all(self.is_ready(*bucket) for bucket in self.buckets),
+            "elapsed": round(self.elapsed if self.elapsed is not None else time.perf_counter() - self.started_at, 1) if self.started_at else None,
+            "buckets": {f"{w}x{h}": {"ready": self.is_ready(w, h), "pipelines": dict(self.state[(w, h)])} for w, h in self.buckets},
+        }
@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of per-token parsing overhead for upstream token streams.
+
+Compares the FrameDecoder against the previous `iter_content(chunk_size=1024)` +
+`str.replace("data:", "")` + `is_valid_json` + `json.loads` loop on a synthetic
+lmdeploy SSE stream, and reports how many tokens each approach recovered.
+
+Usage: python -m benchmarks.frame_decoder [--tokens 20000] [--chunk_size 1024]
+"""
+import argparse
+import json
+import time
+from utils.stream import FrameDecoder
+
+
+def build_stream(n_tokens):
+    frames = []
+    for i in range(n_tokens):
+        frame = {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+                 "choices": [{"index": 0, "delta": {"content": f" token{i}"}, "finish_reason": None}]}
+        frames.append(f"data: {json.dumps(frame)}\n\n")
+    frames.append("data: [DONE]\n\n")
+    return "".join(frames).encode()
+
+
+def chunked(payload, chunk_size):
+    return [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+
+
+def frame_aligned(payload):
+    return [frame + b"\n\n" for frame in payload.split(b"\n\n") if frame]
+
+
+def is_valid_json(json_str):
+    try:
+        json.loads(json_str)
+        return True
+    except json.JSONDecodeError:
+        return False
+
+
+def legacy(chunks):
+    tokens = 0
+    for chunk in chunks:
+        chunk = chunk.decode().replace("data:", "")
+        if is_valid_json(chunk):
+            chunk_data = json.loads(chunk)
+            if 'choices' in chunk_data and 'content' in chunk_data['choices'][0]["delta"]:
+                tokens += 1
+    return tokens
+
+
+def frame_decoder(chunks):
+    tokens = 0
+    decoder = FrameDecoder()
+    for chunk in chunks + [None]:
+        for frame in (decoder.feed(chunk) if chunk is not None else decoder.flush()):
+            if 'content' in frame['choices'][0]["delta"]:
+                tokens += 1
+    return tokens
+
+
+def run(name, fn, chunks, n_tokens, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        recovered = fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<14} {best / n_tokens * 1e6:8.2f} us/token   {recovered}/{n_tokens} tokens recovered")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark upstream token stream parsing")
+    parser.add_argument('--tokens', type=int, default=20000)
+    parser.add_argument('--chunk_size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_stream(args.tokens)
+    for label, chunks in ((f"{args.chunk_size}-byte chunks", chunked(payload, args.chunk_size)), ("one frame per chunk", frame_aligned(payload))):
+        print(label)
+        run("legacy", legacy, chunks, args.tokens, args.repeat)
+        run("frame_decoder", frame_decoder, chunks, args.tokens, args.repeat)
@@ -0,0 +1,48 @@
+"""
+Throughput benchmark of text2image request batching against a fake pipeline.
+
+The fake pipeline sleeps for a fixed per-call overhead plus a per-image cost,
+which is the shape that makes batching pay off on a GPU. Concurrent clients
+submit requests through the same BatchQueue that api/sdfast.py uses.
+
+Usage: python -m benchmarks.sdfast_batching [--requests 64] [--clients 8]
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from api.batching import BatchQueue
+
+
+class FakePipeline:
+    def __init__(self, call_overhead, per_image):
+        self.call_overhead = call_overhead
+        self.per_image = per_image
+
+    def __call__(self, requests):
+        time.sleep(self.call_overhead + self.per_image * len(requests))
+        return [[f"image-{r}"] for r in requests]
+
+
+def measure(pipeline, n_requests, clients, window, max_batch_size):
+    batcher = BatchQueue(pipeline, window=window, max_batch_size=max_batch_size, name=f"bench-{max_batch_size}")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda r: batcher.submit((1024, 1024, 30, False), r).result(), range(n_requests)))
+    elapsed = time.perf_counter() - start
+    assert results == [[f"image-{r}"] for r in range(n_requests)]
+    print(f"max_batch_size={max_batch_size:<3} window={window * 1000:5.1f}ms  "
+          f"{n_requests / elapsed:6.2f} images/s  avg batch={batcher.jobs / batcher.batches:4.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark text2image batching throughput")
+    parser.add_argument('--requests', type=int, default=64)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--call_overhead_ms', type=float, default=150)
+    parser.add_argument('--per_image_ms', type=float, default=50)
+    parser.add_argument('--window_ms', type=float, default=20)
+    args = parser.parse_args()
+
+    pipeline = FakePipeline(args.call_overhead_ms / 1000, args.per_image_ms / 1000)
+    for max_batch_size in (1, 2, 4, 8):
+        measure(pipeline, args.requests, args.clients, args.window_ms / 1000 if max_batch_size > 1 else 0, max_batch_size)
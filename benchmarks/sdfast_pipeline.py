@@ -0,0 +1,70 @@
+"""
+Throughput benchmark of base/refiner execution under refiner-heavy load.
+
+Compares the previous behaviour, where the base and refiner passes of a request
+ran one after the other behind a single lock, with the two-stage pipeline of
+api/sdfast.py, where the base stage hands its latents to the refiner stage over
+a bounded queue. Both passes are simulated with sleeps.
+
+Usage: python -m benchmarks.sdfast_pipeline [--requests 32] [--base_ms 400] [--refiner_ms 150]
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from api.batching import BatchQueue
+
+
+def sequential(n_requests, clients, base, refiner):
+    lock = threading.Lock()
+
+    def request(_):
+        with lock:
+            time.sleep(base)
+        with lock:
+            time.sleep(refiner)
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(request, range(n_requests)))
+
+
+def staged(n_requests, clients, base, refiner, queue_size):
+    def run_refiner(jobs):
+        time.sleep(refiner)
+        return jobs
+
+    refiner_stage = BatchQueue(run_refiner, name="bench-refiner", maxsize=queue_size)
+
+    def run_base(requests):
+        time.sleep(base)
+        return [refiner_stage.submit(None, r) for r in requests]
+
+    base_stage = BatchQueue(run_base, name="bench-base")
+
+    def request(r):
+        result = base_stage.submit(None, r).result()
+        return result.result() if isinstance(result, Future) else result
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(request, range(n_requests)))
+
+
+def measure(name, fn, n_requests):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<12} {n_requests / elapsed:6.2f} images/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark base/refiner pipelining")
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--base_ms', type=float, default=400)
+    parser.add_argument('--refiner_ms', type=float, default=150)
+    parser.add_argument('--refiner_queue_size', type=int, default=4)
+    args = parser.parse_args()
+
+    base, refiner = args.base_ms / 1000, args.refiner_ms / 1000
+    measure("sequential", lambda: sequential(args.requests, args.clients, base, refiner), args.requests)
+    measure("staged", lambda: staged(args.requests, args.clients, base, refiner, args.refiner_queue_size), args.requests)
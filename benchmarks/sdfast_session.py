@@ -0,0 +1,88 @@
+"""
+Benchmark of per-request latency from the daemon to an SDFast worker.
+
+Starts a stand-in worker that answers `/text_to_image` immediately, then compares
+a fresh `aiohttp.ClientSession` per request (the previous behaviour) with the
+long-lived pooled session owned by `SDFast`.
+
+Usage: python -m benchmarks.sdfast_session [--requests 2000] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from types import SimpleNamespace
+import aiohttp
+from aiohttp import web
+from utils.sdfast import SDFast
+from utils.health import HealthSupervisor
+from utils.metrics import MetricsRegistry
+from utils.tracing import Tracer
+
+PAYLOAD = {"prompt": "Petals", "height": 1024, "width": 1024, "num_inference_steps": 30, "seed": 1, "batch_size": 1, "refiner": False}
+
+
+class StandInSDFast(SDFast):
+    def run_subprocess(self):
+        pass
+
+
+async def text_to_image(request):
+    await request.json()
+    return web.json_response({"images": ["x" * 1024], "processing_time": 0.0})
+
+
+async def start_worker(host, port):
+    app = web.Application()
+    app.router.add_post("/text_to_image", text_to_image)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def fresh_session_request(host, port):
+    async with aiohttp.ClientSession() as session:
+        async with session.post(f"http://{host}:{port}/text_to_image", json=PAYLOAD) as response:
+            return await response.json()
+
+
+async def measure(name, request, n_requests, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            start = time.perf_counter()
+            await request()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[timed() for _ in range(n_requests)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"{name:<16} p50={p50:6.2f}ms  p99={p99:6.2f}ms  {n_requests / elapsed:8.1f} req/s")
+
+
+async def main(args):
+    runner = await start_worker(args.host, args.port)
+    # Not started: the worker is never registered, so request outcomes are ignored
+    instance = SimpleNamespace(models={}, base_directory="", health=HealthSupervisor(), metrics=MetricsRegistry(), tracer=Tracer())
+    worker = StandInSDFast(instance, model_name="bench", host=args.host, port=args.port, max_connections=args.concurrency)
+    try:
+        await measure("fresh session", lambda: fresh_session_request(args.host, args.port), args.requests, args.concurrency)
+        await measure("pooled session", lambda: worker.make_request("/text_to_image", PAYLOAD), args.requests, args.concurrency)
+    finally:
+        await worker.close_session()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark daemon to SDFast worker request latency")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=6999)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    asyncio.run(main(parser.parse_args()))
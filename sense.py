@@ -18,12 +18,44 @@ def main():
     import json
     import time
     from utils.fastapi import DaemonAPI
+    from utils.cache import ResultCache, CompletionCache
+    from utils.admission import AdmissionController
     parser = argparse.ArgumentParser(description="Run the Daemon API with specified host and port")
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host for the API server')
     parser.add_argument('--port', type=int, default=8080, help='Port for the API server')
     parser.add_argument("--pulse", default=False, help="Activate Pulse Load Balancer")
     parser.add_argument("--prevent_oom", default=False, action=argparse.BooleanOptionalAction, help="Reduce cache for Turbomind (Only for validators)")
     parser.add_argument('--instance_num', type=int, default=8, help='Instance num for LMDeploy')
+    parser.add_argument('--download_workers', type=int, default=4, help='Maximum number of model files downloaded at the same time')
+    parser.add_argument("--offline", default=False, action=argparse.BooleanOptionalAction, help="Never contact the Hugging Face hub, only use complete local snapshots")
+    parser.add_argument('--workspace_cache_gb', type=float, default=200, help='Disk budget of converted TurboMind workspaces in GB')
+    parser.add_argument('--health_interval', type=float, default=10, help='Seconds between health probes of a healthy model backend')
+    parser.add_argument('--health_timeout', type=float, default=5, help='Timeout of a health probe in seconds')
+    parser.add_argument('--health_failure_threshold', type=int, default=3, help='Consecutive failed health probes before a backend is restarted')
+    parser.add_argument('--restart_budget', type=int, default=3, help='Maximum number of restarts of a backend per --restart_window')
+    parser.add_argument('--restart_window', type=float, default=600, help='Window of the restart budget in seconds')
+    parser.add_argument('--batch_window_ms', type=float, default=0, help='Diffusion workers wait this long to batch compatible text2image requests')
+    parser.add_argument('--max_batch_size', type=int, default=1, help='Maximum number of text2image requests per diffusion pipeline call (1 disables batching)')
+    parser.add_argument('--resolution_buckets', type=str, default='1024x1024', help='Resolutions whose CUDA graphs diffusion workers capture at startup (comma separated WIDTHxHEIGHT)')
+    parser.add_argument('--bucket_mode', type=str, default='off', choices=['snap', 'pad', 'off'], help='Map other resolutions to a bucket: snap (resize the output), pad (crop the output) or off')
+    parser.add_argument('--graph_cache_mb', type=int, default=4096, help='GPU memory budget of the CUDA graphs of each diffusion worker in MB (0 leaves capture to stable-fast)')
+    parser.add_argument('--queue_limit', type=int, default=64, help='Maximum number of requests queued per model before new ones get a 429')
+    parser.add_argument('--queue_timeout', type=float, default=30, help='Maximum time a request waits for a slot in seconds before it gets a 429')
+    parser.add_argument('--request_timeout', type=float, default=0, help='Default deadline of a generation request in seconds, overridden by its X-Request-Timeout header (0 for none)')
+    parser.add_argument('--text_concurrency', type=int, default=None, help='Concurrent requests per text model (defaults to --instance_num)')
+    parser.add_argument('--worker_concurrency', type=int, default=2, help='Concurrent requests per diffusion worker')
+    parser.add_argument('--telemetry_interval', type=float, default=2, help='Seconds between two samples of the GPU and system statistics')
+    parser.add_argument('--telemetry_history', type=int, default=300, help='Number of GPU and system statistics samples kept for /system_info/history')
+    parser.add_argument('--trace_file', type=str, default=f'{path}/logs/traces.json', help='File receiving sampled request traces in Chrome trace format (empty to disable tracing)')
+    parser.add_argument('--trace_sample_rate', type=float, default=0.01, help='Share of requests traced; requests with a sampled traceparent header are always traced')
+    parser.add_argument("--completion_cache", default=False, action=argparse.BooleanOptionalAction, help="Cache text generations of greedy or fixed-seed requests")
+    parser.add_argument('--completion_cache_mb', type=int, default=64, help='Memory budget of the completion cache in MB')
+    parser.add_argument('--completion_cache_ttl', type=float, default=3600, help='Lifetime of a cached completion in seconds')
+    parser.add_argument('--completion_replay_speed', type=float, default=0, help='Replay cached completions at this multiple of their original pace (0 replays at once)')
+    parser.add_argument("--result_cache", default=False, action=argparse.BooleanOptionalAction, help="Cache diffusion results of requests with an explicit seed")
+    parser.add_argument('--result_cache_mb', type=int, default=512, help='Memory budget of the diffusion result cache in MB')
+    parser.add_argument('--result_cache_dir', type=str, default=f'{path}/cache/results', help='Directory of the on-disk diffusion result cache (empty to disable)')
+    parser.add_argument('--result_cache_disk_mb', type=int, default=4096, help='Disk budget of the diffusion result cache in MB')
     args = parser.parse_args()
 
     logging.warning("Sense server must not be on the same server as the miner/validator.")
@@ -39,8 +71,25 @@ def main():
         logging.error(f"Error when loading the config.json file: {e}")
         return;
     system.display_system_info()
-    model = ModelManager(pulse=args.pulse, prevent_oom=args.prevent_oom, instance_num=args.instance_num)
-    api = DaemonAPI(model=model, api_tokens=config['api_tokens'])
+    sdfast_options = {
+        "batch_window_ms": args.batch_window_ms,
+        "max_batch_size": args.max_batch_size,
+        "resolution_buckets": args.resolution_buckets,
+        "bucket_mode": args.bucket_mode,
+        "graph_cache_mb": args.graph_cache_mb,
+    }
+    health_options = {
+        "interval": args.health_interval,
+        "timeout": args.health_timeout,
+        "failure_threshold": args.health_failure_threshold,
+        "restart_budget": args.restart_budget,
+        "restart_window": args.restart_window,
+    }
+    model = ModelManager(pulse=args.pulse, prevent_oom=args.prevent_oom, instance_num=args.instance_num, sdfast_options=sdfast_options, health_options=health_options, download_options={"max_workers": args.download_workers, "offline": args.offline}, workspace_cache_gb=args.workspace_cache_gb, tracing_options={"path": args.trace_file or None, "sample_rate": args.trace_sample_rate}, telemetry_options={"interval": args.telemetry_interval, "history": args.telemetry_history})
+    result_cache = ResultCache(max_bytes=args.result_cache_mb * 1024 ** 2, directory=args.result_cache_dir or None, max_disk_bytes=args.result_cache_disk_mb * 1024 ** 2) if args.result_cache else None
+    admission = AdmissionController(queue_limit=args.queue_limit, queue_timeout=args.queue_timeout, text_concurrency=args.text_concurrency, worker_concurrency=args.worker_concurrency)
+    completion_cache = CompletionCache(max_bytes=args.completion_cache_mb * 1024 ** 2, ttl=args.completion_cache_ttl, replay_speed=args.completion_replay_speed) if args.completion_cache else None
+    api = DaemonAPI(model=model, api_tokens=config['api_tokens'], result_cache=result_cache, admission=admission, completion_cache=completion_cache, request_timeout=args.request_timeout or None)
     api.run(host=args.host, port=args.port)
 if __name__ == "__main__":
     atexit.register(system.terminate_all_process)
@@ -0,0 +1,126 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from graphs import GraphCache  # noqa: E402
+
+TIMEOUT = 5
+
+
+class StubCompiler:
+    """
+    Stands in for sfast graph capture: a "graph" replays the wrapped callable, and the
+    capture records whether any pipeline call was running on the GPU meanwhile.
+    """
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.running = 0
+        self.captures = []
+        self.lock = threading.Lock()
+
+    def capture(self, fn, args, kwargs):
+        with self.lock:
+            self.captures.append(self.running)
+        time.sleep(self.delay)
+        return fn
+
+    @staticmethod
+    def key(args, kwargs):
+        return tuple(args)
+
+    @staticmethod
+    def memory():
+        return 0
+
+
+def make_cache(compiler):
+    return GraphCache(budget_bytes=1024 ** 3, capture=compiler.capture, key=compiler.key, memory=compiler.memory)
+
+
+def run_threads(*targets):
+    threads = [threading.Thread(target=target, daemon=True) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(TIMEOUT)
+    return [thread for thread in threads if thread.is_alive()]
+
+
+def test_hits_and_misses():
+    compiler = StubCompiler(delay=0)
+    cache = make_cache(compiler)
+    unet = cache.wrap("base/unet", lambda shape: shape)
+    assert [unet(64), unet(64), unet(128)] == [64, 64, 128]
+    assert (cache.hits, cache.misses, len(compiler.captures)) == (1, 2, 2)
+
+
+def test_capture_waits_for_running_pipeline_calls():
+    compiler = StubCompiler()
+    cache = make_cache(compiler)
+    unet = cache.wrap("base/unet", lambda shape: shape)
+    started = threading.Event()
+
+    def pipeline_call():
+        with cache.gate.shared():
+            compiler.running += 1
+            started.set()
+            time.sleep(0.2)
+            compiler.running -= 1
+
+    def capturing_call():
+        started.wait(TIMEOUT)
+        with cache.gate.shared():
+            unet(64)
+
+    assert run_threads(pipeline_call, capturing_call) == []
+    assert compiler.captures == [0]
+
+
+def test_refiner_capture_does_not_deadlock_base_decode():
+    # Lock order of SDFastAPI.inference: the pipeline call holds the gate shared, the
+    # image2image encode and the decode hold the VAE lock shared by both stages, and
+    # UNet calls may capture. The refiner encodes, then misses a graph while the base
+    # stage, still holding the gate, waits for the VAE lock to decode.
+    compiler = StubCompiler()
+    cache = make_cache(compiler)
+    vae_lock = threading.Lock()
+    unet = cache.wrap("refiner/unet", lambda shape: shape)
+    encoding = threading.Event()
+
+    def refiner():
+        with cache.gate.shared():
+            with vae_lock:
+                encoding.set()
+                time.sleep(0.1)
+            unet(64)
+
+    def base():
+        encoding.wait(TIMEOUT)
+        with cache.gate.shared():
+            with vae_lock:
+                pass
+
+    assert run_threads(refiner, base) == []
+    assert cache.misses == 1
+
+
+def test_concurrent_misses_in_both_stages():
+    compiler = StubCompiler()
+    cache = make_cache(compiler)
+    base_unet = cache.wrap("base/unet", lambda shape: shape)
+    refiner_unet = cache.wrap("refiner/unet", lambda shape: shape)
+    barrier = threading.Barrier(2)
+
+    def stage(unet):
+        def call():
+            with cache.gate.shared():
+                barrier.wait(TIMEOUT)
+                unet(64)
+        return call
+
+    assert run_threads(stage(base_unet), stage(refiner_unet)) == []
+    assert cache.misses == 2
@@ -0,0 +1,166 @@
+import asyncio
+import math
+import time
+from collections import deque
+from fastapi import HTTPException
+from utils.logging import logging
+
+
+class Ticket:
+    """
+    An admitted request; `release` must be called once it is done (it is idempotent).
+    """
+
+    def __init__(self, queue, queue_time):
+        self.queue = queue
+        self.queue_time = queue_time
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.queue.release(time.monotonic() - self.started_at)
+
+
+class ModelQueue:
+    """
+    Concurrency limit and bounded FIFO queue of one model.
+    """
+
+    def __init__(self, name, concurrency, queue_limit, alpha: float = 0.2):
+        self.name = name
+        self.concurrency = max(concurrency, 1)
+        self.queue_limit = queue_limit
+        self.alpha = alpha
+        self.active = 0
+        self.waiters = deque()
+        self.service_time = None
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queue_seconds = 0.0
+        self.max_queue_seconds = 0.0
+
+    def retry_after(self):
+        """
+        Seconds until a slot is likely to free up for a new request, from the observed service time.
+        """
+        service_time = self.service_time if self.service_time is not None else 1.0
+        return min(max(math.ceil(service_time * (len(self.waiters) + 1) / self.concurrency), 1), 120)
+
+    def release(self, service_time):
+        self.service_time = service_time if self.service_time is None else self.alpha * service_time + (1 - self.alpha) * self.service_time
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        while self.waiters and self.active < self.concurrency:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def snapshot(self):
+        return {
+            "concurrency": self.concurrency,
+            "queue_limit": self.queue_limit,
+            "active": self.active,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "service_time": round(self.service_time, 3) if self.service_time is not None else None,
+            "avg_queue_seconds": round(self.queue_seconds / self.admitted, 3) if self.admitted else 0.0,
+            "max_queue_seconds": round(self.max_queue_seconds, 3),
+            "retry_after": self.retry_after(),
+        }
+
+
+class AdmissionController:
+    """
+    Per-model admission control.
+
+    Each model admits up to `concurrency` requests at a time and queues up to
+    `queue_limit` more in arrival order. Beyond that, or after waiting
+    `queue_timeout` seconds, requests are rejected right away with a 429 whose
+    Retry-After is derived from the observed service time, so overload turns into
+    quick rejections instead of requests timing out.
+    """
+
+    def __init__(self, queue_limit: int = 64, queue_timeout: float = 30, text_concurrency: int = None, worker_concurrency: int = 2):
+        """
+        :param queue_limit: Maximum number of queued requests per model.
+        :param queue_timeout: Maximum time a request waits in the queue.
+        :param text_concurrency: Concurrent requests per text model (defaults to the TurboMind instance_num).
+        :param worker_concurrency: Concurrent requests per diffusion worker.
+        """
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self.text_concurrency = text_concurrency
+        self.worker_concurrency = worker_concurrency
+        self.queues = {}
+
+    def reject(self, queue, reason):
+        queue.rejected += 1
+        retry_after = queue.retry_after()
+        logging.warning(f"[{queue.name}] request rejected ({reason}), retry after {retry_after}s")
+        raise HTTPException(status_code=429, detail=f"Model overloaded: {reason}", headers={"Retry-After": str(retry_after)})
+
+    def abandon(self, queue, waiter):
+        # Leave the queue, handing the slot over if it was granted in the meantime
+        if waiter.done() and not waiter.cancelled():
+            queue.active -= 1
+            queue.wake()
+        else:
+            waiter.cancel()
+            try:
+                queue.waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    async def acquire(self, model_name, concurrency, deadline=None):
+        """
+        Wait for a slot of `model_name` and return its Ticket.
+
+        :param concurrency: Current concurrency limit of the model.
+        :param deadline: Seconds left before the deadline of the request, bounding the wait.
+        :raises HTTPException: 429 when the queue is full or the wait timed out,
+                               504 when the deadline passed while queued.
+        """
+        queue = self.queues.get(model_name)
+        if queue is None:
+            queue = self.queues[model_name] = ModelQueue(model_name, concurrency, self.queue_limit)
+        queue.concurrency = max(concurrency, 1)
+        queue.wake()
+
+        start = time.monotonic()
+        if queue.active < queue.concurrency and not queue.waiters:
+            queue.active += 1
+        else:
+            if len(queue.waiters) >= queue.queue_limit:
+                self.reject(queue, "queue full")
+            waiter = asyncio.get_running_loop().create_future()
+            queue.waiters.append(waiter)
+            timeout = self.queue_timeout if deadline is None else max(min(self.queue_timeout, deadline), 0)
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter), timeout=timeout)
+            except asyncio.TimeoutError:
+                self.abandon(queue, waiter)
+                queue.timed_out += 1
+                if timeout < self.queue_timeout:
+                    raise HTTPException(status_code=504, detail="Deadline exceeded while queued")
+                self.reject(queue, f"queued for more than {self.queue_timeout:.0f}s")
+            except asyncio.CancelledError:
+                # The client went away while queued
+                self.abandon(queue, waiter)
+                raise
+
+        queue_time = time.monotonic() - start
+        queue.admitted += 1
+        queue.queue_seconds += queue_time
+        queue.max_queue_seconds = max(queue.max_queue_seconds, queue_time)
+        return Ticket(queue, queue_time)
+
+    def stats(self):
+        return {name: queue.snapshot() for name, queue in self.queues.items()}
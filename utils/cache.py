@@ -0,0 +1,453 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+import aiofiles
+from utils.logging import logging
+from utils.sdfast import WorkerResponse
+
+
+def make_key(**params):
+    """
+    Content address of a request: sha256 of its canonical JSON parameters.
+    """
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache of worker responses for deterministic requests.
+
+    The memory tier is an LRU bounded in bytes; the optional disk tier keeps the
+    response body and its metadata side by side under `directory`, also LRU bounded
+    in bytes. Concurrent requests for the same key are coalesced so the value is
+    computed once; the computation runs as its own task so a caller going away does
+    not fail the others waiting on it, and is cancelled once none of them waits.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 ** 2, directory: str = None, max_disk_bytes: int = 4 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._inflight = {}
+        self._waiters = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.cancelled = 0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                # Left over by a write that did not complete
+                self._remove(entry.path)
+            elif entry.name.endswith(".bin"):
+                key = entry.name[:-4]
+                # The body is written first, so a body without metadata is an incomplete write
+                if not os.path.exists(self._path(key) + ".json"):
+                    self._remove(entry.path)
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        # The budget may have been lowered since the entries were written
+        self._evict_disk()
+        logging.debug(f"Result cache: {len(self._disk)} entries ({self._disk_bytes / 1024 ** 2:.1f} MB) on disk")
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _put_memory(self, key, value):
+        size = len(value.body)
+        if size > self.max_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key).body)
+        self._memory[key] = value
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.body)
+            self.evictions += 1
+
+    async def _get_disk(self, key):
+        if not self.directory or key not in self._disk:
+            return None
+        try:
+            async with aiofiles.open(self._path(key) + ".json", "r") as f:
+                meta = json.loads(await f.read())
+            async with aiofiles.open(self._path(key) + ".bin", "rb") as f:
+                body = await f.read()
+        except (OSError, ValueError):
+            self._drop_disk(key)
+            return None
+        self._disk.move_to_end(key)
+        return WorkerResponse(body, meta["media_type"], meta["headers"])
+
+    async def _put_disk(self, key, value):
+        if not self.directory:
+            return
+        # Body before metadata, each written aside then renamed: an interrupted write never leaves a truncated entry
+        try:
+            await self._write(self._path(key) + ".bin", value.body)
+            await self._write(self._path(key) + ".json", json.dumps({"media_type": value.media_type, "headers": value.headers}).encode())
+        except OSError as e:
+            logging.error(f"Result cache: unable to write {key}: {e}")
+            self._drop_disk(key)
+            return
+        # A rewritten key replaces its previous files
+        self._disk_bytes += len(value.body) - self._disk.pop(key, 0)
+        self._disk[key] = len(value.body)
+        self._evict_disk()
+
+    async def _write(self, path, data):
+        temporary = path + ".tmp"
+        try:
+            async with aiofiles.open(temporary, "wb") as f:
+                await f.write(data)
+            os.replace(temporary, path)
+        except OSError:
+            self._remove(temporary)
+            raise
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            self._drop_disk(next(iter(self._disk)))
+            self.disk_evictions += 1
+
+    def _drop_disk(self, key):
+        self._disk_bytes -= self._disk.pop(key, 0)
+        for suffix in (".bin", ".json"):
+            self._remove(self._path(key) + suffix)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def get_or_compute(self, key, compute):
+        """
+        Return the cached value for `key`, computing it with `compute()` on a miss.
+
+        :param key: Content address, see make_key.
+        :param compute: Coroutine function returning a WorkerResponse, or None on failure
+                        (failures are not cached).
+        :return: Tuple of (value, source) where source is "hit", "disk", "coalesced" or "miss".
+        """
+        value = self._memory.get(key)
+        if value is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return value, "hit"
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            value, _ = await self._wait(task)
+            return value, "coalesced"
+
+        task = asyncio.ensure_future(self._fill(key, compute))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await self._wait(task)
+
+    async def _wait(self, task):
+        # Shielded so a caller going away does not cancel it for the others, unless it was the last one
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+                    self.cancelled += 1
+
+    async def _fill(self, key, compute):
+        value = await self._get_disk(key)
+        if value is not None:
+            self.disk_hits += 1
+            self._put_memory(key, value)
+            return value, "disk"
+        self.misses += 1
+        value = await compute()
+        if value is not None:
+            self._put_memory(key, value)
+            await self._put_disk(key, value)
+        return value, "miss"
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "cancelled": self.cancelled,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "max_bytes": self.max_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "max_disk_bytes": self.max_disk_bytes if self.directory else 0,
+        }
+
+
+class Recording:
+    """
+    A text generation in progress, streamed to every request subscribed to it.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.chunks = []
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.task = None
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def append(self, chunk):
+        self.chunks.append((time.monotonic() - self.start, chunk))
+        self.size += len(chunk)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def follow(self):
+        """
+        Return a Subscription streaming the chunks generated so far, then the new ones until the generation ends.
+        """
+        return Subscription(self)
+
+    async def _follow(self):
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.chunks):
+                yield self.chunks[sent][1]
+                sent += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+    def leave(self):
+        self.subscribers -= 1
+        # Nobody reads the generation anymore
+        if self.subscribers == 0 and not self.done and self.task is not None:
+            self.task.cancel()
+
+
+class Subscription:
+    """
+    Async iterator over a Recording for one request.
+
+    The subscriber is counted from the moment the stream is handed out rather than on
+    its first read, so a request that joins and leaves early cannot cancel the
+    generation under another one whose response has not started yet. It leaves at the
+    end of the stream or on `aclose`, whichever comes first.
+    """
+
+    def __init__(self, recording):
+        self.recording = recording
+        self._chunks = recording._follow()
+        self._left = False
+        recording.subscribers += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            # End of the generation, its error, or the reader being cancelled
+            self._leave()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._chunks.aclose()
+        finally:
+            self._leave()
+
+    def _leave(self):
+        if not self._left:
+            self._left = True
+            self.recording.leave()
+
+
+class CompletionCache:
+    """
+    Cache of deterministic text generations (greedy or fixed seed), stored as the
+    streamed chunks with their timing.
+
+    A hit replays the chunks right away, or paced like the original generation
+    sped up `replay_speed` times. Identical requests arriving while the generation
+    runs subscribe to it instead of starting another one; the generation runs as its
+    own task, so subscribers going away do not interrupt the others, and is cancelled
+    (and not cached) once all of them went away. Entries expire after `ttl` seconds
+    and are evicted least recently used first beyond `max_bytes`.
+    """
+
+    # Bookkeeping per stored chunk, on top of its text
+    CHUNK_OVERHEAD = 64
+
+    def __init__(self, max_bytes: int = 64 * 1024 ** 2, ttl: float = 3600, replay_speed: float = 0):
+        """
+        :param max_bytes: Memory budget of the cached generations.
+        :param ttl: Lifetime of an entry in seconds.
+        :param replay_speed: Pace of replays relative to the original generation (0 replays at once).
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.replay_speed = replay_speed
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._inflight = {}
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.failures = 0
+        self.cancelled = 0
+
+    def get(self, key):
+        """
+        Return a stream for `key` if it is cached or being generated.
+
+        :return: Tuple of (stream, source) where source is "hit" or "coalesced", or (None, None).
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, chunks, _ = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self.replay(chunks), "hit"
+            self._drop(key)
+            self.expired += 1
+
+        recording = self._inflight.get(key)
+        if recording is not None:
+            self.coalesced += 1
+            return recording.follow(), "coalesced"
+        return None, None
+
+    def record(self, key, stream, release=None):
+        """
+        Generate `key` from the async generator `stream`, caching it once complete.
+
+        :param release: Called once the generation is over (e.g. to free its admission slot).
+        :return: Tuple of (stream, source) where source is "miss", or "coalesced" when an
+                 identical generation started in the meantime (`stream` is then discarded).
+        """
+        recording = self._inflight.get(key)
+        if recording is not None:
+            self.coalesced += 1
+            asyncio.ensure_future(stream.aclose())
+            if release:
+                release()
+            return recording.follow(), "coalesced"
+
+        self.misses += 1
+        recording = self._inflight[key] = Recording()
+        recording.task = asyncio.ensure_future(self._generate(key, recording, stream))
+        # A done callback rather than a finally block: the task may be cancelled before it starts
+        recording.task.add_done_callback(lambda task: self._generation_over(key, recording, release, task))
+        return recording.follow(), "miss"
+
+    async def _generate(self, key, recording, stream):
+        try:
+            async for chunk in stream:
+                recording.append(chunk)
+        except Exception as e:
+            self.failures += 1
+            logging.error(f"Completion cache: generation failed, not cached: {e}")
+            recording.finish(error=e)
+        else:
+            recording.finish()
+            # An empty generation is a failure the backend did not report
+            if recording.chunks:
+                self._put(key, recording)
+
+    def _generation_over(self, key, recording, release, task):
+        if task.cancelled():
+            self.cancelled += 1
+            recording.finish(error=ConnectionAbortedError("Generation cancelled"))
+        if self._inflight.get(key) is recording:
+            del self._inflight[key]
+        if release:
+            release()
+
+    def _put(self, key, recording):
+        size = recording.size + self.CHUNK_OVERHEAD * len(recording.chunks)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, recording.chunks, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    async def replay(self, chunks):
+        start = time.monotonic()
+        for offset, chunk in chunks:
+            if self.replay_speed > 0:
+                delay = offset / self.replay_speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+        }
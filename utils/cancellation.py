@@ -0,0 +1,126 @@
+import asyncio
+import contextvars
+import json
+import time
+from fastapi import HTTPException
+
+# Wall clock time by which the current request must be answered (None without deadline)
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def remaining():
+    """
+    Seconds left before the deadline of the current request, or None without deadline.
+    """
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def expired():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def abandon_reason():
+    # Why a generation was stopped before its end
+    return "deadline" if expired() else "disconnect"
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware setting the deadline of every request, from its X-Request-Timeout
+    header (in seconds) or `default_timeout`.
+
+    The deadline is forwarded to diffusion workers as X-Deadline (wall clock time,
+    the workers run on the same host) so they skip work that would come too late.
+    """
+
+    def __init__(self, app, default_timeout: float = None):
+        self.app = app
+        self.default_timeout = default_timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timeout = self.default_timeout
+        for name, value in scope["headers"]:
+            if name == b"x-request-timeout":
+                try:
+                    timeout = float(value) if float(value) > 0 else timeout
+                except ValueError:
+                    pass
+        token = current_deadline.set(time.time() + timeout if timeout else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_deadline.reset(token)
+
+
+async def until_disconnected(request, awaitable):
+    """
+    Await `awaitable`, cancelling it if the client disconnects or the deadline passes first.
+
+    :raises HTTPException: 499 when the client went away, 504 when the deadline passed.
+    """
+    task = asyncio.ensure_future(awaitable)
+
+    async def disconnected():
+        # The body has been read already, the next message is the disconnect
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(disconnected())
+    try:
+        done, _ = await asyncio.wait({task, watcher}, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task in done:
+        return task.result()
+    task.cancel()
+    if watcher in done:
+        raise HTTPException(status_code=499, detail="Client closed the request")
+    raise HTTPException(status_code=504, detail="Deadline exceeded")
+
+
+async def guarded_stream(stream):
+    """
+    Pass a text stream through until its end or the deadline, then close it so the
+    upstream generation stops (also when the client disconnected, see `close_stream`).
+    """
+    try:
+        while True:
+            left = remaining()
+            try:
+                if left is None:
+                    chunk = await stream.__anext__()
+                else:
+                    chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(left, 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                yield json.dumps({"error": "Deadline exceeded"}) + "\n"
+                return
+            yield chunk
+    finally:
+        await stream.aclose()
+
+
+async def close_stream(stream, release=None, source=None):
+    """
+    Background task of a streamed response. Starlette runs it even after a client
+    disconnect, when the stream is left suspended, so the stream is closed right away
+    instead of whenever it is garbage collected.
+
+    :param source: Stream wrapped by `stream`, closed as well in case `stream` never
+                   started (closing an unstarted generator does not close what it wraps).
+    """
+    try:
+        await stream.aclose()
+        if source is not None:
+            await source.aclose()
+    finally:
+        if release is not None:
+            release()
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from huggingface_hub import HfApi, hf_hub_download
+from utils.logging import logging
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+def lfs_sha256(sibling):
+    lfs = sibling.lfs
+    if lfs is None:
+        return None
+    return lfs.get("sha256") if isinstance(lfs, dict) else getattr(lfs, "sha256", None)
+
+
+def file_matches(path, entry):
+    """
+    Whether a file has the hash of its manifest entry: the sha256 of LFS files, the git
+    blob id of the others. Entries without either only have their size checked.
+    """
+    if entry.get("sha256"):
+        digest, expected = hashlib.sha256(), entry["sha256"]
+    elif entry.get("blob_id"):
+        digest, expected = hashlib.sha1(f"blob {os.path.getsize(path)}\0".encode()), entry["blob_id"]
+    else:
+        return True
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 ** 2):
+            digest.update(chunk)
+    return digest.hexdigest() == expected
+
+
+class DownloadManager:
+    """
+    Downloads model snapshots from the Hugging Face hub.
+
+    - Files are downloaded one by one in a bounded thread pool shared by all
+      downloads, and partial files are resumed.
+    - Concurrent requests for the same repository share a single download (a job
+      in `jobs`) and all receive its progress events.
+    - Downloaded files are checked against the hashes of the hub, then a manifest with
+      the commit and the size and hash of every file is written. A snapshot whose
+      manifest matches the files on disk is used as-is, without contacting the hub, so
+      warm restarts also work offline. The sizes are compared on every start, the
+      hashes only in offline mode, where a corrupted file cannot be downloaded again.
+    """
+
+    def __init__(self, jobs, max_workers: int = 4, offline: bool = False):
+        """
+        :param jobs: JobManager running the downloads.
+        :param max_workers: Maximum number of files downloaded at the same time.
+        :param offline: Never contact the hub; only complete local snapshots can be used.
+        """
+        self.jobs = jobs
+        self.offline = offline
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download")
+        self.inflight = {}
+        self.api = HfApi()
+
+    def manifest_path(self, local_dir):
+        # Next to the snapshot rather than inside it, so it is not mistaken for a model file
+        return os.path.normpath(local_dir) + MANIFEST_SUFFIX
+
+    def load_manifest(self, local_dir):
+        try:
+            with open(self.manifest_path(local_dir), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_complete(self, manifest, local_dir, verify=False):
+        """
+        Whether every file of the manifest is on disk with the expected size.
+
+        :param verify: Also check the hash of every file (reads the whole snapshot).
+        """
+        if not manifest:
+            return False
+        for name, entry in manifest["files"].items():
+            file_path = os.path.join(local_dir, name)
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != entry["size"]:
+                return False
+        if verify:
+            return not self.corrupted_files(manifest["files"], local_dir)
+        return True
+
+    def corrupted_files(self, files, local_dir):
+        """
+        :return: Names of the files that do not match their hash, hashed in parallel.
+        """
+        names = list(files)
+        matches = self.executor.map(lambda name: file_matches(os.path.join(local_dir, name), files[name]), names)
+        return [name for name, match in zip(names, matches) if not match]
+
+    def write_manifest(self, local_dir, manifest):
+        temporary_path = self.manifest_path(local_dir) + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temporary_path, self.manifest_path(local_dir))
+
+    async def fetch(self, repo_id, local_dir):
+        """
+        Make a snapshot of `repo_id` available in `local_dir`, yielding progress events.
+
+        :return: Async generator of status events; the manifest is available with
+                 `load_manifest` once it is exhausted.
+        :raises RuntimeError: If the snapshot could not be downloaded.
+        """
+        job = self.inflight.get(repo_id)
+        if job is None or job.done:
+            job = self.jobs.submit("download", repo_id, self._download(repo_id, local_dir))
+            self.inflight[repo_id] = job
+        async for event in job.follow():
+            yield event
+        if job.state != "succeeded":
+            raise RuntimeError(f"Download of {repo_id} {job.state}: {job.error}")
+
+    async def _download(self, repo_id, local_dir):
+        loop = asyncio.get_running_loop()
+        manifest = self.load_manifest(local_dir)
+        if await loop.run_in_executor(None, self.is_complete, manifest, local_dir, self.offline):
+            logging.debug(f"{repo_id} {manifest['revision'][:8]} found locally, skipping the hub")
+            yield {"status": "downloaded", "message": "Model found locally", "revision": manifest["revision"]}
+            return
+        if self.offline:
+            raise RuntimeError(f"{repo_id} is not available locally (or is corrupted) and downloads are disabled")
+
+        info = await loop.run_in_executor(self.executor, lambda: self.api.model_info(repo_id, files_metadata=True))
+        files = {s.rfilename: {"size": s.size, "sha256": lfs_sha256(s), "blob_id": s.blob_id} for s in info.siblings}
+        total_bytes = sum(entry["size"] or 0 for entry in files.values())
+        logging.info(f"Downloading {repo_id} {info.sha[:8]} ({len(files)} files, {total_bytes / 1024 ** 3:.1f} GB)")
+
+        def download(name):
+            hf_hub_download(repo_id=repo_id, filename=name, revision=info.sha, local_dir=local_dir, resume_download=True)
+            return name
+
+        start = time.perf_counter()
+        done_bytes = 0
+        tasks = [loop.run_in_executor(self.executor, download, name) for name in files]
+        try:
+            for completed, task in enumerate(asyncio.as_completed(tasks), start=1):
+                name = await task
+                done_bytes += files[name]["size"] or 0
+                yield {
+                    "status": "downloading",
+                    "message": f"Downloaded {name}",
+                    "file": name,
+                    "files_done": completed,
+                    "files_total": len(files),
+                    "bytes_done": done_bytes,
+                    "bytes_total": total_bytes,
+                }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        yield {"status": "verifying", "message": "Checking file hashes"}
+        corrupted = await loop.run_in_executor(None, self.corrupted_files, files, local_dir)
+        if corrupted:
+            # Removed so that the next attempt downloads them again instead of resuming
+            for name in corrupted:
+                os.remove(os.path.join(local_dir, name))
+            raise RuntimeError(f"{repo_id} files do not match their hash: {', '.join(corrupted)}")
+
+        manifest = {"repo_id": repo_id, "revision": info.sha, "files": files, "completed_at": time.time()}
+        await loop.run_in_executor(self.executor, self.write_manifest, local_dir, manifest)
+        logging.info(f"{repo_id} {info.sha[:8]} downloaded in {time.perf_counter() - start:.0f}s")
+        yield {"status": "downloaded", "message": "Model downloaded", "revision": info.sha}
@@ -1,13 +1,19 @@
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from pydantic import BaseModel, Field, field_validator
 from utils.logging import logging
-from utils.system import get_all_system_info
+from utils.scheduler import request_cost
+from utils.cache import make_key
+from utils.admission import AdmissionController
+from utils.metrics import MetricsMiddleware
+from utils.tracing import TracingMiddleware
+from utils.cancellation import DeadlineMiddleware, until_disconnected, guarded_stream, close_stream, remaining
 import typing as t
 from starlette import status
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
 from enum import Enum
 import json
@@ -43,6 +49,7 @@ class TextInteractive(BaseModel):
     top_p: Optional[float] = 0.9
     top_k: Optional[int] = 40
     max_tokens: Optional[int] = 512
+    seed: Optional[int] = None
 
 class TextCompletion(BaseModel):
     messages: List
@@ -51,6 +58,7 @@ class TextCompletion(BaseModel):
     top_p: Optional[float] = 0.9
     max_tokens: Optional[int] = 512
     top_k: Optional[int] = 40
+    seed: Optional[int] = None
 
 class TextToImage(BaseModel):
     prompt: str
@@ -60,6 +68,15 @@ class TextToImage(BaseModel):
     seed: Optional[int] = -1 
     batch_size: Optional[int] = 1
     refiner: Optional[bool] = False
+    # Same constraints as the worker, so invalid values get a 422 here rather than a failed worker request
+    format: Literal["jpeg", "png", "webp"] = "jpeg"
+    quality: int = Field(75, ge=1, le=100)
+
+    @field_validator("seed")
+    @classmethod
+    def random_seed(cls, seed):
+        # null asks for a random seed like -1, the worker only accepts integers
+        return -1 if seed is None else seed
 
 class ImageToImage(BaseModel):
     image: str
@@ -69,14 +86,88 @@ class ImageToImage(BaseModel):
     strength: Optional[int] = 1
     seed: Optional[int] = -1 
     batch_size: Optional[int] = 1
+    # Same constraints as the worker, so invalid values get a 422 here rather than a failed worker request
+    format: Literal["jpeg", "png", "webp"] = "jpeg"
+    quality: int = Field(75, ge=1, le=100)
+
+    @field_validator("seed")
+    @classmethod
+    def random_seed(cls, seed):
+        # null asks for a random seed like -1, the worker only accepts integers
+        return -1 if seed is None else seed
+
+class SwapModel(BaseModel):
+    n_gpus: Optional[str] = None # GPU ids of the replacement, e.g. 2,3 (defaults to the current ones)
+    tb_model_type: Optional[TurboMindModel] = None
+    source: Optional[str] = None # Model to serve instead (defaults to the current one)
 
 class UnauthorizedMessage(BaseModel):
     detail: str = "Bearer token missing or unknown"
+
+async def job_stream(job):
+    """
+    Stream the progress of a background job as JSON lines, starting with its id.
+    """
+    yield json.dumps({"status": "submitted", "job_id": job.id}) + "\n"
+    async for event in job.follow():
+        yield json.dumps(event) + "\n"
+
+async def admitted_stream(stream, ticket):
+    """
+    Stream a text generation and free its admission slot once it ends or the client disconnects.
+    """
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        # Stop the upstream generation before handing the slot over
+        await stream.aclose()
+        ticket.release()
+
+def is_deterministic(interact):
+    """
+    Whether a text generation request always produces the same output: greedy decoding or a fixed seed.
+    """
+    # Only the interactive endpoint forwards top_k to lmdeploy
+    greedy = interact.temperature == 0 or (isinstance(interact, TextInteractive) and interact.top_k == 1)
+    return greedy or interact.seed is not None
+
+def queue_time_header(ticket):
+    return {"X-Queue-Time": f"{ticket.queue_time:.3f}"}
+
+def worker_response(response, headers=None):
+    """
+    Pass a diffusion worker response (JSON, image bytes or multipart) through unchanged.
+    """
+    if response is None:
+        raise HTTPException(status_code=502, detail="Diffusion worker request failed")
+    return Response(content=response.body, media_type=response.media_type, headers={**response.headers, **(headers or {})})
     
 class DaemonAPI:
 
-    def __init__(self, model, api_tokens):
+    def __init__(self, model, api_tokens, result_cache=None, admission=None, completion_cache=None, request_timeout=None):
         self.app = FastAPI(docs_url="/")
+        self.result_cache = result_cache
+        self.completion_cache = completion_cache
+        self.admission = admission or AdmissionController()
+        self.metrics = model.metrics
+        self.tracer = model.tracer
+        self.app.add_middleware(MetricsMiddleware, registry=self.metrics)
+        self.app.add_middleware(TracingMiddleware, tracer=self.tracer)
+        self.app.add_middleware(DeadlineMiddleware, default_timeout=request_timeout)
+        queue_wait = self.metrics.histogram("queue_wait_seconds", "Time admitted requests waited for a slot", ("model",))
+        admission_metrics = {
+            "active": self.metrics.gauge("admission_active_requests", "Requests holding an admission slot", ("model",)),
+            "queued": self.metrics.gauge("admission_queued_requests", "Requests waiting for an admission slot", ("model",)),
+            "rejected": self.metrics.counter("admission_rejected_total", "Requests rejected with a 429", ("model",)),
+            "timed_out": self.metrics.counter("admission_timed_out_total", "Requests rejected after waiting --queue_timeout", ("model",)),
+        }
+
+        async def collect_admission_metrics():
+            for model_name, queue in self.admission.stats().items():
+                for key, metric in admission_metrics.items():
+                    metric.set(queue[key], model=model_name)
+        self.metrics.add_collector(collect_admission_metrics)
         self.models = model.models
         self.model = model
         self.known_tokens = set(api_tokens)
@@ -84,19 +175,79 @@ class DaemonAPI:
         async def get_token(
             auth: t.Optional[HTTPAuthorizationCredentials] = Depends(get_bearer_token),
         ) -> str:
-            # Simulate a database query to find a known token
-            if auth is None or (token := auth.credentials) not in self.known_tokens:
-                raise HTTPException(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    detail=UnauthorizedMessage().detail,
-                )
-            return token
+            with self.tracer.span("auth"):
+                # Simulate a database query to find a known token
+                if auth is None or (token := auth.credentials) not in self.known_tokens:
+                    raise HTTPException(
+                        status_code=status.HTTP_401_UNAUTHORIZED,
+                        detail=UnauthorizedMessage().detail,
+                    )
+                return token
+
+        async def admit(model_name: str):
+            # Slots follow the capacity of the model: TurboMind batch size, or the number of diffusion workers
+            model = self.models.get(model_name)
+            if model is None:
+                # Checked first, so that unknown names get a 404 and no admission queue
+                raise HTTPException(status_code=404, detail="Model not found or stopped")
+            if isinstance(model, dict):
+                concurrency = max(len(model['workers']), 1) * self.admission.worker_concurrency
+            else:
+                concurrency = self.admission.text_concurrency or self.model.instance_num
+            with self.tracer.span("queue", model=model_name):
+                ticket = await self.admission.acquire(model_name, concurrency, deadline=remaining())
+            queue_wait.observe(ticket.queue_time, model=model_name)
+            return ticket
         
+        async def stream_text(request: Request, model_name: str, endpoint: str, interact, generate):
+            # Streams are closed by the response background task, which also runs after a client
+            # disconnect, so the upstream generation stops as soon as nobody reads it
+            if self.completion_cache is None or not is_deterministic(interact):
+                ticket = await until_disconnected(request, admit(model_name))
+                body = admitted_stream(guarded_stream(generate()), ticket)
+                return StreamingResponse(body, headers=queue_time_header(ticket), background=BackgroundTask(close_stream, body, ticket.release))
+            # Deterministic requests are replayed from the completion cache, or share the generation in progress
+            key = make_key(endpoint=endpoint, model=model_name, revision=self.model.get_revision(model_name), **jsonable_encoder(interact))
+            stream, source = self.completion_cache.get(key)
+            headers = {}
+            if stream is None:
+                ticket = await until_disconnected(request, admit(model_name))
+                headers = queue_time_header(ticket)
+                stream, source = self.completion_cache.record(key, generate(), release=ticket.release)
+            body = guarded_stream(stream)
+            return StreamingResponse(body, headers={**headers, "X-Cache": source}, background=BackgroundTask(close_stream, body, source=stream))
+
+        @self.app.on_event("startup")
+        async def start_model_manager():
+            self.model.start()
+
+        @self.app.on_event("shutdown")
+        async def stop_health_supervisor():
+            await self.model.health.stop()
+            self.model.telemetry.stop()
+
+        @self.app.get("/health", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_health(token: str = Depends(get_token)):
+            return JSONResponse(content=jsonable_encoder(self.model.health.report()))
+
+        @self.app.get("/metrics", response_class=PlainTextResponse, responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_metrics(token: str = Depends(get_token)):
+            return PlainTextResponse(await self.metrics.render(), media_type="text/plain; version=0.0.4")
+
+        @self.app.get("/admission", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_admission(token: str = Depends(get_token)):
+            return JSONResponse(content=jsonable_encoder(self.admission.stats()))
+
         @self.app.get("/system_info", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
         async def get_active_models(token: str = Depends(get_token)):
-            models_list = jsonable_encoder(get_all_system_info())
+            # Latest background sample, see utils.telemetry
+            models_list = jsonable_encoder(self.model.telemetry.snapshot())
 
             return JSONResponse(content=models_list)
+
+        @self.app.get("/system_info/history", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_system_info_history(seconds: Optional[float] = None, token: str = Depends(get_token)):
+            return JSONResponse(content=jsonable_encoder(self.model.telemetry.history(seconds)))
         
         @self.app.get("/models", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
         async def get_active_models(token: str = Depends(get_token)):
@@ -111,84 +262,164 @@ class DaemonAPI:
                 raise HTTPException(status_code=404, detail="Model not found or stopped")
             
             try:
-                await model.destroy()
+                await self.model.stop_model(model_name)
                 return {"status": "success", "message": "Model stopped"}
             except Exception as e:
                 print(e)
                 return {"status": "error", "message": "Model not stopped"}
             
         @self.app.post("/model/{model_name}/start", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
-        async def start_model(model_name: str, interact: Model, token: str = Depends(get_token)):            
-            response_stream = model.allocate(engine=interact.engine, model_name=model_name, n_gpus=interact.n_gpus, tb_model_type=interact.tb_model_type)
+        async def start_model(model_name: str, interact: Model, token: str = Depends(get_token)):
+            # The allocation runs as a background job; the response follows its progress,
+            # and disconnecting does not interrupt it (see /jobs)
+            job = self.model.jobs.submit("allocate", model_name, model.allocate(engine=interact.engine, model_name=model_name, n_gpus=interact.n_gpus, tb_model_type=interact.tb_model_type))
+            return StreamingResponse(job_stream(job), media_type="application/json")
+
+        @self.app.post("/model/{model_name}/swap", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def swap_model(model_name: str, interact: SwapModel, token: str = Depends(get_token)):
+            if model_name not in self.models:
+                raise HTTPException(status_code=404, detail="Model not found or stopped")
+            job = self.model.jobs.submit("swap", model_name, self.model.swap(model_name=model_name, n_gpus=interact.n_gpus, tb_model_type=interact.tb_model_type.value if interact.tb_model_type else None, source=interact.source))
+            return StreamingResponse(job_stream(job), media_type="application/json")
 
-            async def json_stream_generator(stream):
-                async for item in stream:
-                    yield json.dumps(item) + "\n"
+        @self.app.get("/jobs", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def list_jobs(token: str = Depends(get_token)):
+            return JSONResponse(content=jsonable_encoder(self.model.jobs.list()))
 
-            return StreamingResponse(json_stream_generator(response_stream), media_type="application/json")
+        @self.app.get("/jobs/{job_id}", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_job(job_id: str, token: str = Depends(get_token)):
+            job = self.model.jobs.get(job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail="Job not found")
+            return JSONResponse(content=jsonable_encoder(job.snapshot()))
 
-        @self.app.post("/diffusion/{model_name}/text_to_image", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
-        async def diffusion_text_to_image(model_name: str, interact: TextToImage, token: str = Depends(get_token)):
-            model = await self.model.get_worker(model_name)
-            if not model:
+        @self.app.delete("/jobs/{job_id}", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def cancel_job(job_id: str, token: str = Depends(get_token)):
+            if self.model.jobs.get(job_id) is None:
+                raise HTTPException(status_code=404, detail="Job not found")
+            if not self.model.jobs.cancel(job_id):
+                return {"status": "error", "message": "Job already finished"}
+            return {"status": "success", "message": "Job cancelled"}
+
+        @self.app.get("/model/{model_name}/workers", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def get_model_workers(model_name: str, token: str = Depends(get_token)):
+            workers = self.model.get_worker_loads(model_name)
+            if workers is None:
                 raise HTTPException(status_code=404, detail="Model not found or stopped")
-            response = await model.t2i(
-                prompt=interact.prompt,
-                height=interact.height,
-                width=interact.width,
-                num_inference_steps=interact.num_inference_steps,
-                seed=interact.seed,
-                batch_size=interact.batch_size,
-                refiner=interact.refiner
-            )
-            return response
+            return JSONResponse(content=jsonable_encoder(workers))
+
+        @self.app.post("/diffusion/{model_name}/text_to_image", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def diffusion_text_to_image(model_name: str, interact: TextToImage, request: Request, accept: Optional[str] = Header(None), token: str = Depends(get_token)):
+            cost = request_cost(interact.width, interact.height, interact.num_inference_steps, interact.batch_size)
+
+            headers = {}
+
+            async def render():
+                # Admitted only on a cache miss, so cached results are served even under overload
+                ticket = await admit(model_name)
+                headers.update(queue_time_header(ticket))
+                try:
+                    model = await self.model.get_worker(model_name, cost=cost, width=interact.width, height=interact.height)
+                    if not model:
+                        raise HTTPException(status_code=404, detail="Model not found or stopped")
+                    return await model.t2i(
+                        prompt=interact.prompt,
+                        height=interact.height,
+                        width=interact.width,
+                        num_inference_steps=interact.num_inference_steps,
+                        seed=interact.seed,
+                        batch_size=interact.batch_size,
+                        refiner=interact.refiner,
+                        format=interact.format,
+                        quality=interact.quality,
+                        accept=accept,
+                        cost=cost
+                    )
+                finally:
+                    ticket.release()
+
+            # An explicit seed makes the result deterministic for a given model revision
+            # A disconnect cancels the worker request, and the worker drops it if not started yet
+            if self.result_cache is None or interact.seed == -1:
+                return worker_response(await until_disconnected(request, render()), headers=headers)
+            key = make_key(model=model_name, revision=self.model.get_revision(model_name), accept=accept, **jsonable_encoder(interact))
+            # The shared computation carries on for the other waiters and the cache
+            response, source = await until_disconnected(request, self.result_cache.get_or_compute(key, render))
+            return worker_response(response, headers={**headers, "X-Cache": source})
+
+        @self.app.get("/diffusion/cache", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def diffusion_cache_stats(token: str = Depends(get_token)):
+            if self.result_cache is None:
+                raise HTTPException(status_code=404, detail="Result cache is disabled")
+            return JSONResponse(content=self.result_cache.stats())
         
         @self.app.post("/diffusion/{model_name}/image_to_image", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
-        async def diffusion_image_to_image(model_name: str, interact: ImageToImage, token: str = Depends(get_token)):
-            model = await self.model.get_worker(model_name)
-            if not model:
-                raise HTTPException(status_code=404, detail="Model not found or stopped")
-            response = await model.i2i(
-                image=interact.image,
-                prompt=interact.prompt,
-                height=interact.height,
-                width=interact.width,
-                strength=interact.strength,
-                seed=interact.seed,
-                batch_size=interact.batch_size
-            )
-            return response
+        async def diffusion_image_to_image(model_name: str, interact: ImageToImage, request: Request, accept: Optional[str] = Header(None), token: str = Depends(get_token)):
+            async def render():
+                ticket = await admit(model_name)
+                try:
+                    model = await self.model.get_worker(model_name, cost=request_cost(interact.width, interact.height, 50, interact.batch_size), width=interact.width, height=interact.height)
+                    if not model:
+                        raise HTTPException(status_code=404, detail="Model not found or stopped")
+                    response = await model.i2i(
+                        image=interact.image,
+                        prompt=interact.prompt,
+                        height=interact.height,
+                        width=interact.width,
+                        strength=interact.strength,
+                        seed=interact.seed,
+                        batch_size=interact.batch_size,
+                        format=interact.format,
+                        quality=interact.quality,
+                        accept=accept
+                    )
+                finally:
+                    ticket.release()
+                return response, ticket
+
+            response, ticket = await until_disconnected(request, render())
+            return worker_response(response, headers=queue_time_header(ticket))
     
         @self.app.post("/text_generation/{model_name}/chat/interactive", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
-        async def text_generation_interactive(model_name: str, interact: TextInteractive, token: str = Depends(get_token)):
+        async def text_generation_interactive(model_name: str, interact: TextInteractive, request: Request, token: str = Depends(get_token)):
             model = self.models.get(model_name)
             if not model:
                 raise HTTPException(status_code=404, detail="Model not found")
+            if not self.model.health.is_available(model):
+                raise HTTPException(status_code=503, detail="Model is restarting or unhealthy")
 
-            response = model.interactive(
+            return await stream_text(request, model_name, "interactive", interact, lambda: model.interactive(
                 prompt=interact.prompt,
                 temperature=interact.temperature,
                 repetition_penalty=interact.repetition_penalty,
                 top_p=interact.top_p,
                 top_k=interact.top_k,
                 max_tokens=interact.max_tokens,
-            )
-            return StreamingResponse(response)
+                seed=interact.seed,
+            ))
 
         @self.app.post("/text_generation/{model_name}/chat/completions", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
-        async def text_generation_completions(model_name: str, interact: TextCompletion, token: str = Depends(get_token)):
+        async def text_generation_completions(model_name: str, interact: TextCompletion, request: Request, token: str = Depends(get_token)):
             model = self.models.get(model_name)
             if not model:
                 raise HTTPException(status_code=404, detail="Model not found")
+            if not self.model.health.is_available(model):
+                raise HTTPException(status_code=503, detail="Model is restarting or unhealthy")
 
-            response = model.completion(
+            return await stream_text(request, model_name, "completions", interact, lambda: model.completion(
                 messages=interact.messages,
                 temperature=interact.temperature,
                 repetition_penalty=interact.repetition_penalty,
                 top_p=interact.top_p,
                 max_tokens=interact.max_tokens,
-            )
-            return StreamingResponse(response)
+                seed=interact.seed,
+            ))
+
+        @self.app.get("/text_generation/cache", responses={status.HTTP_401_UNAUTHORIZED: dict(model=UnauthorizedMessage)})
+        async def text_generation_cache_stats(token: str = Depends(get_token)):
+            if self.completion_cache is None:
+                raise HTTPException(status_code=404, detail="Completion cache is disabled")
+            return JSONResponse(content=self.completion_cache.stats())
 
     def run(self, host="127.0.0.1", port=8000):
         import uvicorn
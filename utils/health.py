@@ -0,0 +1,222 @@
+import asyncio
+import time
+from collections import deque
+from utils.logging import logging
+
+# Backends in these states receive traffic
+AVAILABLE_STATES = ("healthy", "degraded")
+
+
+class BackendHealth:
+    """
+    Health state of one supervised backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = f"{backend.model_name}@{backend.host}:{backend.port}"
+        self.state = "healthy"
+        self.failures = 0
+        self.passive_failures = 0
+        self.last_error = None
+        self.last_check = None
+        self.last_ok = None
+        self.next_check = time.monotonic()
+        self.restarted_at = None
+        self.restarts = deque()
+        # Totals since the backend was registered, for metrics
+        self.restarts_total = 0
+        self.probe_failures_total = 0
+        self.request_failures_total = 0
+        self.transitions = deque(maxlen=20)
+        self.checking = False
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "passive_failures": self.passive_failures,
+            "last_error": self.last_error,
+            "last_check": self.last_check,
+            "last_ok": self.last_ok,
+            "restarts": len(self.restarts),
+            "restarts_total": self.restarts_total,
+            "probe_failures_total": self.probe_failures_total,
+            "request_failures_total": self.request_failures_total,
+            "transitions": list(self.transitions),
+        }
+
+
+class HealthSupervisor:
+    """
+    Single asyncio task supervising every model backend.
+
+    Backends are probed through their own pooled session every `interval` seconds
+    while healthy. Failed probes are retried with exponential backoff; after
+    `failure_threshold` consecutive failures the backend is restarted, at most
+    `restart_budget` times per `restart_window` seconds, after which it is marked
+    failed and left for an operator. Failures of real requests (passive signals)
+    mark the backend degraded and bring its next probe forward.
+
+    Backends must expose `model_name`, `host`, `port`, `async probe(timeout)` and
+    `async restart()`.
+    """
+
+    def __init__(self, interval: float = 10, timeout: float = 5, failure_threshold: int = 3, backoff_max: float = 60, restart_budget: int = 3, restart_window: float = 600, startup_timeout: float = 300):
+        """
+        :param interval: Seconds between probes of a healthy backend.
+        :param timeout: Timeout of a single probe in seconds.
+        :param failure_threshold: Consecutive failed probes before a restart.
+        :param backoff_max: Upper bound of the probe backoff in seconds.
+        :param restart_budget: Maximum number of restarts per `restart_window`.
+        :param restart_window: Restart budget window in seconds.
+        :param startup_timeout: Grace period after a restart before failed probes count again.
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.backoff_max = backoff_max
+        self.restart_budget = restart_budget
+        self.restart_window = restart_window
+        self.startup_timeout = startup_timeout
+        self.backends = {}
+        self._task = None
+        self._wakeup = None
+        # Running probes, referenced until they finish so they are not garbage collected
+        self._checks = set()
+
+    def register(self, backend):
+        self.backends[id(backend)] = BackendHealth(backend)
+        logging.debug(f"Health supervisor tracking {self.backends[id(backend)].name}")
+        self._wake()
+
+    def unregister(self, backend):
+        self.backends.pop(id(backend), None)
+
+    def is_available(self, backend):
+        # Backends are registered once ready, and unregistered when destroyed
+        health = self.backends.get(id(backend))
+        return health is not None and health.state in AVAILABLE_STATES
+
+    def record_success(self, backend):
+        health = self.backends.get(id(backend))
+        if health is not None:
+            health.passive_failures = 0
+
+    def record_failure(self, backend, reason):
+        """
+        Passive health signal: a real request to the backend failed.
+        """
+        health = self.backends.get(id(backend))
+        if health is None:
+            return
+        health.passive_failures += 1
+        health.request_failures_total += 1
+        health.last_error = reason
+        if health.state == "healthy":
+            self._transition(health, "degraded", reason)
+        health.next_check = time.monotonic()
+        self._wake()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for check in list(self._checks):
+            check.cancel()
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        logging.info("Health supervisor started")
+        while True:
+            now = time.monotonic()
+            for health in list(self.backends.values()):
+                if not health.checking and health.next_check <= now:
+                    health.checking = True
+                    check = asyncio.create_task(self.check(health))
+                    self._checks.add(check)
+                    check.add_done_callback(self._check_done)
+            pending = [h.next_check for h in self.backends.values() if not h.checking]
+            delay = max(min(pending, default=now + self.interval) - now, 0.05)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def check(self, health):
+        try:
+            try:
+                ok, error = await asyncio.wait_for(health.backend.probe(self.timeout), timeout=self.timeout + 1), None
+            except Exception as e:
+                ok, error = False, str(e) or type(e).__name__
+            health.last_check = time.time()
+            if ok:
+                self._on_success(health)
+            else:
+                await self._on_failure(health, error or "probe failed")
+        finally:
+            health.checking = False
+            self._wake()
+
+    def _check_done(self, check):
+        self._checks.discard(check)
+        if not check.cancelled() and check.exception() is not None:
+            logging.error(f"Health check failed: {check.exception()!r}")
+
+    def _on_success(self, health):
+        health.failures = 0
+        health.last_ok = health.last_check
+        if health.state != "healthy":
+            self._transition(health, "healthy", "probe succeeded")
+        health.next_check = time.monotonic() + self.interval
+
+    async def _on_failure(self, health, error):
+        now = time.monotonic()
+        health.failures += 1
+        health.probe_failures_total += 1
+        health.last_error = error
+        health.next_check = now + min(2 ** (health.failures - 1), self.backoff_max)
+        starting = health.state == "restarting" and now - health.restarted_at < self.startup_timeout
+        if starting or health.state == "failed":
+            return
+        if health.failures < self.failure_threshold:
+            if health.state == "healthy":
+                self._transition(health, "degraded", error)
+            return
+        while health.restarts and now - health.restarts[0] > self.restart_window:
+            health.restarts.popleft()
+        if len(health.restarts) >= self.restart_budget:
+            self._transition(health, "failed", f"restart budget exhausted ({self.restart_budget} per {self.restart_window:.0f}s)")
+            return
+        self._transition(health, "restarting", error)
+        health.restarts.append(now)
+        health.restarts_total += 1
+        health.restarted_at = now
+        health.failures = 0
+        try:
+            await health.backend.restart()
+        except Exception as e:
+            logging.error(f"Restart of {health.name} failed: {e}")
+
+    def _transition(self, health, state, reason):
+        log = logging.info if state == "healthy" else logging.warning
+        log(f"🩺  {health.name}: {health.state} -> {state} ({reason})")
+        health.transitions.append({"time": time.time(), "from": health.state, "to": state, "reason": reason})
+        health.state = state
+
+    def report(self):
+        return {health.name: health.snapshot() for health in self.backends.values()}
@@ -0,0 +1,134 @@
+import asyncio
+import time
+import uuid
+from utils.logging import logging
+
+# Job states after which a job no longer changes
+FINAL_STATES = ("succeeded", "failed", "cancelled")
+
+
+class Job:
+    """
+    A background operation (e.g. a model allocation) driven by an async generator of status events.
+    """
+
+    def __init__(self, kind: str, model_name: str):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.model_name = model_name
+        self.state = "pending"
+        self.events = []
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.state in FINAL_STATES
+
+    def _update(self, state=None, event=None):
+        if state:
+            self.state = state
+        if event:
+            self.events.append({**event, "time": time.time()})
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        """
+        Yield the job events, past ones first, until the job is finished.
+        """
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.events):
+                yield self.events[sent]
+                sent += 1
+            if self.done:
+                return
+            await changed.wait()
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "model_name": self.model_name,
+            "state": self.state,
+            "status": self.events[-1]["status"] if self.events else None,
+            "events": self.events,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class JobManager:
+    """
+    Runs allocations and other long operations as asyncio tasks, so they never block
+    the daemon loop and outlive the request that started them.
+
+    A job fails when its generator raises or yields an event with status "error".
+    Cancelling a job cancels its task; the generator is responsible for cleaning up
+    what it already started.
+    """
+
+    def __init__(self, max_finished: int = 100):
+        self.jobs = {}
+        self.max_finished = max_finished
+
+    def submit(self, kind: str, model_name: str, stream):
+        """
+        Start a job consuming the async generator `stream`.
+        """
+        job = Job(kind, model_name)
+        self.jobs[job.id] = job
+        job.task = asyncio.get_running_loop().create_task(self._run(job, stream))
+        self._prune()
+        logging.debug(f"Job {job.id} ({kind} {model_name}) submitted")
+        return job
+
+    async def _run(self, job, stream):
+        job._update(state="running")
+        state = "succeeded"
+        try:
+            async for event in stream:
+                logging.debug(f"Job {job.id} ({job.kind} {job.model_name}): {event}")
+                job._update(event=event)
+                if event.get("status") == "error":
+                    state = "failed"
+                    job.error = event.get("message")
+        except asyncio.CancelledError:
+            state = "cancelled"
+            job._update(event={"status": "cancelled", "message": "Job cancelled"})
+        except Exception as e:
+            state = "failed"
+            job.error = str(e)
+            job._update(event={"status": "error", "message": str(e)})
+            logging.error(f"Job {job.id} ({job.kind} {job.model_name}) failed: {e}")
+        finally:
+            await stream.aclose()
+            job.finished_at = time.time()
+            job._update(state=state)
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return [job.snapshot() for job in self.jobs.values()]
+
+    def active(self, model_name: str):
+        return [job for job in self.jobs.values() if job.model_name == model_name and not job.done]
+
+    def cancel(self, job_id: str):
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        job.task.cancel()
+        return True
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished[:max(len(finished) - self.max_finished, 0)]:
+            del self.jobs[job.id]
@@ -0,0 +1,284 @@
+import bisect
+import math
+import time
+
+# Default histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1, 2.5)
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    """
+    A metric family: one series per combination of label values.
+
+    Recording is a dict lookup and a few additions, without locking; metrics are
+    recorded from the daemon event loop only.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def remove(self, **labels):
+        self.series.pop(self.key(labels), None)
+
+    def clear(self):
+        self.series.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for key, value in self.series.items():
+            lines.extend(self.render_series(dict(zip(self.labelnames, key)), value))
+        return lines
+
+    def render_series(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        # For counters maintained elsewhere (e.g. by a worker), copied at scrape time
+        self.series[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.series[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [self.buckets, [0] * (len(self.buckets) + 1), 0.0, 0]
+        series[1][bisect.bisect_left(series[0], value)] += 1
+        series[2] += value
+        series[3] += 1
+
+    def set(self, bounds, counts, sum, count, **labels):
+        """
+        Replace a series with a histogram recorded elsewhere.
+
+        :param bounds: Upper bounds of the buckets, without +Inf.
+        :param counts: Non-cumulative count of each bucket, +Inf last.
+        """
+        self.series[self.key(labels)] = [tuple(bounds), list(counts), sum, count]
+
+    def render_series(self, labels, series):
+        bounds, counts, total, count = series
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*bounds, math.inf), counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': format_value(bound)})} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of the daemon, rendered in the Prometheus text exposition format.
+
+    Request paths record into counters and histograms as they go. Values owned by
+    other components (admission queues, backend health, diffusion workers) are
+    copied into the registry by collectors (see `add_collector`) at scrape time only.
+    """
+
+    def __init__(self, namespace="sense"):
+        self.namespace = namespace
+        self.metrics = {}
+        self.collectors = []
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(f"{self.namespace}_{name}", help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self.register(Gauge(f"{self.namespace}_{name}", help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(f"{self.namespace}_{name}", help, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        :param collector: Async callable run before every scrape.
+        """
+        self.collectors.append(collector)
+
+    async def render(self):
+        for collector in self.collectors:
+            await collector()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them until the last byte of the
+    response is sent, so streamed responses are measured in full.
+    """
+
+    def __init__(self, app, registry):
+        self.app = app
+        self.requests = registry.counter("http_requests_total", "HTTP requests by endpoint, model and status code", ("endpoint", "model", "status"))
+        self.duration = registry.histogram("http_request_duration_seconds", "Time until the response is fully sent", ("endpoint", "model"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+        recorded = False
+
+        async def send_wrapper(message):
+            nonlocal status_code, recorded
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                recorded = True
+                self.record(scope, status_code, start)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Errors and client disconnects before the end of the response
+            if not recorded:
+                self.record(scope, status_code, start)
+
+    def record(self, scope, status_code, start):
+        # The router stores the matched route in the scope, giving the path template
+        route = scope.get("route")
+        endpoint = getattr(route, "path", "unmatched")
+        model = scope.get("path_params", {}).get("model_name", "")
+        self.requests.inc(endpoint=endpoint, model=model, status=status_code)
+        self.duration.observe(time.perf_counter() - start, endpoint=endpoint, model=model)
+
+
+def abandonment_metrics(registry):
+    """
+    Counters of the work stopped or skipped because its client went away or its deadline
+    passed, shared by the text backends and the diffusion worker collector.
+    """
+    labels = ("model", "backend", "endpoint", "reason")
+    abandoned = registry.counter("requests_abandoned_total", "Requests stopped or skipped after a client disconnect or a passed deadline", labels)
+    reclaimed = registry.counter("gpu_seconds_reclaimed_total", "Estimated backend time not spent on abandoned requests", labels)
+    return abandoned, reclaimed
+
+
+class GenerationMetrics:
+    """
+    Token streaming metrics of the text generation backends.
+    """
+
+    def __init__(self, registry, backend=""):
+        labels = ("model", "endpoint")
+        self.backend = backend
+        self.first_token = registry.histogram("time_to_first_token_seconds", "Time from the request to the first streamed token", labels)
+        self.inter_token = registry.histogram("inter_token_latency_seconds", "Time between two streamed chunks", labels, buckets=TOKEN_LATENCY_BUCKETS)
+        self.duration = registry.histogram("generation_duration_seconds", "Time from the request to the last streamed token", labels)
+        self.throughput = registry.histogram("generation_tokens_per_second", "Decoding speed of a request after its first token", labels, buckets=THROUGHPUT_BUCKETS)
+        self.tokens = registry.counter("generated_tokens_total", "Tokens streamed to clients", labels)
+        self.errors = registry.counter("generation_errors_total", "Generations interrupted by a backend error", labels)
+        self.abandoned, self.reclaimed = abandonment_metrics(registry)
+        # Moving average of the decoding time per token, to estimate the time saved by aborting a generation
+        self.seconds_per_token = {}
+
+    def timer(self, **labels):
+        return GenerationTimer(self, labels)
+
+    def abandon(self, reason, seconds, model, endpoint):
+        labels = {"model": model, "backend": self.backend, "endpoint": endpoint, "reason": reason}
+        self.abandoned.inc(**labels)
+        self.reclaimed.inc(seconds, **labels)
+
+
+class GenerationTimer:
+    """
+    Times one streamed generation; call `chunk` for every streamed chunk and `finish` at the end.
+    """
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.start = time.perf_counter()
+        self.first = None
+        self.last = None
+
+    def chunk(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+            self.metrics.first_token.observe(now - self.start, **self.labels)
+        else:
+            self.metrics.inter_token.observe(now - self.last, **self.labels)
+        self.last = now
+
+    def finish(self, tokens, error=False, abandoned=None, max_tokens=None):
+        """
+        :param abandoned: Reason the generation was aborted before its end ("disconnect" or "deadline").
+        :param max_tokens: Token budget of the generation, to estimate the decoding time saved by the abort.
+        """
+        metrics = self.metrics
+        model = self.labels.get("model", "")
+        if error:
+            metrics.errors.inc(**self.labels)
+        metrics.tokens.inc(tokens, **self.labels)
+        per_token = None
+        if self.last is not None and self.last > self.first and tokens > 1:
+            per_token = (self.last - self.first) / (tokens - 1)
+            metrics.throughput.observe(1 / per_token, **self.labels)
+            if abandoned is None:
+                average = metrics.seconds_per_token.get(model, per_token)
+                metrics.seconds_per_token[model] = 0.9 * average + 0.1 * per_token
+        if abandoned is not None:
+            per_token = per_token or metrics.seconds_per_token.get(model, 0)
+            metrics.abandon(abandoned, max(max_tokens - tokens, 0) * per_token if max_tokens else 0, model, self.labels.get("endpoint", ""))
+        if self.last is not None:
+            metrics.duration.observe(self.last - self.start, **self.labels)
@@ -4,48 +4,177 @@ import json
 import os
 
 import aiofiles
-from huggingface_hub import snapshot_download
 from fastapi import HTTPException
 from utils.turbomind import TurboMind
 from utils.sdfast import SDFast
+from utils.scheduler import select_worker
+from utils.health import HealthSupervisor
+from utils.jobs import JobManager
+from utils.download import DownloadManager
+from utils.workspace import WorkspaceCache
+from utils.metrics import MetricsRegistry, abandonment_metrics
+from utils.tracing import Tracer
+from utils.telemetry import TelemetrySampler
 import random
 path = os.path.dirname(os.path.realpath(__file__))
 class ModelManager:
     """
     A class to manage downloading, configuring, and running various machine learning models asynchronously.
     """
-    async def get_worker(self, model_name: str):
+    async def get_worker(self, model_name: str, cost: float = 1.0, width: int = None, height: int = None):
+        """
+        Select the least-loaded worker of a diffusion model, among the workers already
+        warm for the requested resolution when there are any.
+
+        Parameters:
+        model_name (str): Name of the model.
+        cost (float): Estimated cost of the request, see utils.scheduler.request_cost.
+        width (int): Requested width.
+        height (int): Requested height.
+        """
         model = self.models.get(model_name)
         if not model:
             raise HTTPException(status_code=404, detail="Model not found or stopped")
 
-        worker_count = len(model['workers'])
-        
-        if worker_count == 0:
+        with self.tracer.span("schedule", model=model_name):
+            workers = [w for w in model['workers'].values() if self.health.is_available(w)]
+            if not workers:
+                raise HTTPException(status_code=503, detail="No healthy workers for the model")
+            # Readiness is polled in the background; until a worker reports, only its known warm buckets count
+            for w in workers:
+                w.watch_readiness()
+            warm_workers = [w for w in workers if w.is_warm(width, height)]
+            worker = select_worker(warm_workers or workers, cost=cost)
+        if worker is None:
             raise HTTPException(status_code=500, detail="No workers available for the model")
 
-        queue = model['workers'].get('queue', 0)         
-        if queue + 2 >= worker_count:
-            model['workers']['queue'] = 0
-        else:
-            model['workers']['queue'] = queue + 1
-        
-        logging.debug(f'Use worker {queue}')
-        return model['workers'][queue]
+        logging.debug(f'Use worker {worker.gpu_id} (inflight={worker.load.inflight})')
+        return worker
+
+    def get_worker_loads(self, model_name: str):
+        """
+        Return the queue depth and service rate of every worker of a diffusion model.
+        """
+        model = self.models.get(model_name)
+        if not isinstance(model, dict):
+            return None
+        return {n: {"gpu_id": worker.gpu_id, "port": worker.port, "warm": worker.warm, "warm_buckets": sorted(f"{w}x{h}" for w, h in worker.warm_buckets), **worker.load.snapshot()} for n, worker in model['workers'].items()}
     
-    def __init__(self, pulse=False, prevent_oom=False, instance_num=8):
+    def __init__(self, pulse=False, prevent_oom=False, instance_num=8, sdfast_options=None, health_options=None, download_options=None, workspace_cache_gb=200, tracing_options=None, telemetry_options=None):
         self.models = {}
+        self.metrics = MetricsRegistry()
+        self.tracer = Tracer(**(tracing_options or {}))
+        self.telemetry = TelemetrySampler(**(telemetry_options or {}))
+        self.health = HealthSupervisor(**(health_options or {}))
+        self.swapping = set()
+        self.jobs = JobManager()
+        self.downloads = DownloadManager(self.jobs, **(download_options or {}))
+        self.revisions = {}
+        self.sdfast_options = sdfast_options or {}
         self.prevent_oom = prevent_oom
         self.base_directory = os.getcwd()
         self.instance_num = instance_num
         self.models_directory = os.path.join(self.base_directory, 'models')
+        self.workspaces = WorkspaceCache(self.models_directory, max_bytes=workspace_cache_gb * 1024 ** 3)
         self.available_ports = [6000,6001,6002,6003,6004,6005,6006]
         self.used_ports = set()
         if not os.path.exists(self.models_directory):
             os.makedirs(self.models_directory)
         self.config = asyncio.run(self.load_config("config.json"))
-        if True:
-            asyncio.run(self.load_models_from_config())
+        self.startup = None
+        self.metrics.add_collector(self.collect_metrics)
+
+    async def collect_metrics(self):
+        """
+        Copy backend health and diffusion worker statistics into the metrics registry (run at scrape time).
+        """
+        metrics = self.metrics
+        backend_labels = ("model", "backend")
+        health_metrics = {
+            "state": metrics.gauge("backend_healthy", "Whether the backend receives traffic (healthy or degraded)", backend_labels),
+            "restarts_total": metrics.counter("backend_restarts_total", "Restarts of the backend by the health supervisor", backend_labels),
+            "probe_failures_total": metrics.counter("backend_probe_failures_total", "Failed health probes of the backend", backend_labels),
+            "request_failures_total": metrics.counter("backend_request_failures_total", "Failed requests to the backend", backend_labels),
+        }
+        for metric in health_metrics.values():
+            metric.clear()
+        for health in list(self.health.backends.values()):
+            labels = {"model": health.backend.model_name, "backend": health.name}
+            health_metrics["state"].set(int(self.health.is_available(health.backend)), **labels)
+            for key in ("restarts_total", "probe_failures_total", "request_failures_total"):
+                health_metrics[key].set(getattr(health, key), **labels)
+
+        gpu_labels = ("gpu", "uuid")
+        gpu_metrics = {
+            "memory_used": metrics.gauge("gpu_memory_used_megabytes", "GPU memory in use", gpu_labels),
+            "total_memory": metrics.gauge("gpu_memory_total_megabytes", "GPU memory", gpu_labels),
+            "load": metrics.gauge("gpu_utilization_ratio", "Share of time the GPU was busy", gpu_labels),
+            "temperature": metrics.gauge("gpu_temperature_celsius", "GPU temperature", gpu_labels),
+            "power": metrics.gauge("gpu_power_watts", "GPU power draw", gpu_labels),
+        }
+        for gpu in self.telemetry.latest["gpus"]:
+            for key, metric in gpu_metrics.items():
+                if gpu.get(key) is not None:
+                    metric.set(float(gpu[key]), gpu=gpu["index"], uuid=gpu["uuid"])
+
+        worker_labels = ("model", "worker")
+        worker_metrics = {
+            "inflight": metrics.gauge("worker_inflight_requests", "Requests in flight on a diffusion worker", worker_labels),
+            "stages": metrics.histogram("worker_stage_duration_seconds", "Pipeline stage durations reported by a diffusion worker", worker_labels + ("endpoint", "stage")),
+            "images": metrics.counter("worker_images_total", "Images generated by a diffusion worker", worker_labels + ("endpoint",)),
+            "embedding_hits": metrics.counter("worker_prompt_embedding_hits_total", "Prompt embedding cache hits of a diffusion worker", worker_labels),
+            "embedding_misses": metrics.counter("worker_prompt_embedding_misses_total", "Prompt embedding cache misses of a diffusion worker", worker_labels),
+            "graph_hits": metrics.counter("worker_cuda_graph_hits_total", "CUDA graph cache hits of a diffusion worker", worker_labels),
+            "graph_misses": metrics.counter("worker_cuda_graph_misses_total", "CUDA graph captures of a diffusion worker", worker_labels),
+        }
+        for metric in worker_metrics.values():
+            metric.clear()
+        abandoned, reclaimed = abandonment_metrics(metrics)
+        workers = [worker for model in list(self.models.values()) if isinstance(model, dict) for worker in list(model['workers'].values())]
+        reports = await asyncio.gather(*(worker.stats() for worker in workers))
+        for worker, report in zip(workers, reports):
+            labels = worker.metric_labels
+            worker_metrics["inflight"].set(worker.load.inflight, **labels)
+            if not report:
+                continue
+            timings = report.get("timings") or {}
+            for entry in timings.get("stages", []):
+                worker_metrics["stages"].set(timings["bounds"], entry["counts"], entry["sum"], entry["count"], endpoint=entry["endpoint"], stage=entry["stage"], **labels)
+            for endpoint, images in timings.get("images", {}).items():
+                worker_metrics["images"].set(images, endpoint=endpoint, **labels)
+            for key, stats in (("embedding", report.get("prompt_embeddings")), ("graph", report.get("cuda_graphs"))):
+                if stats:
+                    worker_metrics[f"{key}_hits"].set(stats["hits"], **labels)
+                    worker_metrics[f"{key}_misses"].set(stats["misses"], **labels)
+            # Shared with the text backends, which count as they go: series are overwritten, never cleared
+            backend_labels = {"model": labels["model"], "backend": labels["worker"]}
+            for endpoint, reasons in timings.get("skipped", {}).items():
+                for reason, (count, seconds) in reasons.items():
+                    abandoned.set(count, endpoint=endpoint, reason=reason, **backend_labels)
+                    reclaimed.set(seconds, endpoint=endpoint, reason=reason, **backend_labels)
+
+    def start(self):
+        """
+        Start health supervision and telemetry, and load the configured models in the
+        background, on the loop that serves the API (see DaemonAPI startup).
+        """
+        self.health.start()
+        self.telemetry.start()
+        if self.startup is None:
+            self.startup = asyncio.get_running_loop().create_task(self.load_models_from_config())
+
+    async def stop_model(self, model_name: str):
+        """
+        Stop a model: a TurboMind backend, or every worker of a diffusion model.
+
+        Parameters:
+        model_name (str): Name of the model.
+        """
+        model = self.models.get(model_name)
+        if isinstance(model, dict):
+            await asyncio.gather(*(worker.destroy() for worker in list(model['workers'].values())))
+        elif model is not None:
+            await model.destroy()
 
     def get_random_port(self):
         if not self.available_ports:
@@ -80,6 +209,22 @@ class ModelManager:
             logging.error(f"Error decoding JSON from the config file {config_path}.")
             return {}
 
+    def model_folder(self, model_name):
+        return f"./models/{model_name.replace('|', '/').replace('/', '-')}/model"
+
+    async def download_model(self, model_name):
+        """
+        Download a model snapshot from Hugging Face (or find it locally), yielding progress events.
+
+        Parameters:
+        model_name (str): Name of the model on Hugging Face ('/' may be written '|').
+        """
+        model_folder = self.model_folder(model_name)
+        logging.debug(f'Fetching model {model_name} from huggingface..')
+        async for event in self.downloads.fetch(model_name.replace('|', '/'), model_folder):
+            yield event
+        self.revisions[model_name] = self.downloads.load_manifest(model_folder)["revision"]
+
     async def fetch_model(self, model_name):
         """
         Asynchronously download a model snapshot from Hugging Face and save it to a specific directory.
@@ -87,14 +232,12 @@ class ModelManager:
         Parameters:
         model_name (str): Name of the model on Hugging Face.
         """
-        model_name = model_name.replace('|', '/')
-        model_folder = f"./models/{model_name.replace('/', '-')}/model"
-        logging.debug(f'Fetching model {model_name} from huggingface..')
-        snapshot_download(repo_id=model_name, local_dir=model_folder)
+        async for _ in self.download_model(model_name):
+            pass
+
+    def get_revision(self, model_name):
+        return self.revisions.get(model_name, model_name)
 
-    async def allocate_wrapper(self, engine, model_name, n_gpus, tb_model_type=None):
-        async for chunk in self.allocate(engine=engine, model_name=model_name, n_gpus=n_gpus, tb_model_type=tb_model_type):
-            logging.debug(chunk)
     def edit_config(self, file_path, changes):
         try:
             with open(file_path, 'r') as file:
@@ -131,11 +274,11 @@ class ModelManager:
         await self.load_turbomind(models.get('turbomind', []))
         gpu_ids = models["diffusions"][0]["gpu_id"].split(",")  # Split the GPU IDs string into a list
         logging.debug('Async loading models. Please wait')
-        task1 = self.allocate_wrapper(engine="turbomind", model_name="TheBloke|bagel-dpo-34b-v0.2-AWQ", n_gpus=models["turbomind"][0]["gpu_id"], tb_model_type="llama2")
-        tasks2 = [self.allocate_wrapper(engine="sdfast", model_name="dataautogpt3|OpenDalleV1.1", n_gpus=gpu_id) for gpu_id in gpu_ids]
+        job1 = self.jobs.submit("allocate", "TheBloke|bagel-dpo-34b-v0.2-AWQ", self.allocate(engine="turbomind", model_name="TheBloke|bagel-dpo-34b-v0.2-AWQ", n_gpus=models["turbomind"][0]["gpu_id"], tb_model_type="llama2"))
+        jobs2 = [self.jobs.submit("allocate", "dataautogpt3|OpenDalleV1.1", self.allocate(engine="sdfast", model_name="dataautogpt3|OpenDalleV1.1", n_gpus=gpu_id)) for gpu_id in gpu_ids]
 
-        # Executing all tasks simultaneously
-        await asyncio.gather(task1, *tasks2)
+        # Executing all jobs simultaneously
+        await asyncio.gather(*(job.task for job in [job1, *jobs2]))
 
 
 
@@ -159,6 +302,19 @@ class ModelManager:
         tasks = [self.fetch_model(model_info.get('modelName')) for model_info in turbominds if model_info.get('modelName')]
         await asyncio.gather(*tasks)
 
+    async def build_turbomind(self, **kwargs):
+        """
+        Create a TurboMind backend in a worker thread, since it converts the model
+        synchronously. The backend is not routable until it is registered in `models`.
+        If the caller is cancelled meanwhile, the backend is destroyed once created.
+        """
+        future = asyncio.get_running_loop().run_in_executor(None, lambda: TurboMind(self, register=False, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda f: f.exception() is None and asyncio.ensure_future(f.result().destroy()))
+            raise
+
     async def allocate(self, engine, model_name, n_gpus, tb_model_type=None):
         model_name_fn = model_name.replace("/", "-").replace("|", "-")
         if engine == "turbomind":
@@ -167,36 +323,108 @@ class ModelManager:
             yield {"status": "allocating", "message": "Model allocated"}
             logging.info(f'Allocate {model_path} (type = {model_type}) with {n_gpus} GPUs..')
             yield {"status": "downloading", "message": "Download model"}
-            await self.fetch_model(model_name=model_name)
-            yield {"status": "downloaded", "message": "Model downloaded"}
+            async for event in self.download_model(model_name):
+                yield event
             yield {"status": "start_process", "message": "Starting process"}
-            tm = TurboMind(self, model_path=model_path, model_name=model_name, gpu_id=n_gpus, tb_model_type=model_type, port=self.get_random_port(), prevent_oom=self.prevent_oom, instance_num=self.instance_num)
-            yield {"status": "wait_status", "message": "Wait for status"}
-            if tm.wait_for_tb_model_status():
-                tm.warm_up(gpu_id=n_gpus)
-                yield {"status": "ready", "message": "Model is ready"}
-                self.models[model_name].status = 1
-                logging.info(f'Model {model_name} is ready')
-            else:
-                yield {"status": "error", "message": "Model is not ready"}
-                logging.error(f'Error when allocating {model_path}.')
-                del self.models[model_name]
+            tm = await self.build_turbomind(model_path=model_path, model_name=model_name, gpu_id=n_gpus, tb_model_type=model_type, port=self.get_random_port(), prevent_oom=self.prevent_oom, instance_num=self.instance_num)
+            try:
+                yield {"status": "wait_status", "message": "Wait for status"}
+                if await tm.wait_for_tb_model_status():
+                    await tm.warm_up(gpu_id=n_gpus)
+                    tm.status = 1
+                    self.models[model_name] = tm
+                    self.health.register(tm)
+                    yield {"status": "ready", "message": "Model is ready"}
+                    logging.info(f'Model {model_name} is ready')
+                else:
+                    yield {"status": "error", "message": "Model is not ready"}
+                    logging.error(f'Error when allocating {model_path}.')
+                    await tm.destroy()
+            except asyncio.CancelledError:
+                logging.warning(f'Allocation of {model_name} cancelled')
                 await tm.destroy()
+                raise
         if engine == "sdfast":
             yield {"status": "allocating", "message": "Model allocated"}
             model_path = f"/models/{model_name_fn}/model"
             logging.info(f'Allocate {model_path} (type = sdfast) with {n_gpus} GPUs..')
             yield {"status": "downloading", "message": "Download model"}
-            await self.fetch_model(model_name=model_name)
-            yield {"status": "downloaded", "message": "Model downloaded"}
+            async for event in self.download_model(model_name):
+                yield event
             yield {"status": "start_process", "message": "Starting process"}
-            sd = SDFast(self, model_name=model_name, model_path=model_path, model_refiner="/models/stabilityai-stable-diffusion-xl-refiner-1.0/model", port=self.get_random_port(), model_type="t2i", gpu_id=n_gpus)
-            yield {"status": "wait_status", "message": "Wait for status"}
-            if await sd.wait_for_sd_model_status():
-                yield {"status": "ready", "message": "Model is ready"}
-                logging.info(f'Model {model_name} is ready')
-            else:
-                yield {"status": "error", "message": "Model is not ready"}
-                logging.error(f'Error when allocating {model_path}.')
-                del self.models[model_name]
-                await sd.destroy()
\ No newline at end of file
+            sd = SDFast(self, model_name=model_name, model_path=model_path, model_refiner="/models/stabilityai-stable-diffusion-xl-refiner-1.0/model", port=self.get_random_port(), model_type="t2i", gpu_id=n_gpus, **self.sdfast_options)
+            try:
+                yield {"status": "wait_status", "message": "Wait for status"}
+                if await sd.wait_for_sd_model_status():
+                    self.health.register(sd)
+                    yield {"status": "ready", "message": "Model is ready"}
+                    logging.info(f'Model {model_name} is ready')
+                else:
+                    yield {"status": "error", "message": "Model is not ready"}
+                    logging.error(f'Error when allocating {model_path}.')
+                    await sd.destroy()
+            except asyncio.CancelledError:
+                logging.warning(f'Allocation of {model_name} (GPU {n_gpus}) cancelled')
+                await sd.destroy()
+                raise
+
+    async def swap(self, model_name, n_gpus=None, tb_model_type=None, source=None):
+        """
+        Blue/green swap of a TurboMind model: start a replacement next to the running
+        instance, wait until it is ready and warm, switch new traffic over in one step,
+        then drain and stop the old instance.
+
+        Parameters:
+        model_name (str): Name the model is served under.
+        n_gpus (str): GPU ids of the replacement, the current ones if not set.
+        tb_model_type (str): TurboMind model type, the current one if not set.
+        source (str): Hugging Face model to serve instead, the current one if not set.
+        """
+        old = self.models.get(model_name)
+        if not isinstance(old, TurboMind):
+            yield {"status": "error", "message": "Only running TurboMind models can be swapped"}
+            return
+        if model_name in self.swapping:
+            yield {"status": "error", "message": "A swap is already in progress for this model"}
+            return
+        self.swapping.add(model_name)
+        new = None
+        try:
+            source = source or model_name
+            n_gpus = n_gpus or old.gpu_id
+            tb_model_type = tb_model_type or old.tb_model_type
+            if set(n_gpus.split(",")) & set(old.gpu_id.split(",")):
+                logging.warning(f"Swap of {model_name} shares GPUs {n_gpus} with the running instance, both must fit in memory")
+            yield {"status": "downloading", "message": "Download model"}
+            async for event in self.download_model(source):
+                yield event
+            yield {"status": "start_process", "message": "Starting replacement"}
+            model_path = f"/models/{source.replace('/', '-').replace('|', '-')}/"
+            new = await self.build_turbomind(model_path=model_path, model_name=model_name, gpu_id=n_gpus, tb_model_type=tb_model_type, port=self.get_random_port(), prevent_oom=self.prevent_oom, instance_num=self.instance_num)
+            yield {"status": "wait_status", "message": "Wait for replacement status"}
+            if not await new.wait_for_tb_model_status():
+                yield {"status": "error", "message": "Replacement is not ready, keeping the running instance"}
+                await new.destroy()
+                return
+            await new.warm_up(gpu_id=n_gpus)
+            # New requests go to the replacement from here on; streams already running finish on the old instance
+            new.status = 1
+            self.models[model_name] = new
+            self.revisions[model_name] = self.get_revision(source)
+            self.health.register(new)
+            logging.info(f"Traffic for {model_name} switched to {model_path} on port {new.port}")
+            yield {"status": "switched", "message": "Traffic switched to the replacement"}
+            await old.destroy()
+            yield {"status": "ready", "message": "Swap complete"}
+        except asyncio.CancelledError:
+            logging.warning(f"Swap of {model_name} cancelled")
+            if new is not None and self.models.get(model_name) is not new:
+                await new.destroy()
+            raise
+        except Exception as e:
+            logging.error(f"Swap of {model_name} failed: {e}")
+            if new is not None and self.models.get(model_name) is not new:
+                await new.destroy()
+            yield {"status": "error", "message": f"Swap failed: {e}"}
+        finally:
+            self.swapping.discard(model_name)
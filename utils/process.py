@@ -0,0 +1,144 @@
+import asyncio
+import os
+import shlex
+import signal
+import subprocess
+import time
+import psutil
+from utils.logging import logging
+
+
+async def gpu_compute_pids():
+    """
+    PIDs of the processes holding a CUDA context, or None if nvidia-smi is not available.
+    """
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "nvidia-smi", "--query-compute-apps=pid", "--format=csv,noheader",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        stdout, _ = await process.communicate()
+    except (FileNotFoundError, PermissionError):
+        return None
+    if process.returncode != 0:
+        return None
+    return {int(line) for line in stdout.decode().split() if line.strip().isdigit()}
+
+
+class ManagedProcess:
+    """
+    A model worker process owned by the daemon.
+
+    The process is started in its own session (and process group), so stopping it
+    also stops everything it spawned. Every PID seen in the group is tracked, so that
+    after a stop the daemon can confirm that none of them still holds GPU memory
+    before the port or GPU is handed to another worker.
+    """
+
+    def __init__(self, command, name: str, env: dict = None):
+        """
+        :param command: Command line, as a string or a list of arguments.
+        :param name: Name used in logs.
+        :param env: Environment of the process.
+        """
+        self.command = shlex.split(command) if isinstance(command, str) else list(command)
+        self.name = name
+        self.env = env
+        self.process = None
+        self.pids = set()
+
+    @property
+    def pid(self):
+        return self.process.pid if self.process else None
+
+    def start(self):
+        logging.info(f'Spawning 1 process for {self.name}')
+        self.process = subprocess.Popen(self.command, env=self.env, start_new_session=True)
+        self.pids = {self.process.pid}
+        return self
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def group_pids(self):
+        """
+        PIDs of the processes still alive in the process group, which are added to the tracked PIDs.
+        """
+        if self.process is None:
+            return set()
+        alive = set()
+        for process in psutil.process_iter(["pid"]):
+            try:
+                if os.getpgid(process.pid) == self.process.pid:
+                    alive.add(process.pid)
+            except (ProcessLookupError, PermissionError):
+                continue
+        self.pids |= alive
+        return alive
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    async def _wait_group(self, timeout):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self.process.poll()
+            if not self.group_pids():
+                return True
+            await asyncio.sleep(0.1)
+        return False
+
+    async def stop(self, idle=None, drain_timeout: float = 30, term_timeout: float = 15, gpu_timeout: float = 30):
+        """
+        Drain, terminate and reap the process group.
+
+        :param idle: Callable returning True once the worker has no request in flight;
+                     new traffic must already be routed elsewhere.
+        :param drain_timeout: Maximum time to wait for in-flight requests.
+        :param term_timeout: Time between SIGTERM and SIGKILL.
+        :param gpu_timeout: Maximum time to wait for the GPU memory of the group to be released.
+        :return: True if the group is gone and holds no GPU memory.
+        """
+        if self.process is None:
+            return True
+        start = time.monotonic()
+        self.group_pids()
+        if idle is not None and self.is_running():
+            while not idle() and time.monotonic() - start < drain_timeout:
+                await asyncio.sleep(0.1)
+            if not idle():
+                logging.warning(f"{self.name}: requests still in flight after {drain_timeout:.0f}s, stopping anyway")
+
+        self._signal(signal.SIGTERM)
+        if not await self._wait_group(term_timeout):
+            logging.warning(f"{self.name}: still running {term_timeout:.0f}s after SIGTERM, sending SIGKILL")
+            self._signal(signal.SIGKILL)
+            await self._wait_group(5)
+        await asyncio.get_running_loop().run_in_executor(None, self.process.wait)
+
+        gpu_free = await self.wait_gpu_free(gpu_timeout)
+        logging.info(f"{self.name} stopped in {time.monotonic() - start:.1f}s (exit code {self.process.returncode})")
+        return gpu_free
+
+    async def wait_gpu_free(self, timeout: float = 30):
+        """
+        Wait until no tracked PID holds a CUDA context.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            holders = await gpu_compute_pids()
+            if holders is None:
+                logging.debug(f"{self.name}: nvidia-smi unavailable, cannot confirm GPU memory release")
+                return True
+            if not holders & self.pids:
+                return True
+            if time.monotonic() > deadline:
+                logging.error(f"{self.name}: PIDs {sorted(holders & self.pids)} still hold GPU memory")
+                return False
+            await asyncio.sleep(0.2)
+
+    async def restart(self, **stop_options):
+        await self.stop(**stop_options)
+        return self.start()
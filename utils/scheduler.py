@@ -0,0 +1,100 @@
+import random
+import time
+from contextlib import contextmanager
+
+
+def request_cost(width, height, num_inference_steps, batch_size=1):
+    """
+    Estimate the GPU work of a diffusion request in megapixel-steps.
+
+    :param width: Image width in pixels.
+    :param height: Image height in pixels.
+    :param num_inference_steps: Number of denoising steps.
+    :param batch_size: Number of images generated.
+    :return: Relative cost used to compare requests of different sizes.
+    """
+    return max(width * height * num_inference_steps * batch_size / 1e6, 1e-3)
+
+
+class WorkerLoad:
+    """
+    Tracks in-flight work and recent service rate for a single worker.
+
+    The service rate is an exponentially weighted moving average of seconds per
+    unit of cost (see `request_cost`). Since a worker serializes inference, only the
+    share of a request's latency attributable to its own cost is used as a sample.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.inflight = 0
+        self.pending_cost = 0.0
+        self.seconds_per_unit = None
+        self.completed = 0
+        self.failed = 0
+        self.last_latency = None
+
+    def expected_wait(self, cost=1.0, default_rate=1.0):
+        """
+        Expected time until a new request of the given cost would be finished.
+        """
+        rate = self.seconds_per_unit if self.seconds_per_unit is not None else default_rate
+        return (self.pending_cost + cost) * rate
+
+    @contextmanager
+    def track(self, cost=1.0):
+        """
+        Account for a request for as long as the context is open.
+        """
+        pending_at_start = self.pending_cost
+        self.inflight += 1
+        self.pending_cost += cost
+        start = time.monotonic()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            latency = time.monotonic() - start
+            self.inflight -= 1
+            self.pending_cost = max(self.pending_cost - cost, 0.0)
+            self.last_latency = latency
+            if ok:
+                self.completed += 1
+                sample = latency / (pending_at_start + cost)
+                if self.seconds_per_unit is None:
+                    self.seconds_per_unit = sample
+                else:
+                    self.seconds_per_unit += self.alpha * (sample - self.seconds_per_unit)
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        return {
+            "inflight": self.inflight,
+            "pending_cost": round(self.pending_cost, 3),
+            "seconds_per_unit": self.seconds_per_unit,
+            "expected_wait": round(self.expected_wait(cost=0.0, default_rate=self.seconds_per_unit or 0.0), 3),
+            "completed": self.completed,
+            "failed": self.failed,
+            "last_latency": self.last_latency,
+        }
+
+
+def select_worker(workers, cost=1.0):
+    """
+    Pick the worker with the shortest expected wait for a request of the given cost.
+
+    Workers without a latency sample yet are assumed to run at the average rate of
+    their peers. Ties are broken randomly so idle workers share the load.
+
+    :param workers: Iterable of workers exposing a `load` attribute (WorkerLoad).
+    :param cost: Cost of the request being scheduled.
+    :return: The selected worker, or None if there are no workers.
+    """
+    workers = list(workers)
+    if not workers:
+        return None
+    rates = [w.load.seconds_per_unit for w in workers if w.load.seconds_per_unit is not None]
+    default_rate = sum(rates) / len(rates) if rates else 1.0
+    return min(workers, key=lambda w: (w.load.expected_wait(cost, default_rate), w.load.inflight, random.random()))
@@ -1,20 +1,32 @@
-import threading
-import requests
 import time
 import os
 import json
-import subprocess
 from utils.logging import logging
-import signal
 import asyncio
-import shlex
 import aiohttp
+from utils.scheduler import WorkerLoad, request_cost
+from utils.process import ManagedProcess
+from utils.cancellation import current_deadline, remaining, expired
+
+# Worker response headers forwarded to clients (lowercase)
+FORWARDED_HEADERS = ("server-timing",)
+
+class WorkerResponse:
+    """
+    A worker response passed through to the client without being re-serialized.
+    """
+
+    def __init__(self, body: bytes, media_type: str, headers: dict = None):
+        self.body = body
+        self.media_type = media_type
+        self.headers = headers or {}
+
 class SDFast:
     """
     A class to manage the interface with the SDFast model for generating images from text or images.
     """
 
-    def __init__(self, instance, model_name: str = None, model_path: str = None, model_refiner: str = None, model_type: str = "t2i", host: str = "127.0.0.1", port: int = 9000, gpu_id=0, warm_up=True):
+    def __init__(self, instance, model_name: str = None, model_path: str = None, model_refiner: str = None, model_type: str = "t2i", host: str = "127.0.0.1", port: int = 9000, gpu_id=0, warm_up=True, max_connections: int = 8, request_timeout: float = 300, batch_window_ms: float = 0, max_batch_size: int = 1, resolution_buckets: str = "1024x1024", bucket_mode: str = "off", graph_cache_mb: int = 4096):
         if instance.models.get(model_name) is None:
             instance.models[model_name] = {}
             instance.models[model_name]['workers'] = {}
@@ -33,6 +45,13 @@ class SDFast:
         :param port: Port number for the model server.
         :param gpu_id: GPU ID to use for the model.
         :param warm_up: Flag to warm up the model on initialization.
+        :param max_connections: Maximum number of pooled connections to the worker.
+        :param request_timeout: Total timeout in seconds for a single generation request.
+        :param batch_window_ms: How long the worker waits to batch compatible text2image requests.
+        :param max_batch_size: Maximum number of text2image requests per pipeline call (1 disables batching).
+        :param resolution_buckets: Comma separated WIDTHxHEIGHT resolutions whose CUDA graphs the worker captures at startup.
+        :param bucket_mode: How other resolutions map to a bucket: 'snap', 'pad' or 'off'.
+        :param graph_cache_mb: GPU memory budget of the worker's CUDA graphs in MB.
         """
         self.model_type = "turbomind"
         self.model_name = model_name
@@ -45,6 +64,24 @@ class SDFast:
         self.model_type = model_type
         self.model_refiner = model_refiner
         self.base_directory = instance.base_directory
+        self.max_connections = max_connections
+        self.request_timeout = request_timeout
+        self.batch_window_ms = batch_window_ms
+        self.max_batch_size = max_batch_size
+        self.resolution_buckets = resolution_buckets
+        self.bucket_mode = bucket_mode
+        self.graph_cache_mb = graph_cache_mb
+        self._session = None
+        self._session_loop = None
+        self.load = WorkerLoad()
+        self.metric_labels = {"model": model_name, "worker": f"{host}:{port}"}
+        self.request_duration = instance.metrics.histogram("worker_request_duration_seconds", "Generation requests to a diffusion worker, as seen by the daemon", ("model", "worker", "endpoint"))
+        self.request_errors = instance.metrics.counter("worker_request_errors_total", "Failed generation requests to a diffusion worker", ("model", "worker", "endpoint"))
+        self.warm = False
+        self.warm_buckets = set()
+        self._readiness_checked_at = 0.0
+        self._readiness_task = None
+        self.process = None
         self.run_subprocess()
     def run_subprocess(self):
         """
@@ -52,13 +89,9 @@ class SDFast:
         """
         environment = os.environ.copy()
         environment["CUDA_VISIBLE_DEVICES"] = str(self.gpu_id)
-        command = f"python3 api/sdfast.py --host {self.host} --port {self.port} --model_name {self.base_directory}{self.model_path} --model_refiner {self.base_directory}{self.model_refiner} --model_type {self.model_type} --worker_id {self.gpu_id}"
-        logging.info(f'Spawning 1 process for {self.model_path}')
-
+        command = f"python3 api/sdfast.py --host {self.host} --port {self.port} --model_name {self.base_directory}{self.model_path} --model_refiner {self.base_directory}{self.model_refiner} --model_type {self.model_type} --worker_id {self.gpu_id} --batch_window_ms {self.batch_window_ms} --max_batch_size {self.max_batch_size} --resolution_buckets {self.resolution_buckets} --bucket_mode {self.bucket_mode} --graph_cache_mb {self.graph_cache_mb}"
         try:
-            self.process_tb = subprocess.Popen(shlex.split(command), shell=False, env=environment, preexec_fn=os.setsid, stdout=subprocess.PIPE)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error when executing the command: {e}")
+            self.process = ManagedProcess(command, name=f"{self.model_path} (GPU {self.gpu_id}, port {self.port})", env=environment).start()
         except Exception as e:
             logging.error(f"An error occurred: {e}")
 
@@ -69,38 +102,174 @@ class SDFast:
         :param timeout: Maximum time to wait for the model to be ready.
         """
         start_time = time.time()
-        url = f"http://{self.host}:{self.port}/ping"
+        session = await self.get_session()
         while True:
             if time.time() - start_time > timeout:
                 logging.error(f"Error: Timeout of {timeout} seconds exceeded for model {self.model_path} ({self.host}:{self.port})")
                 return False
+            if self.process is not None and not self.process.is_running():
+                logging.error(f"Error: worker for {self.model_path} exited with code {self.process.process.returncode}")
+                return False
 
             try:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    logging.info(f'Model {self.model_path} is ready')
-                    return True
-            except requests.exceptions.RequestException:
+                async with session.get("/ping", timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    if response.status == 200:
+                        logging.info(f'Model {self.model_path} is ready')
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
                 pass
             await asyncio.sleep(1)  # Wait for a second before retrying
 
-    async def make_request(self, endpoint, payload):
-        async with aiohttp.ClientSession() as session:
-            url = f"http://{self.host}:{self.port}{endpoint}"
-            headers = {"Content-Type": "application/json"}
-            try:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    response_data = await response.json()
-                    if response.status == 200:
-                        return response_data
-                    else:
-                        logging.error(f"Failed to get response: {response.status}")
-                        return None
-            except Exception as e:
-                logging.error(f"Failed to make request: {str(e)}")
-                return None
-
-    async def i2i(self, image, prompt, height, width, strength, seed, batch_size):
+    async def get_session(self):
+        """
+        Return the long-lived session to this worker, opening it on first use.
+
+        The session is bound to the event loop it was created on, so a new one is
+        opened if the daemon is now running on a different loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                base_url=f"http://{self.host}:{self.port}",
+                connector=connector,
+                headers={"Content-Type": "application/json"},
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout, sock_connect=10),
+                trace_configs=[self.instance.tracer.aiohttp_trace_config],
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def close_session(self):
+        """
+        Close the session to this worker if it belongs to the running loop.
+        """
+        if self._session is not None and not self._session.closed and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    async def refresh_readiness(self, interval: float = 1.0):
+        """
+        Update which resolution buckets the worker has warmed up, at most once per `interval` seconds.
+
+        Workers answer /ping while they are still warming up; until /ready reports the
+        warm-up as finished, only the buckets it lists as ready count as warm.
+        """
+        if self.warm or time.monotonic() - self._readiness_checked_at < interval:
+            return
+        self._readiness_checked_at = time.monotonic()
+        try:
+            session = await self.get_session()
+            async with session.get("/ready", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                response.raise_for_status()
+                report = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return
+        self.warm_buckets = {tuple(int(v) for v in bucket.split("x")) for bucket, state in report["buckets"].items() if state["ready"]}
+        if report["ready"]:
+            self.warm = True
+            logging.info(f"{self.model_path} (GPU {self.gpu_id}) warm-up finished in {report['elapsed']}s")
+
+    def watch_readiness(self, interval: float = 1.0):
+        """
+        Poll /ready in the background until the warm-up is over, so scheduling never
+        waits for the probe (started by the health probe and by the scheduler).
+        """
+        if self.warm or (self._readiness_task is not None and not self._readiness_task.done()):
+            return
+
+        async def watch():
+            while not self.warm:
+                await self.refresh_readiness(interval)
+                await asyncio.sleep(interval)
+
+        self._readiness_task = asyncio.ensure_future(watch())
+
+    def is_warm(self, width=None, height=None):
+        """
+        Whether the worker is warm for a resolution (or fully warm, without one).
+        """
+        return self.warm or (width, height) in self.warm_buckets
+
+    async def stats(self, timeout=2):
+        """
+        Return the worker statistics (caches and stage timings), or None if it does not answer.
+        """
+        try:
+            session = await self.get_session()
+            async with session.get("/stats", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def probe(self, timeout=5):
+        """
+        Health probe used by the health supervisor (see utils.health).
+        """
+        self.watch_readiness()
+        session = await self.get_session()
+        async with session.get("/ping", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status == 200
+
+    async def restart(self):
+        """
+        Replace the worker process; the health supervisor waits for the probe to pass again.
+        """
+        logging.error(f"Worker {self.host}:{self.port} ({self.model_path}) is down, restarting")
+        await self.close_session()
+        self.warm = False
+        self.warm_buckets = set()
+        await self.process.restart(term_timeout=5)
+
+    async def make_request(self, endpoint, payload, cost=1.0, accept=None):
+        """
+        Send a generation request to the worker.
+
+        :param endpoint: Worker endpoint, e.g. /text_to_image.
+        :param payload: JSON payload.
+        :param cost: Estimated cost of the request, see utils.scheduler.request_cost.
+        :param accept: Accept header forwarded to the worker (JSON, image/* or multipart/mixed).
+        :return: WorkerResponse with the untouched body, or None on failure.
+        """
+        session = await self.get_session()
+        tracer = self.instance.tracer
+        headers = {**tracer.headers(), **({"Accept": accept} if accept else {})}
+        # The worker skips the request if it is still queued when the deadline passes
+        deadline = current_deadline.get()
+        options = {}
+        if deadline is not None:
+            headers["X-Deadline"] = f"{deadline:.3f}"
+            options["timeout"] = aiohttp.ClientTimeout(total=max(min(self.request_timeout, remaining()), 0.001), sock_connect=10)
+        start = time.perf_counter()
+        try:
+            with self.load.track(cost), tracer.span("worker request", endpoint=endpoint, **self.metric_labels):
+                async with session.post(endpoint, json=payload, headers=headers, **options) as response:
+                    with tracer.span("read body"):
+                        body = await response.read()
+                    tracer.record_remote(response.headers.get("X-Trace-Spans"), process=f"worker {self.metric_labels['worker']}", pid=self.port)
+                    response.raise_for_status()
+                    self.instance.health.record_success(self)
+                    self.request_duration.observe(time.perf_counter() - start, endpoint=endpoint, **self.metric_labels)
+                    # Other worker headers (X-Trace-Spans, X-Processing-Time) are internal, and cached responses would replay them
+                    passthrough = {k: v for k, v in response.headers.items() if k.lower() in FORWARDED_HEADERS}
+                    return WorkerResponse(body, response.headers.get("Content-Type", "application/json"), passthrough)
+        except aiohttp.ClientResponseError as e:
+            logging.error(f"Failed to get response: {e.status}")
+            self.request_errors.inc(endpoint=endpoint, **self.metric_labels)
+            # 504 is the worker skipping a request past its deadline, not a worker failure
+            if e.status >= 500 and e.status != 504:
+                self.instance.health.record_failure(self, f"HTTP {e.status} on {endpoint}")
+            return None
+        except Exception as e:
+            logging.error(f"Failed to make request: {str(e)}")
+            self.request_errors.inc(endpoint=endpoint, **self.metric_labels)
+            if not expired():
+                self.instance.health.record_failure(self, f"{type(e).__name__} on {endpoint}")
+            return None
+
+    async def i2i(self, image, prompt, height, width, strength, seed, batch_size, format="jpeg", quality=75, accept=None):
         payload = {
             "image": image,
             "prompt": prompt,
@@ -108,12 +277,14 @@ class SDFast:
             "width": width,
             "strength": strength,
             "seed": seed,
-            "batch_size": batch_size
+            "batch_size": batch_size,
+            "format": format,
+            "quality": quality
         }
-        response = await self.make_request("/image_to_image", payload)
+        response = await self.make_request("/image_to_image", payload, cost=request_cost(width, height, 50, batch_size), accept=accept)
         return response
 
-    async def t2i(self, prompt, height, width, num_inference_steps, seed, batch_size, refiner):
+    async def t2i(self, prompt, height, width, num_inference_steps, seed, batch_size, refiner, format="jpeg", quality=75, accept=None, cost=None):
         payload = {
             "prompt": prompt,
             "height": height,
@@ -121,23 +292,39 @@ class SDFast:
             "num_inference_steps": num_inference_steps,
             "seed": seed,
             "batch_size": batch_size,
-            "refiner": refiner
+            "refiner": refiner,
+            "format": format,
+            "quality": quality
         }
-        response = await self.make_request("/text_to_image", payload)
+        if cost is None:
+            cost = request_cost(width, height, num_inference_steps, batch_size)
+        response = await self.make_request("/text_to_image", payload, cost=cost, accept=accept)
         return response
         
-    def destroy(self):
-        print(self.process_tb)
-        if self.process_tb:
-            try:
-                logging.info(f"Stop {self.model_path} model..")
-                model = self.instance.models.get(self.model_name)
-                if model:
-                    del model
-                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
-                time.sleep(2)
-                logging.info(f"{self.model_path} model stopped.")
-            except Exception as e:
-                logging.error(f"Error when stopping {self.model_path} model: {e}")
-        else:
-            logging.info(f"{self.model_path} model is not running.")
\ No newline at end of file
+    async def destroy(self):
+        """
+        Stop routing to this worker, drain its in-flight requests and stop its process.
+
+        The port is released only once the worker's GPU memory has been freed.
+        """
+        self.instance.health.unregister(self)
+        if self._readiness_task is not None:
+            self._readiness_task.cancel()
+        workers = self.instance.models.get(self.model_name, {}).get('workers', {})
+        for n, worker in list(workers.items()):
+            if worker is self:
+                del workers[n]
+        if not workers:
+            self.instance.models.pop(self.model_name, None)
+        if self.process is None:
+            logging.info(f"{self.model_path} model is not running.")
+            return
+        try:
+            logging.info(f"Stop {self.model_path} model..")
+            gpu_free = await self.process.stop(idle=lambda: self.load.inflight == 0)
+            if gpu_free:
+                self.instance.release_port(self.port)
+        except Exception as e:
+            logging.error(f"Error when stopping {self.model_path} model: {e}")
+        finally:
+            await self.close_session()
@@ -0,0 +1,73 @@
+import json
+from utils.logging import logging
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for upstream token streams.
+
+    Accepts raw bytes in arbitrarily sized chunks and returns every complete frame
+    parsed exactly once. Both newline-delimited JSON (lmdeploy `/v1/chat/interactive`)
+    and Server-Sent Events `data:` frames (`/v1/chat/completions`) are understood;
+    SSE `event:`/`id:`/`retry:` fields, comments and the `[DONE]` sentinel are skipped.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data = []
+        self.errors = 0
+
+    def feed(self, chunk: bytes):
+        """
+        Add a chunk to the buffer and return the frames it completed.
+
+        :param chunk: Bytes received from the upstream connection.
+        :return: List of decoded JSON objects.
+        """
+        self._buffer += chunk
+        if b"\n" not in chunk:
+            return []
+        *lines, self._buffer = self._buffer.split(b"\n")
+        frames = []
+        for line in lines:
+            self._decode_line(line, frames)
+        return frames
+
+    def flush(self):
+        """
+        Decode whatever is left once the upstream stream has ended.
+        """
+        frames = []
+        if self._buffer:
+            self._decode_line(self._buffer, frames)
+            self._buffer = b""
+        self._dispatch(frames)
+        return frames
+
+    def _decode_line(self, line, frames):
+        line = line.rstrip(b"\r")
+        if not line:
+            # Blank line terminates an SSE event
+            self._dispatch(frames)
+        elif line.startswith(b"data:"):
+            self._data.append(line[5:].lstrip(b" "))
+        elif line.startswith(b":") or line.startswith((b"event:", b"id:", b"retry:")):
+            pass
+        else:
+            self._dispatch(frames)
+            self._parse(line, frames)
+
+    def _dispatch(self, frames):
+        if self._data:
+            data = b"\n".join(self._data)
+            self._data = []
+            self._parse(data, frames)
+
+    def _parse(self, data, frames):
+        if data.strip() == b"[DONE]":
+            return
+        try:
+            frames.append(json.loads(data))
+        except ValueError:
+            self.errors += 1
+            logging.error(f"Dropping malformed upstream frame: {data[:120]!r}")
@@ -0,0 +1,239 @@
+import os
+import platform
+import sys
+import threading
+import time
+from collections import deque
+import psutil
+from utils.logging import logging
+
+
+class NvmlSource:
+    """
+    GPU statistics read from NVML in-process (requires pynvml), without forking nvidia-smi.
+    """
+
+    name = "nvml"
+
+    def __init__(self):
+        import pynvml
+        self.nvml = pynvml
+        pynvml.nvmlInit()
+        self.driver = self.text(pynvml.nvmlSystemGetDriverVersion())
+        self.handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(pynvml.nvmlDeviceGetCount())]
+        self.static = [{"uuid": self.text(pynvml.nvmlDeviceGetUUID(h)), "name": self.text(pynvml.nvmlDeviceGetName(h))} for h in self.handles]
+
+    @staticmethod
+    def text(value):
+        # Older pynvml versions return bytes
+        return value.decode() if isinstance(value, bytes) else value
+
+    def gpus(self):
+        nvml = self.nvml
+        gpus = []
+        for index, (handle, static) in enumerate(zip(self.handles, self.static)):
+            memory = nvml.nvmlDeviceGetMemoryInfo(handle)
+            gpu = {"index": index, **static, "driver": self.driver,
+                   "total_memory": memory.total / 1024 ** 2, "memory_used": memory.used / 1024 ** 2, "free_memory": memory.free / 1024 ** 2,
+                   "load": nvml.nvmlDeviceGetUtilizationRates(handle).gpu / 100}
+            try:
+                gpu["temperature"] = nvml.nvmlDeviceGetTemperature(handle, nvml.NVML_TEMPERATURE_GPU)
+                gpu["power"] = nvml.nvmlDeviceGetPowerUsage(handle) / 1000
+            except nvml.NVMLError:
+                pass
+            gpus.append(gpu)
+        return gpus
+
+
+class GPUtilSource:
+    """
+    GPU statistics from GPUtil, which runs nvidia-smi on every call; used when pynvml is unavailable.
+    """
+
+    name = "nvidia-smi"
+
+    def gpus(self):
+        import GPUtil
+        return [{"index": gpu.id, "uuid": gpu.uuid, "name": gpu.name, "driver": gpu.driver,
+                 "total_memory": gpu.memoryTotal, "memory_used": gpu.memoryUsed, "free_memory": gpu.memoryFree,
+                 "load": gpu.load, "temperature": gpu.temperature} for gpu in GPUtil.getGPUs()]
+
+
+class FakeSource:
+    """
+    Fixed GPU statistics, for tests and machines without GPUs.
+
+    :param gpus: List of GPU dicts, or a callable returning one (e.g. to simulate load).
+    """
+
+    name = "fake"
+
+    def __init__(self, gpus=None):
+        self._gpus = gpus or []
+
+    def gpus(self):
+        return [dict(gpu) for gpu in (self._gpus() if callable(self._gpus) else self._gpus)]
+
+
+def default_source():
+    try:
+        return NvmlSource()
+    except Exception as e:
+        logging.debug(f"NVML unavailable ({e}), falling back to nvidia-smi for GPU telemetry")
+        return GPUtilSource()
+
+
+def read_cgroup_file(file_path):
+    try:
+        with open(file_path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_stats():
+    """
+    Memory and CPU accounting of the container, from cgroup v2 or v1.
+    """
+    if os.path.exists('/sys/fs/cgroup/cgroup.controllers'):
+        quota, _, period = (read_cgroup_file('/sys/fs/cgroup/cpu.max') or "max 100000").partition(" ")
+        cpu_stat = dict(line.split() for line in (read_cgroup_file('/sys/fs/cgroup/cpu.stat') or "").splitlines() if line)
+        return {
+            "cgroup_memory_usage": read_cgroup_file('/sys/fs/cgroup/memory.current'),
+            "cgroup_memory_limit": read_cgroup_file('/sys/fs/cgroup/memory.max'),
+            "cgroup_cpu_quota": "-1" if quota == "max" else quota,
+            "cgroup_cpu_period": period,
+            "cgroup_cpu_usage": str(int(cpu_stat["usage_usec"]) * 1000) if "usage_usec" in cpu_stat else None,
+        }
+    return {
+        "cgroup_memory_usage": read_cgroup_file('/sys/fs/cgroup/memory/memory.usage_in_bytes'),
+        "cgroup_memory_limit": read_cgroup_file('/sys/fs/cgroup/memory/memory.limit_in_bytes'),
+        "cgroup_cpu_quota": read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us'),
+        "cgroup_cpu_period": read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us'),
+        "cgroup_cpu_usage": read_cgroup_file('/sys/fs/cgroup/cpu/cpuacct.usage'),
+    }
+
+
+class TelemetrySampler:
+    """
+    Samples GPU, memory, disk and cgroup statistics in a background thread.
+
+    Readers get the latest sample (`snapshot`, `gpu`) without any system call, and
+    the last `history` samples are kept in a ring buffer. GPU statistics come from
+    NVML when pynvml is installed, nvidia-smi otherwise, or any object with a
+    `gpus()` method (see FakeSource).
+    """
+
+    def __init__(self, interval: float = 2.0, history: int = 300, source=None, disk_path: str = "/"):
+        """
+        :param interval: Seconds between two samples.
+        :param history: Number of samples kept.
+        :param source: GPU statistics source (defaults to NVML, then nvidia-smi).
+        :param disk_path: Path whose file system is reported.
+        """
+        self.interval = interval
+        self.source = source or default_source()
+        self.disk_path = disk_path
+        self.samples = deque(maxlen=history)
+        self.static = {
+            "os": platform.system(),
+            "version": platform.version(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "python": sys.version,
+            "total_ram": psutil.virtual_memory().total / (1024 ** 2),
+        }
+        self.docker = os.path.exists('/.dockerenv')
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._gpu_error = None
+        self.sample()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+            self._thread.start()
+            logging.debug(f"Telemetry sampler started ({self.source.name}, every {self.interval}s)")
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """
+        Take a sample now and return it.
+        """
+        start = time.perf_counter()
+        try:
+            gpus = self.source.gpus()
+            self._gpu_error = None
+        except Exception as e:
+            # Logged once rather than at every sample
+            if str(e) != self._gpu_error:
+                logging.error(f"Error in gathering GPU telemetry: {e}")
+            self._gpu_error = str(e)
+            gpus = []
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage(self.disk_path)
+        sample = {
+            "time": time.time(),
+            "free_ram": memory.available / (1024 ** 2),
+            "disk_space": {"total": disk.total / (1024 ** 2), "used": disk.used / (1024 ** 2), "free": disk.free / (1024 ** 2)},
+            "gpus": gpus,
+            "sample_seconds": time.perf_counter() - start,
+        }
+        if self.docker:
+            sample["docker"] = cgroup_stats()
+        with self._lock:
+            self.samples.append(sample)
+        return sample
+
+    @property
+    def latest(self):
+        return self.samples[-1]
+
+    def visible_gpus(self, gpus):
+        # GPUs visible to the daemon as per CUDA_VISIBLE_DEVICES
+        cuda_visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+        if not cuda_visible_devices:
+            return gpus
+        visible = {int(i) for i in cuda_visible_devices.split(',') if i.strip().isdigit()}
+        return [gpu for gpu in gpus if gpu["index"] in visible]
+
+    def snapshot(self):
+        """
+        System information from the latest sample, in the format /system_info always had:
+        GPU total memory as a string, unreadable cgroup values as 0, and no sampling
+        fields. Samples in their own format are available through `history`.
+        """
+        sample = self.latest
+        snapshot = {**self.static, "free_ram": sample["free_ram"], "disk_space": sample["disk_space"],
+                    "gpus": [{"uuid": gpu["uuid"], "name": gpu["name"], "total_memory": f"{gpu['total_memory']}", "free_memory": gpu["free_memory"],
+                              "memory_used": gpu["memory_used"], "driver": gpu["driver"], "load": gpu["load"]} for gpu in self.visible_gpus(sample["gpus"])]}
+        if "docker" in sample:
+            snapshot["docker"] = {key: 0 if value is None else value for key, value in sample["docker"].items()}
+        return snapshot
+
+    def history(self, seconds: float = None):
+        """
+        Samples of the last `seconds` (all kept samples by default), oldest first.
+        """
+        with self._lock:
+            samples = list(self.samples)
+        if seconds is not None:
+            since = time.time() - seconds
+            samples = [sample for sample in samples if sample["time"] >= since]
+        return samples
+
+    def gpu(self, index: int, fresh: bool = False):
+        """
+        Statistics of one GPU (by physical index), from the latest or a new sample.
+        """
+        sample = self.sample() if fresh else self.latest
+        return next((gpu for gpu in sample["gpus"] if gpu["index"] == index), None)
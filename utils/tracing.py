@@ -0,0 +1,284 @@
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+import aiohttp
+from utils.logging import logging
+
+# Span of the current request, inherited by the tasks it starts
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_id(n_bytes):
+    return os.urandom(n_bytes).hex()
+
+
+def parse_traceparent(value):
+    """
+    Parse a W3C traceparent header into (trace_id, parent_id, sampled), or None if invalid.
+    """
+    parts = (value or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Trace:
+    """
+    Spans of one request; written to the trace file when the request ends, if sampled.
+    """
+
+    def __init__(self, trace_id, request_id, sampled, parent_id=None):
+        self.trace_id = trace_id
+        self.request_id = request_id
+        self.sampled = sampled
+        # Span of the caller, when it sent a traceparent
+        self.parent_id = parent_id
+        self.events = []
+        # Each request gets its own row in the viewer, so that its spans nest
+        self.tid = int(trace_id[:8], 16)
+
+
+class SpanContext:
+    __slots__ = ("trace", "span_id")
+
+    def __init__(self, trace, span_id):
+        self.trace = trace
+        self.span_id = span_id
+
+
+class Tracer:
+    """
+    Request tracing across the daemon and its backends.
+
+    Every request gets a request ID (X-Request-ID, kept from the client when given)
+    and a W3C trace context that is forwarded to workers and api_servers. Sampling
+    is decided once at the head of the request, from `sample_rate` or the sampled
+    flag of an incoming traceparent, so unsampled requests only pay for creating IDs.
+    Spans of sampled requests, including those reported by diffusion workers, are
+    appended to `path` as Chrome trace events, which chrome://tracing and Perfetto load.
+    """
+
+    def __init__(self, path: str = None, sample_rate: float = 0.01, max_file_mb: int = 256):
+        """
+        :param path: Trace file (None disables tracing, request IDs are still propagated).
+        :param sample_rate: Share of requests traced.
+        :param max_file_mb: Size after which the trace file is rotated to `path`.1.
+        """
+        self.path = path
+        self.sample_rate = sample_rate if path else 0.0
+        self.max_file_bytes = max_file_mb * 1024 ** 2
+        self.pid = os.getpid()
+        self.processes = {self.pid: "daemon"}
+        self._named = set()
+        self._file = None
+        self._lock = threading.Lock()
+        # Wall clock derived from the monotonic clock, comparable with the workers' time.time()
+        self._offset = time.time() - time.perf_counter()
+        self.aiohttp_trace_config = self.make_aiohttp_trace_config()
+
+    def now(self):
+        return self._offset + time.perf_counter()
+
+    def start(self, traceparent=None, request_id=None):
+        """
+        Start the trace of an incoming request and make it current.
+
+        :return: Token to pass to `finish`.
+        """
+        parent = parse_traceparent(traceparent)
+        if parent:
+            trace_id, parent_id, sampled = parent
+            sampled = sampled and self.path is not None
+        else:
+            trace_id, parent_id, sampled = new_id(16), None, random.random() < self.sample_rate
+        trace = Trace(trace_id, request_id or new_id(8), sampled, parent_id)
+        # The daemon gets a span of its own, child of the caller's: backends see it as their parent
+        return current_span.set(SpanContext(trace, new_id(8)))
+
+    def finish(self, token):
+        context = current_span.get()
+        current_span.reset(token)
+        if context is not None and context.trace.sampled and context.trace.events:
+            self.write(context.trace.events)
+
+    def current(self):
+        return current_span.get()
+
+    def headers(self):
+        """
+        Headers propagating the current request to a backend.
+        """
+        context = current_span.get()
+        if context is None:
+            return {}
+        trace = context.trace
+        return {"traceparent": f"00-{trace.trace_id}-{context.span_id}-{'01' if trace.sampled else '00'}", "X-Request-ID": trace.request_id}
+
+    def record(self, name, start, end=None, pid=None, **args):
+        """
+        Add a finished span to the current trace.
+
+        :param start: Wall clock start in seconds (see `now`).
+        """
+        context = current_span.get()
+        if context is None or not context.trace.sampled:
+            return
+        trace = context.trace
+        end = end if end is not None else self.now()
+        trace.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": round(start * 1e6),
+            "dur": round(max(end - start, 0) * 1e6),
+            "pid": pid or self.pid,
+            "tid": trace.tid,
+            "args": {"request_id": trace.request_id, "trace_id": trace.trace_id, **args},
+        })
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Time a block as a span of the current trace; spans opened inside it become its children.
+
+        Not for blocks that yield from an async generator: use `record` there.
+        """
+        context = current_span.get()
+        if context is None or not context.trace.sampled:
+            yield
+            return
+        token = current_span.set(SpanContext(context.trace, new_id(8)))
+        start = self.now()
+        try:
+            yield
+        finally:
+            current_span.reset(token)
+            self.record(name, start, **args)
+
+    def record_remote(self, header, process, pid):
+        """
+        Add the spans a worker reported in its X-Trace-Spans header ([name, start, duration] in seconds).
+        """
+        if not header:
+            return
+        try:
+            spans = [(str(name), float(start), float(duration)) for name, start, duration in json.loads(header)]
+        except (ValueError, TypeError):
+            # Malformed reports are dropped, they must not fail the request
+            logging.debug(f"Ignoring malformed X-Trace-Spans header from {process}")
+            return
+        self.processes.setdefault(pid, process)
+        for name, start, duration in spans:
+            self.record(name, start, start + duration, pid=pid)
+
+    def make_aiohttp_trace_config(self):
+        """
+        aiohttp hooks adding connection and time-to-first-byte spans to backend requests.
+        """
+        tracer = self
+
+        def sampled():
+            context = current_span.get()
+            return context is not None and context.trace.sampled
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = tracer.now() if sampled() else None
+
+        async def on_connection_queued_start(session, ctx, params):
+            ctx.queued = tracer.now()
+
+        async def on_connection_queued_end(session, ctx, params):
+            if ctx.start is not None:
+                tracer.record("connection pool wait", ctx.queued)
+
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect = tracer.now()
+
+        async def on_connection_create_end(session, ctx, params):
+            if ctx.start is not None:
+                tracer.record("connect", ctx.connect)
+
+        async def on_request_end(session, ctx, params):
+            # Called once the response headers are received
+            if ctx.start is not None:
+                tracer.record("first byte", ctx.start, url=str(params.url.path), status=params.response.status)
+
+        trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=lambda trace_request_ctx=None: SimpleNamespace(start=None, queued=None, connect=None))
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    def write(self, events):
+        with self._lock:
+            try:
+                if self._file is None or self._file.tell() > self.max_file_bytes:
+                    self.open()
+                lines = []
+                for pid in {event["pid"] for event in events} - self._named:
+                    self._named.add(pid)
+                    lines.append(json.dumps({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": self.processes.get(pid, str(pid))}}))
+                lines.extend(json.dumps(event) for event in events)
+                # JSON array format; viewers accept the missing closing bracket
+                self._file.write(",\n".join(lines) + ",\n")
+                self._file.flush()
+            except OSError as e:
+                logging.error(f"Failed to write trace events to {self.path}: {e}")
+
+    def open(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self.path, self.path + ".1")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._file = open(self.path, "w")
+        self._file.write("[\n")
+        self._named = set()
+        logging.info(f"Writing request traces to {self.path} (sample rate {self.sample_rate})")
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware starting the trace of every request, with a root span lasting
+    until its response is fully sent, and returning its X-Request-ID.
+    """
+
+    def __init__(self, app, tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = {name: value for name, value in scope["headers"] if name in (b"traceparent", b"x-request-id")}
+        token = self.tracer.start(
+            traceparent=headers.get(b"traceparent", b"").decode("latin-1"),
+            request_id=headers.get(b"x-request-id", b"").decode("latin-1")[:128] or None,
+        )
+        context = self.tracer.current()
+        start = self.tracer.now()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", context.trace.request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = getattr(scope.get("route"), "path", scope["path"])
+            self.tracer.record(f"{scope['method']} {route}", start, status=status_code, model=scope.get("path_params", {}).get("model_name", ""), parent_id=context.trace.parent_id or "")
+            self.tracer.finish(token)
@@ -1,29 +1,22 @@
 import multiprocessing
 import threading
-import requests
 import time
 import json
 from utils.logging import logging
+from utils.stream import FrameDecoder
 import asyncio
 import os 
 import subprocess
 import torch
 import gc
-import configparser
 import signal
-import GPUtil
-import concurrent.futures
 import sys
 import aiohttp
 import shlex
-# Function to check if a string is valid JSON
-def is_valid_json(json_str):
-    try:
-        json.loads(json_str)
-        return True
-    except json.JSONDecodeError:
-        return False
-
+from utils.process import ManagedProcess
+from utils.workspace import source_hash
+from utils.metrics import GenerationMetrics
+from utils.cancellation import abandon_reason
 # Function to count the number of GPUs specified in a comma-separated string
 def count_gpu(gpus_str):
     gpu_list = gpus_str.split(',')
@@ -37,25 +30,6 @@ def get_first_gpu(gpus_str):
     else:
         return None
 
-# Function to check a configuration file for a specific tensor parallel size
-def check_tp_config(file, tp):
-    try:
-        config = configparser.ConfigParser()
-        config.read(file)
-    except FileNotFoundError:
-        return False
-    
-    if 'llama' in config:
-        llama_section = config['llama']
-        
-        if 'tensor_para_size' in llama_section:
-            tensor_para_size = int(llama_section['tensor_para_size'])
-            if tensor_para_size == tp:
-                return True
-    
-    return False
-
-
 class TurboMindThread(threading.Thread):
   def __init__(self, *args, **keywords):
     threading.Thread.__init__(self, *args, **keywords)
@@ -88,8 +62,10 @@ class TurboMindThread(threading.Thread):
 
 # Class for managing TurboMind
 class TurboMind:
-    def __init__(self, instance, model_name: str = None, model_path: str = None, host: str = "127.0.0.1", port: int = 9000, tp: int = 1, instance_num: int = 8, gpu_id=0, warm_up=True, tb_model_type: str = "qwen-14b", prevent_oom=False):
-        instance.models[model_name] = self
+    def __init__(self, instance, model_name: str = None, model_path: str = None, host: str = "127.0.0.1", port: int = 9000, tp: int = 1, instance_num: int = 8, gpu_id=0, warm_up=True, tb_model_type: str = "qwen-14b", prevent_oom=False, max_connections: int = 512, register: bool = True):
+        # A replacement started by a blue/green swap is registered once it is ready
+        if register:
+            instance.models[model_name] = self
         self.instance = instance
         self.prevent_oom = prevent_oom
         self.headers = {'Content-Type': 'application/json'}
@@ -97,6 +73,7 @@ class TurboMind:
         self.model_name = model_name
         self.model_type = "turbomind"
         self.process = None
+        self.inflight = 0
         self.instance = instance
         self.model_path = model_path
         self.host = host
@@ -107,66 +84,51 @@ class TurboMind:
         self.gpu_id = gpu_id
         self.base_directory = instance.base_directory
         self.cache_max_entry_count = 0.5
+        self.workspace = None
+        self.generation_metrics = GenerationMetrics(instance.metrics, backend=f"{host}:{port}")
+        # Keep-alive connection pool to the lmdeploy api_server, created lazily on the running loop
+        self.max_connections = max_connections
+        self._session = None
+        self._session_loop = None
         # Load TurboMind Model
         self.run_build_process()
         self.start_process()
-        mon_thread = threading.Thread(target=self.check_endpoint)
-
-        mon_thread.start()
 
+    # Health probe used by the health supervisor (see utils.health)
+    async def probe(self, timeout=5):
+        session = await self.get_session()
+        async with session.get("/v1/models", timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status == 200
 
-    def on_failure(self):
-        self.start_process()
-        self.wait_for_tb_model_status()
-        self.status = 1
-
-    def check_endpoint(self, check_interval=10, timeout=10):
-        while True:
-            if self.status == 1:
-                try:
-                    response = requests.get(f"http://{self.host}:{self.port}/v1/models", timeout=timeout)
-                    if response.status_code == 200:
-                        pass
-                    else:
-                        self.status = 0
-                        logging.error("Endpoint is down, auto restart")
-                        self.on_failure()
-                except requests.exceptions.Timeout:
-                    self.status = 0
-                    logging.error("Endpoint is down, auto restart")
-                    self.on_failure()
-                except requests.exceptions.RequestException as e:
-                    self.status = 0
-                    logging.error("Endpoint is down, auto restart")
-                    self.on_failure()
-
-            time.sleep(check_interval)
+    # Restart requested by the health supervisor, which then waits for the probe to pass
+    async def restart(self):
+        logging.error(f"Endpoint {self.host}:{self.port} is down, auto restart")
+        await self.close_session()
+        await self.process.restart(term_timeout=5)
     def is_running(self):
-        stat = os.system("ps -p %s &> /dev/null" % self.process.pid)
-        return stat == 0
+        return self.process is not None and self.process.is_running()
     def get_gpu_memory(self, gpu_id):
-        try:
-            gpu_info = GPUtil.getGPUs()[gpu_id]
-            total_memory = gpu_info.memoryUsed
-            return total_memory
-        except Exception as e:
-            logging.error(f"An error occurred while getting GPU memory: {str(e)}")
+        # A fresh sample, taken right after the test requests
+        gpu_info = self.instance.telemetry.gpu(gpu_id, fresh=True)
+        if gpu_info is None:
+            logging.error(f"An error occurred while getting GPU memory: no telemetry for GPU {gpu_id}")
             return 0.0
+        return gpu_info["memory_used"]
 
     # Function to run an interactive test
-    def run_interactive_test(self):
+    async def run_interactive_test(self):
         tokens = self.interactive(prompt="Once upon a time, in a picturesque little village ...")
-        return concurrent.futures.ThreadPoolExecutor().submit(self.process_tokens, tokens)
+        return await self.process_tokens(tokens)
     
     # Function to process tokens from an interactive test
-    def process_tokens(self, tokens):
+    async def process_tokens(self, tokens):
         final_response = ""
-        for token in tokens:
+        async for token in tokens:
             final_response += json.loads(token)['text']
         return final_response
 
     # Function to warm up the TurboMind model
-    def warm_up(self, gpu_id):
+    async def warm_up(self, gpu_id):
         logging.info(f"🌺 Warming up {self.model_path}.. Please wait.")
         logging.warning(f"🌺 This may take some time. We check how many concurrent requests your GPUs can handle.")
         
@@ -174,18 +136,14 @@ class TurboMind:
         
         try:
             # Measure VRAM usage with a single request
-            single_request_future = self.run_interactive_test()
-            single_request_future.result()  # Wait for the single request to complete
-            single_request_memory = self.get_gpu_memory(get_first_gpu(gpu_id))
+            await self.run_interactive_test()
+            single_request_memory = await asyncio.to_thread(self.get_gpu_memory, get_first_gpu(gpu_id))
             logging.info(f"Single request GPU memory usage: {single_request_memory:.2f} MB")
 
             # Measure VRAM usage with two simultaneous requests
-            futures = [self.run_interactive_test(), self.run_interactive_test()]
-
-            for future in concurrent.futures.as_completed(futures):
-                response = future.result()
+            await asyncio.gather(self.run_interactive_test(), self.run_interactive_test())
             
-            total_memory = self.get_gpu_memory(get_first_gpu(gpu_id))
+            total_memory = await asyncio.to_thread(self.get_gpu_memory, get_first_gpu(gpu_id))
             logging.info(f"Total GPU memory used with two concurrent requests: {total_memory:.2f} MB")
 
             # Calculate RAM usage per request
@@ -197,27 +155,23 @@ class TurboMind:
 
     # Function to start the TurboMind subprocess
     def start_process(self):
-        # Create a thread to run the subprocess
-        self.process_thread = threading.Thread(target=self.run_subprocess)
-        self.process_thread.start()
+        self.run_subprocess()
 
     # Function to run the model build process
     def run_build_process(self):
-        if not check_tp_config(f"{self.base_directory}{self.model_path}workspace/triton_models/weights/config.ini", count_gpu(self.gpu_id)):
-            environment = os.environ.copy()
-            environment["CUDA_VISIBLE_DEVICES"] = self.gpu_id
-            
-            command = f"lmdeploy convert {self.tb_model_type} {self.base_directory}{self.model_path}model --dst-path {self.base_directory}{self.model_path}workspace --model-format awq --group-size 128 --tp {count_gpu(self.gpu_id)}"
-            logging.info(f'Spawning build model for {self.model_path}')
-
-            try:
-                # Execute the command using subprocess.run
-                subprocess.run(command, shell=True, check=False, env=environment)
-                logging.success(f'Model building is complete')
-            except subprocess.CalledProcessError as e:
-                logging.error(f"Error when executing the command: {e}")
-            except Exception as e:
-                logging.error(f"An error occurred: {e}")
+        # Reuse a workspace converted from the same snapshot with the same settings, if any
+        environment = os.environ.copy()
+        environment["CUDA_VISIBLE_DEVICES"] = self.gpu_id
+        source_dir = f"{self.base_directory}{self.model_path}model"
+        manifest = self.instance.downloads.load_manifest(source_dir)
+        self.workspace = self.instance.workspaces.get_or_convert(
+            root=f"{self.base_directory}{self.model_path}workspaces",
+            source_dir=source_dir,
+            source_hash=source_hash(manifest) if manifest else self.instance.get_revision(self.model_name),
+            model_type=self.tb_model_type,
+            tp=count_gpu(self.gpu_id),
+            env=environment,
+        )
 
     # Function to run the TurboMind subprocess
     def run_subprocess(self):
@@ -227,40 +181,106 @@ class TurboMind:
         environment = os.environ.copy()
         environment["CUDA_VISIBLE_DEVICES"] = self.gpu_id
         logging.debug(f'Batch size limit = {self.instance_num}. If OOM errors occur, lower the batch size limit with --instance_num')
-        command = f"lmdeploy serve api_server {self.base_directory}{self.model_path}workspace --server-name {self.host} --server-port {self.port} --tp {count_gpu(self.gpu_id)} --cache-max-entry-count {self.cache_max_entry_count}"
-        logging.info(f'Spawning 1 process for {self.model_path}')
+        command = f"lmdeploy serve api_server {self.workspace} --server-name {self.host} --server-port {self.port} --tp {count_gpu(self.gpu_id)} --cache-max-entry-count {self.cache_max_entry_count}"
 
         try:
-            # Execute the command using subprocess.run
-            subprocess.run(command, shell=True, check=False, env=environment)
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error when executing the command: {e}")
+            self.process = ManagedProcess(command, name=f"{self.model_path} (GPU {self.gpu_id}, port {self.port})", env=environment).start()
         except Exception as e:
             logging.error(f"An error occurred: {e}")
 
     # Function to wait for the TurboMind model to be ready
-    def wait_for_tb_model_status(self, timeout=240):
+    async def wait_for_tb_model_status(self, timeout=240):
         start_time = time.time()
-        url = f"http://{self.host}:{self.port}/v1/models"
+        session = await self.get_session()
         while True:
             current_time = time.time()
             if current_time - start_time > timeout:
                 logging.error(f"Error: Timeout of {timeout} seconds exceeded for model {self.model_path} ({self.host}:{self.port})")
                 return False
+            if self.process is not None and not self.process.is_running():
+                logging.error(f"Error: api_server for {self.model_path} exited with code {self.process.process.returncode}")
+                return False
 
             try:
-                response = requests.get(url)
-                if response.status_code == 200:
-                    data = response.json()
-                    self.tb_model = data['data'][0]['id']
-                    logging.info(f'Model {self.model_path} is ready')
-                    return True
-            except requests.exceptions.RequestException:
-                time.sleep(1)
+                async with session.get("/v1/models", timeout=aiohttp.ClientTimeout(total=5)) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        self.tb_model = data['data'][0]['id']
+                        logging.info(f'Model {self.model_path} is ready')
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError):
                 pass
+            await asyncio.sleep(1)
+
+    # Function to get the pooled session for this backend
+    async def get_session(self):
+        """
+        Return the keep-alive session to the lmdeploy api_server.
+
+        The session is bound to the event loop it was created on, so a new one is
+        opened if the daemon is now running on a different loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, limit_per_host=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                base_url=f"http://{self.host}:{self.port}",
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+                trace_configs=[self.instance.tracer.aiohttp_trace_config],
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def close_session(self):
+        if self._session is not None and not self._session.closed and self._session_loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    # Function to stream decoded JSON frames from the api_server
+    async def stream(self, endpoint, payload):
+        session = await self.get_session()
+        decoder = FrameDecoder()
+        tracer = self.instance.tracer
+        start = tracer.now()
+        first_frame = True
+        self.inflight += 1
+        try:
+            async with session.post(endpoint, data=json.dumps(payload), headers=tracer.headers()) as response:
+                if response.status >= 500:
+                    self.instance.health.record_failure(self, f"HTTP {response.status} on {endpoint}")
+                else:
+                    self.instance.health.record_success(self)
+                # An error body holds no frames: fail the generation instead of ending it empty
+                if response.status >= 400:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status,
+                                                      message=(await response.text())[:200], headers=response.headers)
+                try:
+                    async for chunk in response.content.iter_any():
+                        for frame in decoder.feed(chunk):
+                            if first_frame:
+                                first_frame = False
+                                tracer.record("first token", start, endpoint=endpoint)
+                            yield frame
+                except (GeneratorExit, asyncio.CancelledError):
+                    # Drop the connection instead of returning it to the pool, so the
+                    # api_server sees the client gone and stops generating
+                    response.close()
+                    raise
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            self.instance.health.record_failure(self, f"{type(e).__name__} on {endpoint}")
+            raise
+        finally:
+            self.inflight -= 1
+            # Spans cannot be opened across yields of a generator, so the stream is recorded afterwards
+            tracer.record("upstream stream", start, endpoint=endpoint, model=self.model_name)
+        for frame in decoder.flush():
+            yield frame
 
     # Function for interactive completions
-    def interactive(self, prompt=None, temperature=0.7, repetition_penalty=1.2, top_p=0.7, top_k=40, max_tokens=512):
+    async def interactive(self, prompt=None, temperature=0.7, repetition_penalty=1.2, top_p=0.7, top_k=40, max_tokens=512, seed=None):
         logging.debug(f"[-->] (Interactive) [{self.model_path}] Request for completion")
         payload = {
             "prompt": prompt,
@@ -271,27 +291,37 @@ class TurboMind:
             "stream": True,
             "request_output_len": max_tokens
         }
-        data = json.dumps(payload)
-        response = requests.post(f"http://{self.host}:{self.port}" + '/v1/chat/interactive', data=data, stream=True)
+        if seed is not None:
+            payload["seed"] = seed
 
         stream_start_time = time.time()
-        response_stream = response.iter_content(chunk_size=1024, decode_unicode=True)
+        timer = self.generation_metrics.timer(model=self.model_name, endpoint="interactive")
         tokens = 0;
-        for chunk in response_stream:
-            try:
-                if is_valid_json(chunk):
-                    chunk_data = json.loads(chunk)
-                    if 'text' in chunk_data:
-                        yield json.dumps({"text": chunk_data['text']})+"\n"
-                        tokens = chunk_data['tokens'];         
-            except Exception as e:
-                logging.error('Chunk :', str(e))
+        failed = False
+        abandoned = None
+        frames = self.stream('/v1/chat/interactive', payload)
+        try:
+            async for chunk_data in frames:
+                if 'text' in chunk_data:
+                    timer.chunk()
+                    yield json.dumps({"text": chunk_data['text']})+"\n"
+                    tokens = chunk_data.get('tokens', tokens)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            failed = True
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            abandoned = abandon_reason()
+            raise
+        finally:
+            # Closed early when the client disconnected or the deadline passed: abort the upstream request now
+            await frames.aclose()
+            timer.finish(tokens, error=failed, abandoned=abandoned, max_tokens=max_tokens)
 
         streaming_duration = round(time.time() - stream_start_time, 2)
         logging.debug(f"[<--] (Interactive) [{self.model_path}] Completion done in {streaming_duration}s ({tokens} tokens)")
 
     # Function for message completions
-    def completion(self, messages=None, temperature=0.7, repetition_penalty=1.2, top_p=0.7, max_tokens=512):
+    async def completion(self, messages=None, temperature=0.7, repetition_penalty=1.2, top_p=0.7, max_tokens=512, seed=None):
         logging.debug(f"[-->] [{self.model_path}] Request for completion")
         payload = {
             "model": self.tb_model,
@@ -302,37 +332,51 @@ class TurboMind:
             "stream": True,
             "max_tokens": max_tokens
         }
-        data = json.dumps(payload)
-        response = requests.post(f"http://{self.host}:{self.port}" + '/v1/chat/completions', data=data, stream=True)
+        if seed is not None:
+            payload["seed"] = seed
 
         stream_start_time = time.time()
-        response_stream = response.iter_content(chunk_size=1024, decode_unicode=True)
+        timer = self.generation_metrics.timer(model=self.model_name, endpoint="completions")
         tokens = 0;
-        for chunk in response_stream:
-            try:
-                chunk = chunk.replace("data:", "")
-                if is_valid_json(chunk):
-                    chunk_data = json.loads(chunk) 
-                    if 'choices' in chunk_data:
-                        if 'content' in chunk_data['choices'][0]["delta"]:
-                            yield json.dumps({"text": chunk_data['choices'][0]["delta"]["content"]})+"\n"
-                            
-         
-            except Exception as e:
-                logging.error('Chunk :', str(e))
+        failed = False
+        abandoned = None
+        frames = self.stream('/v1/chat/completions', payload)
+        try:
+            async for chunk_data in frames:
+                choices = chunk_data.get('choices')
+                if choices and 'content' in choices[0].get("delta", {}):
+                    timer.chunk()
+                    yield json.dumps({"text": choices[0]["delta"]["content"]})+"\n"
+                    tokens += 1
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            failed = True
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            abandoned = abandon_reason()
+            raise
+        finally:
+            # Closed early when the client disconnected or the deadline passed: abort the upstream request now
+            await frames.aclose()
+            timer.finish(tokens, error=failed, abandoned=abandoned, max_tokens=max_tokens)
 
         streaming_duration = round(time.time() - stream_start_time, 2)
-        logging.debug(f"[<--] (Completion) [{self.model_path}] Completion done in {streaming_duration}s")
+        logging.debug(f"[<--] (Completion) [{self.model_path}] Completion done in {streaming_duration}s ({tokens} tokens)")
 
     async def destroy(self):
-        if self.process:
-            try:
-                logging.info(f"Stop {self.model_path} model..")
-                del self.instance.models[self.model_name]
-                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
-                await asyncio.sleep(2)
-                logging.info(f"{self.model_path} model stopped.")
-            except Exception as e:
-                logging.error(f"Error when stopping {self.model_path} model: {e}")
-        else:
-            logging.info(f"{self.model_path} model is not running.")
\ No newline at end of file
+        # Stop routing first, then drain in-flight streams before stopping the api_server
+        self.instance.health.unregister(self)
+        if self.instance.models.get(self.model_name) is self:
+            del self.instance.models[self.model_name]
+        if self.process is None:
+            logging.info(f"{self.model_path} model is not running.")
+            return
+        try:
+            logging.info(f"Stop {self.model_path} model..")
+            gpu_free = await self.process.stop(idle=lambda: self.inflight == 0)
+            if gpu_free:
+                self.instance.release_port(self.port)
+        except Exception as e:
+            logging.error(f"Error when stopping {self.model_path} model: {e}")
+        finally:
+            self.instance.workspaces.release(self.workspace)
+            await self.close_session()
\ No newline at end of file
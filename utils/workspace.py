@@ -0,0 +1,160 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import Counter
+from utils.logging import logging
+
+METADATA_NAME = "workspace.json"
+
+
+def directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def source_hash(manifest):
+    """
+    Content hash of a downloaded snapshot from its manifest (see utils.download).
+    """
+    files = {name: entry.get("sha256") or entry.get("blob_id") for name, entry in manifest["files"].items()}
+    return hashlib.sha256(json.dumps({"revision": manifest["revision"], "files": files}, sort_keys=True).encode()).hexdigest()
+
+
+class WorkspaceCache:
+    """
+    Converted TurboMind workspaces, keyed by everything `lmdeploy convert` depends on.
+
+    Each model keeps its workspaces side by side in `<model>/workspaces/<key>`, so
+    going back to a previous TP degree or source revision reuses the earlier
+    conversion. A conversion is written to a temporary directory and only becomes
+    visible once complete. Workspaces of all models are evicted least recently used
+    first once they take more than `max_bytes`, except those currently served.
+    Workspaces of the previous layout (`<model>/workspace`, converted for whatever
+    settings were last used) are removed on startup, since their key is unknown.
+
+    Conversions of different workspaces run in parallel; the cache lock only covers
+    metadata, publication and eviction. Served workspaces are counted per user, since
+    a swap with the same settings serves the same workspace from two instances.
+    """
+
+    def __init__(self, models_directory, max_bytes: int = 200 * 1024 ** 3):
+        """
+        :param models_directory: Directory holding the model folders.
+        :param max_bytes: Disk budget of all workspaces.
+        """
+        self.models_directory = models_directory
+        self.max_bytes = max_bytes
+        self.in_use = Counter()
+        self._lock = threading.Lock()
+        self._conversions = {}
+        self.remove_legacy()
+
+    @staticmethod
+    def key(source_hash, model_type, model_format, group_size, tp):
+        params = {"source": source_hash, "model_type": model_type, "model_format": model_format, "group_size": group_size, "tp": tp}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def read_metadata(self, path):
+        try:
+            with open(os.path.join(path, METADATA_NAME), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def touch(self, path, metadata):
+        metadata["last_used"] = time.time()
+        metadata_path = os.path.join(path, METADATA_NAME)
+        with open(metadata_path + ".tmp", "w") as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(metadata_path + ".tmp", metadata_path)
+
+    def remove_legacy(self):
+        for path in glob.glob(os.path.join(self.models_directory, "*", "workspace")):
+            if os.path.isdir(path):
+                logging.info(f"Removing workspace {path} of the previous layout ({directory_size(path) / 1024 ** 3:.1f} GB)")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def get_or_convert(self, root, source_dir, source_hash, model_type, tp, model_format="awq", group_size=128, env=None):
+        """
+        Return the path of the workspace for these parameters, converting the model if needed.
+
+        :param root: Directory of the model's workspaces.
+        :param source_dir: Downloaded model snapshot.
+        :param source_hash: Content hash of the snapshot.
+        :raises RuntimeError: If the conversion fails.
+        """
+        key = self.key(source_hash, model_type, model_format, group_size, tp)
+        path = os.path.join(root, key[:16])
+        with self._lock:
+            conversion_lock = self._conversions.setdefault(path, threading.Lock())
+        # Only requests for this same workspace wait for its conversion
+        with conversion_lock:
+            with self._lock:
+                metadata = self.read_metadata(path)
+                if metadata is not None:
+                    logging.info(f"Reusing converted workspace {path} (tp={tp}, type={model_type})")
+                    self.touch(path, metadata)
+                    self.in_use[path] += 1
+                    return path
+
+            temporary_path = path + ".tmp"
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            os.makedirs(root, exist_ok=True)
+            command = ["lmdeploy", "convert", model_type, source_dir, "--dst-path", temporary_path, "--model-format", model_format, "--group-size", str(group_size), "--tp", str(tp)]
+            logging.info(f"Spawning build model for {source_dir} (tp={tp}, type={model_type})")
+            start = time.perf_counter()
+            result = subprocess.run(command, env=env, check=False)
+            if result.returncode != 0:
+                shutil.rmtree(temporary_path, ignore_errors=True)
+                raise RuntimeError(f"lmdeploy convert exited with code {result.returncode}")
+            metadata = {"key": key, "source": source_hash, "model_type": model_type, "model_format": model_format, "group_size": group_size, "tp": tp,
+                        "size": directory_size(temporary_path), "created": time.time()}
+            with self._lock:
+                self.touch(temporary_path, metadata)
+                # Left over with unreadable metadata, e.g. by an earlier crash
+                shutil.rmtree(path, ignore_errors=True)
+                os.replace(temporary_path, path)
+                logging.success(f"Model building is complete in {time.perf_counter() - start:.0f}s ({metadata['size'] / 1024 ** 3:.1f} GB)")
+                self.in_use[path] += 1
+                self.evict()
+            return path
+
+    def release(self, path):
+        if path is None:
+            return
+        with self._lock:
+            self.in_use[path] -= 1
+            if self.in_use[path] <= 0:
+                del self.in_use[path]
+
+    def evict(self):
+        """
+        Remove the least recently used workspaces until all of them fit in the budget.
+
+        Called with the cache lock held.
+        """
+        workspaces = []
+        for path in glob.glob(os.path.join(self.models_directory, "*", "workspaces", "*")):
+            metadata = self.read_metadata(path)
+            if metadata is not None:
+                workspaces.append((metadata.get("last_used", 0), metadata.get("size", 0), path))
+        total = sum(size for _, size, _ in workspaces)
+        for _, size, path in sorted(workspaces):
+            if total <= self.max_bytes:
+                break
+            if self.in_use[path] > 0:
+                continue
+            logging.info(f"Evicting converted workspace {path} ({size / 1024 ** 3:.1f} GB)")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size